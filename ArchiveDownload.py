@@ -0,0 +1,114 @@
+"""This module downloads the BlueToad archive.  The transfer is streamed to disk in chunks rather than held in
+memory, into a partial file beside the archive that is renamed into place only once it is complete and verified:
+its size against the length the server announced and, if D['archive_sha1'] is set, its sha1.
+
+What was fetched is recorded in a .download.json beside the archive (its url, ETag, Last-Modified, size and sha1).
+A refresh sends these back as a conditional request, so an unchanged archive is not downloaded again.  A transfer
+interrupted by a timeout or a dropped connection is resumed from the end of the partial file with a Range request,
+on the next attempt or the next run, as long as the server's copy has not changed in the meantime (If-Range)."""
+
+import os
+import socket
+import hashlib
+import httplib
+import urllib2
+import BlueToadAnalysis as BTA
+
+CHUNK_BYTES = 1 << 20
+
+def MetadataPath(dest_path):
+	"""The record of what was downloaded to (dest_path)."""
+	return dest_path + ".download.json"
+
+def PartPath(dest_path):
+	return dest_path + ".part"
+
+def ReadRecord(path):
+	return BTA.GetJSON("", path) if os.path.exists(path) else None
+
+def PartialHash(part_path):
+	"""The sha1 of the (part_path) downloaded so far, to be continued as the rest arrives."""
+	sha = hashlib.sha1()
+	with open(part_path, 'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK_BYTES), ''):
+			sha.update(chunk)
+	return sha
+
+def OpenTransfer(url, dest_path, timeout):
+	"""Request (url), conditionally on the copy at (dest_path) and resuming its partial file where there is one.
+	Returns the response and the bytes of the partial file it continues (0 to start over), or None and 0 if the
+	server's copy has not changed since it was downloaded."""
+	request = urllib2.Request(url)
+	record, part_record = ReadRecord(MetadataPath(dest_path)), ReadRecord(MetadataPath(PartPath(dest_path)))
+	if os.path.exists(dest_path) and record is not None and record['url'] == url: #a conditional refresh
+		if record.get('etag'): request.add_header('If-None-Match', record['etag'])
+		if record.get('last_modified'): request.add_header('If-Modified-Since', record['last_modified'])
+	resume_from = os.path.getsize(PartPath(dest_path)) if os.path.exists(PartPath(dest_path)) else 0
+	validator = None if part_record is None or part_record['url'] != url else (part_record.get('etag') or part_record.get('last_modified'))
+	if resume_from > 0 and validator:
+		request.add_header('Range', 'bytes=%d-' % resume_from)
+		request.add_header('If-Range', validator) #the whole file, rather than the rest, if it changed since
+	try:
+		response = urllib2.urlopen(request, timeout = timeout)
+	except urllib2.HTTPError, e:
+		if e.code == 304:
+			return None, 0
+		if e.code == 416 and resume_from > 0: #the partial file is already complete, or the server's copy shrank
+			os.remove(PartPath(dest_path))
+			return OpenTransfer(url, dest_path, timeout)
+		raise
+	return response, (resume_from if response.getcode() == 206 and resume_from > 0 and validator else 0)
+
+def Transfer(url, dest_path, timeout):
+	"""Stream one attempt at (url) into the partial file of (dest_path).  Returns None if the copy at (dest_path) is
+	current, or else the record of the completed partial file: its validators, announced size, and sha1."""
+	response, resume_from = OpenTransfer(url, dest_path, timeout)
+	if response is None:
+		return None
+	headers = response.info()
+	length = headers.get('Content-Length')
+	record = {'url' : url, 'etag' : headers.get('ETag'), 'last_modified' : headers.get('Last-Modified'),
+			  'size' : resume_from + int(length) if length is not None else None}
+	BTA.WriteJSON(record, "", MetadataPath(PartPath(dest_path))) #so that an interrupted transfer can be resumed
+	sha = PartialHash(PartPath(dest_path)) if resume_from > 0 else hashlib.sha1()
+	if resume_from > 0:
+		print "Resuming %s from %.1f MB" % (url, resume_from / 1048576.0)
+	with open(PartPath(dest_path), 'ab' if resume_from > 0 else 'wb') as local_file:
+		for chunk in iter(lambda: response.read(CHUNK_BYTES), ''):
+			local_file.write(chunk)
+			sha.update(chunk)
+	if record['size'] is not None and os.path.getsize(PartPath(dest_path)) < record['size']: #the connection closed early
+		raise socket.error("connection closed after %d of %d bytes" % (os.path.getsize(PartPath(dest_path)), record['size']))
+	record['sha1'] = sha.hexdigest()
+	return record
+
+def Download(url, dest_path, timeout = 60, retries = 3, expected_sha1 = None):
+	"""Download (url) to (dest_path), unless the copy there is current, retrying a failed transfer up to (retries)
+	times from where it stopped.  The download replaces (dest_path) only once its size, and (expected_sha1) if
+	given, are verified.  Returns True if (dest_path) was replaced, False if it was already current."""
+	for attempt in range(retries + 1):
+		try:
+			record = Transfer(url, dest_path, timeout)
+			break
+		except (socket.error, httplib.HTTPException, urllib2.URLError), e: #timeouts included; HTTP errors are not retried
+			if isinstance(e, urllib2.HTTPError) or attempt == retries:
+				raise
+			print "Transfer of %s stopped (%s), retrying" % (url, e)
+	if record is None:
+		print "%s is unchanged since it was downloaded" % url
+		return False
+	received = os.path.getsize(PartPath(dest_path))
+	failure = None
+	if record['size'] is not None and received != record['size']:
+		failure = "%s gave %d bytes rather than %d" % (url, received, record['size'])
+	elif expected_sha1 is not None and record['sha1'] != expected_sha1:
+		failure = "%s has sha1 %s rather than %s" % (url, record['sha1'], expected_sha1)
+	if failure is not None: #start over on the next attempt, rather than resume from a corrupt file
+		os.remove(PartPath(dest_path)); os.remove(MetadataPath(PartPath(dest_path)))
+		raise IOError(failure)
+	record['size'] = received
+	os.rename(PartPath(dest_path), dest_path)
+	BTA.WriteJSON(record, "", MetadataPath(dest_path))
+	os.remove(MetadataPath(PartPath(dest_path)))
+	print "Downloaded %s, %.1f MB" % (url, received / 1048576.0)
+	return True
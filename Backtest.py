@@ -0,0 +1,318 @@
+"""This module measures forecast accuracy by replaying history.  Each of a list of historical timestamps is treated as
+'now': the current conditions of every roadway are read from its stored history at that time, analogs are matched
+among the readings up to that time only, and the resulting predictions are scored against the speeds observed
+afterwards, as error, pinball loss, and coverage per horizon and percentile.
+
+Every roadway's history is loaded once, as arrays, along with an index of its readings sorted by traffic state,
+before the replay is split across processes.  Forked workers share these arrays, so thousands of timestamps cost
+one load.  Analogs are matched as GenerateNormalizedPredictions matches them (weather, then traffic percentile,
+then day and time of day, relaxing as it does), and predictions are unnormalized with the same functions."""
+
+import os
+import json
+import time
+import datetime
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import BlueToadAnalysis as BTA
+import MassDotDataTypes as data
+
+REPLAY_COLUMNS = ['insert_time', 'speed', 'day_of_week', 'time_of_day', 'Normalized_t', 'weather', 'norm_traffic_hist', 'weather_hist']
+WEATHER_SEVERITY_FAC, MIN_MATCHES, MIN_WEATHER_KERNEL_SIZE, MIN_TRAFFIC_BT_SIZE = 2.5, 10, 2, 150 #as in GenerateNormalizedPredictions
+
+global replay_pairs
+global replay_settings
+global daytime_masks
+replay_pairs, replay_settings = {}, {} #loaded once in the parent, then shared with every forked worker
+daytime_masks = {} #by time of day, subset, time range, day of week and analysis day
+
+def SlotDatetime(slot):
+	return datetime.datetime.fromordinal(int(slot) / 288) + datetime.timedelta(minutes = 5 * (int(slot) % 288))
+
+def DatetimeSlot(when):
+	return when.toordinal() * 288 + (when.hour * 60 + when.minute) / 5
+
+def LoadReplayPair(D, a, history_dir = None):
+	"""Load the processed history of roadway (a) as arrays, with its readings' absolute slots, (day, slot) keys,
+	dense grids of observed speeds and of normalized speeds by slot (see HistoryGrid), and the order of its readings by
+	traffic state.  Returns None if the
+	roadway was not built."""
+	history_dir = os.path.join(D['update_path'], "IndividualFiles") if history_dir is None else history_dir
+	history_path = os.path.join(history_dir, D['bt_name'] + "_" + str(a) + "_CNW_TrafficHist_WeatherHist.csv")
+	if not os.path.exists(history_path):
+		return None
+	sub_bt = data.ReadPairFile(history_path, usecols = REPLAY_COLUMNS)
+	slots = data.DaySlots(sub_bt.insert_time.values)
+	traffic = sub_bt.norm_traffic_hist.values #compared in the stored dtype, as the pandas filters compare them
+	observed = np.empty(slots[-1] - slots[0] + 1); observed.fill(np.nan)
+	observed[slots - slots[0]] = sub_bt.speed.values
+	non_nan = np.flatnonzero(~np.isnan(traffic))
+	return {'slots' : slots, 'first_slot' : slots[0], 'observed' : observed,
+			'daytime_keys' : np.asarray(sub_bt.day_of_week.values, dtype = int) * 288 + data.TimeSlots(sub_bt.time_of_day.values),
+			'weather_hist' : sub_bt.weather_hist.values, 'traffic' : traffic,
+			'traffic_order' : np.concatenate([non_nan[np.argsort(traffic[non_nan], kind = 'quicksort')], np.flatnonzero(np.isnan(traffic))]),
+			'grid' : data.HistoryGrid(slots, sub_bt.Normalized_t.values), 'speed' : np.asarray(sub_bt.speed.values, dtype = np.float64),
+			'strata' : BTA.AnalogStrata(sub_bt)}
+
+def DaytimeMask(current_datetime, subset, time_range, day_of_week, analysis_day = -1):
+	"""A boolean lookup over (day_of_week * 288 + five-minute slot) keys of the days and times GetSub_Times_and_Days
+	accepts.  These depend on the date only through its day of the week, so each is built once per process."""
+	mask_key = (DatetimeSlot(current_datetime) % 288, subset, time_range, day_of_week, analysis_day)
+	if mask_key not in daytime_masks:
+		daytime_masks[mask_key] = BuildDaytimeMask(current_datetime, subset, time_range, day_of_week, analysis_day)
+	return daytime_masks[mask_key]
+
+def BuildDaytimeMask(current_datetime, subset, time_range, day_of_week, analysis_day):
+	current_time, shifted_daytimes = BTA.AcceptableDaytimes(current_datetime, subset, "", time_range, day_of_week, analysis_day)
+	mask = np.zeros(7 * 288, dtype = bool)
+	viable_days = [analysis_day] if analysis_day >= 0 else ([5,6] if 'S' in subset else [0,1,2,3,4])
+	current_slot = data.TimeSlots([current_time])[0]
+	for d in viable_days:
+		mask[d * 288 + current_slot] = True
+	for new_day_of_week, new_time in shifted_daytimes:
+		mask[new_day_of_week * 288 + data.TimeSlots([new_time])[0]] = True
+	return mask
+
+def TrafficWindow(ordered, traffic, current_traffic, pct_range):
+	"""The readings GetSub_Traffic keeps: those within (pct_range) of the current traffic state's percentile, from
+	the (ordered) candidate readings already sorted by (traffic) state."""
+	L = len(ordered)
+	ordered_traffic = traffic[ordered]
+	if current_traffic >= np.nanmax(ordered_traffic):
+		start_greater = .999*L
+	else:
+		start_greater = np.min((ordered_traffic > current_traffic).nonzero()[0])
+	percentile = start_greater * 1.0 / L
+	percentile_range = (max(percentile - pct_range, 0), min(percentile + pct_range,1))
+	return ordered[int(percentile_range[0] * L):int(percentile_range[1] * L - 1)]
+
+def MatchAnalogs(pair, end, conditions, current_datetime, subset, day_of_week, D):
+	"""Return the indices of the analogs of the current (conditions) among the first (end) readings of (pair), as
+	GenerateNormalizedPredictions would select them from a history ending at (current_datetime), or None if there
+	are too few."""
+	weather_factor = max(int(conditions[1]/WEATHER_SEVERITY_FAC),1)
+	candidates = np.zeros(len(pair['slots']), dtype = bool); candidates[:end] = True
+	if 'W' in subset:
+		weather_kernel_size = max(conditions[1] * D['weather_kernel_pct'], MIN_WEATHER_KERNEL_SIZE)
+		candidates[:end] = np.logical_and(pair['weather_hist'][:end] <= conditions[1] + weather_kernel_size,
+										  pair['weather_hist'][:end] >= conditions[1] - weather_kernel_size)
+	ordered = pair['traffic_order'][candidates[pair['traffic_order']]] #the candidates, sorted by traffic state
+	if len(ordered) == 0:
+		return None
+	if 'T' in subset:
+		analogs = TrafficWindow(ordered, pair['traffic'], conditions[0], D['pct_range'])
+		if len(analogs) < MIN_TRAFFIC_BT_SIZE:
+			analogs = TrafficWindow(ordered, pair['traffic'], conditions[0], D['pct_range'] * 2)
+	else:
+		analogs = ordered
+	keys = pair['daytime_keys'][analogs]
+	if 'Y' in subset or 'S' in subset or any([d in subset for d in '0123456']):
+		analysis_day = -1 if ('Y' in subset or 'S' in subset) else int(subset[-1])
+		matches = analogs[DaytimeMask(current_datetime, subset, D['time_range'] * weather_factor, day_of_week, analysis_day)[keys]]
+		if len(matches) < MIN_MATCHES: #relax as RelaxRequirements_GetMatches does
+			relaxed = subset.replace('O','S') if subset[-1] in ['5','6'] else subset.replace('O','Y')
+			for widen in [1, 2, 4, 8]:
+				matches = analogs[DaytimeMask(current_datetime, relaxed, D['time_range'] * widen * weather_factor, day_of_week)[keys]]
+				if len(matches) > MIN_MATCHES:
+					break
+			if len(matches) < MIN_MATCHES:
+				return None
+	else:
+		matches = analogs
+	return matches if len(matches) > MIN_MATCHES else None
+
+def ReplayNormalized(a, slot, subset, D):
+	"""Match the analogs of roadway (a) at the absolute five-minute (slot), using only readings up to then, and return
+	the normalized percentiles with what unnormalizing and scoring them needs, or None if no prediction could be made."""
+	pair = replay_pairs[a]
+	end = np.searchsorted(pair['slots'], slot, side = 'right')
+	if end == 0 or pair['slots'][end - 1] != slot: #no reading at this time, so no current conditions
+		return None
+	conditions = [float(pair['traffic'][end - 1]), float(pair['weather_hist'][end - 1]), float(pair['speed'][end - 1])]
+	if np.isnan(conditions[0]) or np.isnan(conditions[2]):
+		return None
+	current_datetime = SlotDatetime(slot)
+	day_of_week = current_datetime.weekday()
+	subset = subset + str(day_of_week) if 'O' in subset else subset
+	analogs = MatchAnalogs(pair, end, conditions, current_datetime, subset, day_of_week, D)
+	if analogs is None:
+		return None
+	if D['analog_cap'] > 0 and len(analogs) > D['analog_cap']: #as a capped run samples them
+		analogs = analogs[BTA.StratifiedSample(pair['strata'][analogs], D['analog_cap'], D['analog_seed'])]
+	grid = {'values' : pair['grid']['values'][:slot - pair['grid']['first_slot'] + 1], 'positions' : pair['grid']['positions']} #nothing after now
+	horizon = BTA.HorizonMatrix(grid, analogs, replay_settings['pred_len'])
+	if np.isnan(horizon).all():
+		return None
+	std_seq = BTA.GetStandardSequences(str(a), day_of_week, current_datetime, replay_settings['DiurnalDic'], replay_settings['pred_len'])
+	if len(std_seq) == 0:
+		return None
+	start = slot + 1 - pair['first_slot'] #the prediction i steps ahead is for 5(i + 1) minutes after now
+	return {'norm_pcts' : BTA.HorizonPercentiles(horizon, D['pct_tile_list']), 'std_seq' : std_seq, 'current_speed' : conditions[2],
+			'observed' : pair['observed'][start:start + replay_settings['pred_len']]}
+
+def ReplayUnNormalized(a, normalized, D):
+	"""Unnormalize the (normalized) replay of roadway (a), as UnNormalizePredictions would, returning speeds by percentile."""
+	max_speed = replay_settings['MaximumDic'].get(str(a), D['max_speed'])
+	speeds = dict((p, BTA.UnNormalizeSequence(normalized['norm_pcts'][p], normalized['std_seq']['50'], max_speed, normalized['current_speed'],
+											  D['steps_to_smooth'], D['steps_to_diurnal_return'])) for p in normalized['norm_pcts'])
+	speeds.update(BTA.SpreadPercentiles(speeds, normalized['std_seq'], D['min_spread_fac'], D['steps_to_smooth']))
+	return speeds
+
+def ReplayPrediction(a, slot, subset, D):
+	"""Predict the speeds of roadway (a) at the absolute five-minute (slot), returning them by percentile with the
+	speeds observed afterwards, or None if no prediction could be made."""
+	normalized = ReplayNormalized(a, slot, subset, D)
+	if normalized is None:
+		return None
+	return ReplayUnNormalized(a, normalized, D), normalized['observed']
+
+def EmptyScores(pcts, pred_len):
+	scores = {'predictions' : 0, 'skipped' : 0}
+	for p in pcts:
+		for name in ['count', 'abs_error', 'error', 'pinball', 'below']:
+			scores[p + '_' + name] = np.zeros(pred_len)
+	return scores
+
+def ScorePrediction(scores, speeds, observed, pcts):
+	"""Add the errors of one roadway's predicted (speeds), by percentile, against the (observed) speeds to (scores)."""
+	for p in pcts:
+		k = min(len(speeds[p]), len(observed))
+		predicted, seen = np.asarray(speeds[p][:k], dtype = float), observed[:k]
+		valid = ~np.isnan(seen)
+		error = np.where(valid, seen - predicted, 0)
+		scores[p + '_count'][:k] += valid
+		scores[p + '_abs_error'][:k] += np.abs(error)
+		scores[p + '_error'][:k] += error
+		below = np.zeros(k, dtype = bool)
+		below[valid] = seen[valid] <= predicted[valid] #gaps are not compared, which would warn of the NaN
+		scores[p + '_below'][:k] += below
+		if p not in ['min', 'max']: #the quantile (pinball) loss of the p-th percentile
+			q = float(p) / 100
+			scores[p + '_pinball'][:k] += np.where(error >= 0, q * error, (q - 1) * error)
+	return scores
+
+def ReplaySlots(task):
+	"""Replay every pair at each of the task's slots, for each of its parameter points, returning the summed scores
+	of each point.  The points differ only in how predictions are unnormalized, so analogs are matched once, with the
+	first point's parameters, and unnormalized for each.  Run in a worker process."""
+	points, slots = task
+	pcts = replay_settings['pcts']
+	point_Ds = [dict(replay_settings['D'], **point) for point in points]
+	all_scores = [EmptyScores(pcts, replay_settings['pred_len']) for point in points]
+	for slot in slots:
+		for a in replay_pairs:
+			normalized = ReplayNormalized(a, slot, replay_settings['subset'], point_Ds[0])
+			for point_D, scores in zip(point_Ds, all_scores):
+				if normalized is None:
+					scores['skipped'] += 1
+				else:
+					scores['predictions'] += 1
+					ScorePrediction(scores, ReplayUnNormalized(a, normalized, point_D), normalized['observed'], pcts)
+	return all_scores
+
+def MergeScores(all_scores):
+	merged = all_scores[0]
+	for scores in all_scores[1:]:
+		for name in scores:
+			merged[name] = merged[name] + scores[name]
+	return merged
+
+def Ratio(numerator, denominator):
+	return np.where(denominator > 0, numerator / np.maximum(denominator, 1), np.nan)
+
+def Listed(values):
+	return [None if np.isnan(v) else round(float(v), 4) for v in values]
+
+def Report(scores, pcts, pred_len, timestamps):
+	"""Summarize the summed (scores) per horizon and percentile: mean absolute error, mean error (observed minus
+	predicted), pinball loss, and coverage (the fraction of observations at or below the predicted percentile)."""
+	report = {'timestamps' : timestamps, 'predictions' : scores['predictions'], 'skipped' : scores['skipped'],
+			  'horizon_minutes' : [5 * (i + 1) for i in xrange(pred_len)], 'percentiles' : {}, 'intervals' : {}}
+	for p in pcts:
+		count = scores[p + '_count']
+		report['percentiles'][p] = {'mae' : Listed(Ratio(scores[p + '_abs_error'], count)), 'bias' : Listed(Ratio(scores[p + '_error'], count)),
+									'coverage' : Listed(Ratio(scores[p + '_below'], count)),
+									'overall' : {'mae' : Listed([Ratio(np.sum(scores[p + '_abs_error']), np.sum(count))])[0],
+												 'coverage' : Listed([Ratio(np.sum(scores[p + '_below']), np.sum(count))])[0]}}
+		if p not in ['min', 'max']:
+			report['percentiles'][p]['pinball'] = Listed(Ratio(scores[p + '_pinball'], count))
+			report['percentiles'][p]['expected_coverage'] = float(p) / 100
+	numeric = sorted([int(p) for p in pcts if p not in ['min', 'max']])
+	for low, high in zip(numeric, numeric[::-1]): #central intervals, e.g. 10-90 and 25-75
+		if low < high:
+			count = scores[str(low) + '_count']
+			inside = scores[str(high) + '_below'] - scores[str(low) + '_below']
+			report['intervals']['%d-%d' % (low, high)] = {'coverage' : Listed(Ratio(inside, count)), 'expected' : (high - low) / 100.0}
+	return report
+
+def TimestampSlots(start, end, every, timestamp_file = None):
+	"""The absolute slots of every (every)-minute step from the (start) to the (end) datetime, or of the ISO datetimes
+	listed one per line in (timestamp_file), each rounded down to the five-minute grid."""
+	if timestamp_file is not None:
+		return [DatetimeSlot(datetime.datetime.strptime(line.strip()[:16], "%Y-%m-%dT%H:%M")) for line in open(timestamp_file) if line.strip()]
+	return range(DatetimeSlot(start), DatetimeSlot(end) + 1, max(every / 5, 1))
+
+def LoadReplay(D, all_pair_ids, subset, pred_len, history_dir = None):
+	"""Load every pair's history, from (history_dir) if given rather than the IndividualFiles directory, along with
+	the diurnal cycles and maximum speeds, to be shared by every replay that follows."""
+	replay_settings.update({'D' : D, 'subset' : subset, 'pred_len' : pred_len, 'pcts' : [str(p) for p in D['pct_tile_list']],
+							'DiurnalDic' : BTA.GetJSON(D['update_path'], 'DiurnalDictionary.txt'),
+							'MaximumDic' : BTA.GetJSON(D['update_path'], 'MaximumDic.txt')})
+	replay_pairs.clear(); daytime_masks.clear()
+	for a in all_pair_ids.pair_id:
+		pair = LoadReplayPair(D, a, history_dir)
+		if pair is not None:
+			replay_pairs[a] = pair
+	return replay_pairs
+
+def Replay(point_groups, slots, processes):
+	"""Replay (slots) for every group of parameter points in (point_groups), across (processes) workers, returning
+	the summed scores of each group's points.  Points in a group must share every parameter used in matching."""
+	chunks = [slots[i::processes * 4] for i in xrange(processes * 4) if len(slots[i::processes * 4]) > 0]
+	tasks = [(points, chunk) for points in point_groups for chunk in chunks]
+	if processes > 1:
+		pool = multiprocessing.Pool(processes) #forked after loading, so every worker shares the loaded pairs
+		results = pool.map(ReplaySlots, tasks, chunksize = 1)
+		pool.close(); pool.join()
+	else:
+		results = map(ReplaySlots, tasks)
+	group_scores = []
+	for g in xrange(len(point_groups)):
+		group_results = results[g * len(chunks):(g + 1) * len(chunks)]
+		group_scores.append([MergeScores([r[k] for r in group_results]) for k in xrange(len(point_groups[g]))])
+	return group_scores
+
+def RunBacktest(D, all_pair_ids, slots, subset, pred_len, processes):
+	"""Load every pair once, replay (slots) across (processes) workers, and return the report."""
+	LoadReplay(D, all_pair_ids, subset, pred_len)
+	print "Replaying %d timestamps over %d pairs with %d processes" % (len(slots), len(replay_pairs), processes)
+	scores = Replay([[{}]], slots, processes)[0][0]
+	return Report(scores, replay_settings['pcts'], pred_len, len(slots))
+
+if __name__ == "__main__":
+	D = BTA.HardCodedParameters()
+	environment_vars = BTA.GetJSON("","config.json") if os.path.exists("config.json") else {}
+	for key in environment_vars:
+		D[key] = environment_vars[key]
+	parser = argparse.ArgumentParser()
+	parser.add_argument("start", help = "first timestamp replayed, as YYYY-MM-DDTHH:MM")
+	parser.add_argument("end", help = "last timestamp replayed, as YYYY-MM-DDTHH:MM")
+	parser.add_argument("-e", "--every", help = "minutes between replayed timestamps, default of 60", type = int, default = 60)
+	parser.add_argument("-f", "--timestamps", help = "file listing the timestamps to replay, one YYYY-MM-DDTHH:MM per line, instead of start/end/every", type = str, default = None)
+	parser.add_argument("-s", "--subset", help = "analog subset, as in BlueToadAnalysis ('W' weather, 'T' traffic, 'O' same day, 'Y' weekday, 'S' weekend...)", type = str, default = 'WTO')
+	parser.add_argument("-l", "--length", help = "horizon scored, in five-minute increments, default of 288 (one day)", type = int, default = 288)
+	parser.add_argument("-j", "--jobs", help = "worker processes, default of one per core", type = int, default = multiprocessing.cpu_count())
+	parser.add_argument("-o", "--output", help = "file to which the JSON report is written", type = str, default = "backtest_results.json")
+	args = parser.parse_args()
+
+	start_time = time.time()
+	slots = TimestampSlots(datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M"), datetime.datetime.strptime(args.end, "%Y-%m-%dT%H:%M"),
+						   args.every, args.timestamps)
+	all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
+	report = RunBacktest(D, all_pair_ids, slots, args.subset, args.length, max(args.jobs, 1))
+	report['seconds'] = round(time.time() - start_time, 2)
+	with open(args.output, 'wb') as outfile:
+		json.dump(report, outfile, indent = 1)
+	print "Replayed %d predictions (%d skipped) in %.1f s; results written to %s" % (report['predictions'], report['skipped'], report['seconds'], args.output)
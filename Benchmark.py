@@ -0,0 +1,152 @@
+"""This module benchmarks the prediction pipeline, stage by stage, on synthetic inputs from SyntheticData.  Each stage
+is timed separately, its peak resident memory is sampled while it runs, and its throughput is reported in rows per
+second.  Results are written as a JSON so that releases can be compared on the same hardware, entirely offline."""
+
+import os
+import time
+import json
+import shutil
+import platform
+import argparse
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+import BlueToadAnalysis as BTA
+import MassDotDataTypes as data
+import ParseRealTimeMassDot as mass
+import SyntheticData as synthetic
+import RunMetrics as metrics
+
+class MemorySampler(threading.Thread):
+	"""Poll the resident set size of this process while a stage runs, keeping the peak."""
+	def __init__(self, interval = 0.01):
+		threading.Thread.__init__(self)
+		self.daemon, self.interval, self.peak, self.running = True, interval, metrics.CurrentRSS(), True
+
+	def run(self):
+		while self.running:
+			self.peak = max(self.peak, metrics.CurrentRSS())
+			time.sleep(self.interval)
+
+	def stop(self):
+		self.running = False
+		self.join()
+		return max(self.peak, metrics.CurrentRSS())
+
+def MeasureStage(results, stage, function, args, rows):
+	"""Run (function)(*args) as the named (stage), appending its wall time, peak memory, and throughput over
+	(rows), which may be a number or a function of the stage's result, to (results).  Returns the stage's result."""
+	sampler = MemorySampler(); sampler.start()
+	start = time.time()
+	result = function(*args)
+	wall_seconds = time.time() - start
+	peak_rss_mb = sampler.stop()
+	rows = rows(result) if callable(rows) else rows
+	results.append({'stage' : stage, 'wall_seconds' : round(wall_seconds, 4), 'peak_rss_mb' : round(peak_rss_mb, 1),
+					'rows' : rows, 'rows_per_second' : round(rows / wall_seconds, 1) if wall_seconds > 0 else None})
+	print "%-32s %9.3f s %9.1f MB %12.1f rows/s" % (stage, wall_seconds, peak_rss_mb, results[-1]['rows_per_second'] or 0)
+	return result
+
+def PairFile(D, a, suffix):
+	return os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + suffix)
+
+def CleanAll(D, pair_ids):
+	return sum([len(BTA.SubBt_Cleaned_to_PreNormalized(D, a)) for a in pair_ids])
+
+def DiurnalAll(D, pair_ids):
+	DiurnalDic = {}
+	for a in pair_ids:
+		DiurnalDic.update(BTA.GenerateDiurnalDic(data.ReadPairFile(PairFile(D, a, "_Cleaned.csv")), D['update_path'],
+												 BTA.five_minute_fractions, D['pct_tile_list'], D['window']))
+	return DiurnalDic
+
+def NormalizeAll(D, pair_ids, DiurnalDic):
+	return sum([len(BTA.NormalizeTravelTime(data.ReadPairFile(PairFile(D, a, "_Cleaned.csv")), DiurnalDic,
+											os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a))) for a in pair_ids])
+
+def WeatherAll(D, pair_ids):
+	return sum([len(BTA.AttachWeatherData(data.ReadPairFile(PairFile(D, a, "_Cleaned_Normalized.csv")), os.path.join(D['update_path'], "IndividualFiles"),
+										  D['bt_name'] + "_" + str(a), D['weather_dir'], D['weather_site_default'])) for a in pair_ids])
+
+def HistoryAll(D, pair_ids, weights):
+	rows = 0
+	for a in pair_ids:
+		sub_bt = BTA.AttachTrafficHistory(data.ReadPairFile(PairFile(D, a, "_Cleaned_Normalized_Weather.csv")),
+										  os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a), D, weights)
+		rows += len(BTA.AttachWeatherHistory(sub_bt, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a), D, weights))
+	return rows
+
+def CurrentConditions(D, pair_ids, steps_before_end):
+	"""Treat the row (steps_before_end) from the end of the first pair's history as 'now', and read each pair's
+	traffic state, weather state, and speed at that time, as GetCurrentInfo and RealTimeWeather would provide."""
+	ps_and_cs, now_time = {}, None
+	for a in pair_ids:
+		sub_bt = data.ReadPairFile(PairFile(D, a, "_CNW_TrafficHist_WeatherHist.csv"))
+		if now_time is None:
+			now_time = sub_bt.insert_time.iloc[max(0, len(sub_bt) - steps_before_end)]
+		row = sub_bt[sub_bt.insert_time <= now_time].iloc[-1]
+		ps_and_cs[str(a)] = [row['norm_traffic_hist'], row['weather_hist'], row['speed']]
+	return ps_and_cs, now_time
+
+def GitRevision():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+	except Exception:
+		return None
+
+def RunBenchmark(D, n_pairs, months, gap_rate, weather_mix, seed, pred_len):
+	"""Generate a synthetic dataset under D's paths, then time each stage of a cold build and a prediction run."""
+	results = []
+	dataset = synthetic.GenerateDataset(D, n_pairs, months, gap_rate, weather_mix, seed)
+	pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv")).pair_id
+	weights = list(pd.read_csv(os.path.join(D['data_path'], 'DecaySeries.csv')).Weight)
+	print "Generated %d rows for %d pairs over %d months" % (dataset['rows'], n_pairs, months)
+	MeasureStage(results, "GetBlueToad", data.GetBlueToad, [D, D['bt_name']], dataset['rows'])
+	cleaned_rows = MeasureStage(results, "clean", CleanAll, [D, pair_ids], lambda r: r)
+	DiurnalDic = MeasureStage(results, "diurnal_build", DiurnalAll, [D, pair_ids], cleaned_rows)
+	MeasureStage(results, "normalization", NormalizeAll, [D, pair_ids, DiurnalDic], lambda r: r)
+	MeasureStage(results, "weather_attach", WeatherAll, [D, pair_ids], lambda r: r)
+	MeasureStage(results, "history_features", HistoryAll, [D, pair_ids, weights], lambda r: r)
+	ps_and_cs, now_time = CurrentConditions(D, pair_ids, 288 + pred_len)
+	current_datetime, day_of_week = mass.YYYYDOY_to_Datetime(now_time), BTA.GetDayOfWeek(int(now_time))
+	subset = 'WTO' + str(day_of_week)
+	all_pair_ids = pd.DataFrame({'pair_id' : pair_ids})
+	PredictionDic = MeasureStage(results, "GenerateNormalizedPredictions", BTA.GenerateNormalizedPredictions,
+								 [all_pair_ids, ps_and_cs, D['weather_fac_dic'], day_of_week, current_datetime, D['pct_range'], D['time_range'],
+								  D['update_path'], D['bt_name'], D['pct_tile_list'], subset, pred_len, "", D['weather_kernel_pct'], 0, 9999999],
+								 cleaned_rows)
+	MaximumDic = dict((str(a), float(np.max(data.ReadPairFile(PairFile(D, a, "_Cleaned.csv")).speed))) for a in pair_ids)
+	CurrentPredDic = MeasureStage(results, "UnNormalizePredictions", BTA.UnNormalizePredictions,
+								  [PredictionDic, DiurnalDic, MaximumDic, day_of_week, current_datetime, pred_len, "", D['max_speed'],
+								   ps_and_cs, D['steps_to_smooth'], D['steps_to_diurnal_return'], D['min_spread_fac']],
+								  len(pair_ids) * pred_len * len(D['pct_tile_list']))
+	MeasureStage(results, "output_writing", BTA.WriteJSON, [CurrentPredDic, D['update_path'], "benchmark_predictions.json"],
+				 len(pair_ids) * pred_len * len(D['pct_tile_list']))
+	return {'dataset' : dataset, 'prediction_length' : pred_len, 'stages' : results,
+			'total_wall_seconds' : round(sum([r['wall_seconds'] for r in results]), 4),
+			'environment' : {'python' : platform.python_version(), 'numpy' : np.__version__, 'pandas' : pd.__version__,
+							 'platform' : platform.platform(), 'processor' : platform.processor(), 'git_revision' : GitRevision(),
+							 'timestamp' : time.strftime("%Y-%m-%dT%H:%M:%S")}}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-p", "--pairs", help = "number of synthetic pair_ids", type = int, default = 10)
+	parser.add_argument("-m", "--months", help = "months of five-minute history per pair", type = int, default = 1)
+	parser.add_argument("-g", "--gap_rate", help = "fraction of five-minute readings that are missing or '\\N'", type = float, default = 0.02)
+	parser.add_argument("-w", "--weather_mix", help = "weather fractions, e.g. ' :0.8,RA:0.12,FG:0.05,SN:0.03'", type = str,
+						default = ' :0.8,RA:0.12,FG:0.05,SN:0.03')
+	parser.add_argument("-s", "--seed", help = "random seed for the synthetic data", type = int, default = 0)
+	parser.add_argument("-l", "--length", help = "prediction length, in five-minute increments", type = int, default = 288)
+	parser.add_argument("-d", "--workdir", help = "directory in which the synthetic tree is built (emptied first)", type = str, default = "benchmark_run")
+	parser.add_argument("-c", "--memory_ceiling", help = "memory ceiling in MB for the archive split (0 for none)", type = int, default = 0)
+	parser.add_argument("-o", "--output", help = "file to which the JSON results are written", type = str, default = "benchmark_results.json")
+	args = parser.parse_args()
+
+	if os.path.exists(args.workdir): shutil.rmtree(args.workdir)
+	D = synthetic.PointAt(BTA.HardCodedParameters(), args.workdir)
+	D['memory_ceiling_mb'] = args.memory_ceiling
+	report = RunBenchmark(D, args.pairs, args.months, args.gap_rate, synthetic.ParseWeatherMix(args.weather_mix), args.seed, args.length)
+	with open(args.output, 'wb') as outfile:
+		json.dump(report, outfile, indent = 1)
+	print "Results written to %s" % args.output
@@ -4,18 +4,24 @@ import ParseRealTimeMassDot as mass
 import os
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import MassDotDataTypes as data
 import datetime
 import json
 import NCDC_WeatherProcessor as NCDC
 import math
-import zipfile as Z
 import sys
 import argparse
-from urllib2 import urlopen, URLError, HTTPError
+import SpatialIndex as spatial
+import RunMetrics as metrics
+import ModelBundle as bundle
+import PairStatistics as stats
+import time
+import BuildLocks as locks
 
 global five_minute_fractions
 five_minute_fractions = [round(float(f)/288,3) for f in range(288)]
+WEATHER_STRATA = [' ', 'RA', 'FG', 'SN'] #the weather categories of weather_cost_facs, each sampled as its own stratum
 
 def AddDayOfWeekColumn(blue_toad, blue_toad_path, blue_toad_name):
 	print "Adding days of the week for site %d" % int(blue_toad.pair_id[0:1])
@@ -30,8 +36,8 @@ def AddDayOfWeekColumn(blue_toad, blue_toad_path, blue_toad_name):
 	for d in days:
 		day_of_week_column.append(GetDayOfWeek(d))
 	blue_toad['day_of_week'] = day_of_week_column
-	blue_toad.to_csv(os.path.join(blue_toad_path, blue_toad_name + "_Cleaned.csv"),
-						index = False)
+	blue_toad = data.CompactFrame(blue_toad)
+	WriteCSVAtomic(blue_toad, os.path.join(blue_toad_path, blue_toad_name + "_Cleaned.csv"))
 	return blue_toad
 
 def GetDayOfWeek(date):
@@ -92,19 +98,21 @@ def MA_Smooth_Circular(sequence, one_dir_window):
 			smoothed_seq.append(round(np.mean(sequence[(ind - one_dir_window):(ind + one_dir_window)]),0))
 	return smoothed_seq
 
-def GenerateDiurnalDic(bt, blue_toad_path, five_minute_fractions, pct_tile_list, window = 12):
+def GenerateDiurnalDic(bt, blue_toad_path, five_minute_fractions, pct_tile_list, window = 12, def_val = None):
 	"""Given a cleaned blue_toad data file, produce a smoothed diurnal cycle for all pair_id,
-	day_of_week combinations...and store in a dictionary for later use..."""
+	day_of_week combinations...and store in a dictionary for later use...  Times with no examples default
+	to (def_val), the mean speed, which is taken from the statistics catalog where the caller has it."""
 	#fractions of a day in 5-min increments
 	five_minute_fractions = [float(d)/24/12 for d in range(24*12)]
 	unique_ids = mass.unique(bt.pair_id)
 	DiurnalDic = {}
+	if def_val is None: def_val = np.mean(bt.speed)
 	for u in unique_ids: #over all unique_ids
 		for day in xrange(7): #over all days_of_the_week
 			print "Building diurnal cycle for roadway %d on day %d (Monday = 0, Sunday = 6)" % (u,day)
 			sub_bt = GetSubBlueToad(bt, u, day)
 			DiurnalDic[str(u) + "_" + str(day)] = DefineDiurnalCycle(sub_bt, day, five_minute_fractions, pct_tile_list,
-														window, np.mean(bt.speed)) #default to mean
+														window, def_val) #default to mean
 	return DiurnalDic
 
 def NormalizeTravelTime(bt, DiurnalDic, blue_toad_path, blue_toad_name):
@@ -121,7 +129,8 @@ def NormalizeTravelTime(bt, DiurnalDic, blue_toad_path, blue_toad_name):
 		bt['Normalized_t'] = normalized_times
 	else:
 		bt['Normalized_t'] = []
-	bt.to_csv(os.path.join(blue_toad_path, blue_toad_name + "_Cleaned" + "_Normalized.csv"), index = False)
+	bt = data.CompactFrame(bt)
+	WriteCSVAtomic(bt, os.path.join(blue_toad_path, blue_toad_name + "_Cleaned" + "_Normalized.csv"))
 	return bt
 
 def AppendWeatherInformation(weather_data, sub_bt):
@@ -171,37 +180,42 @@ def AttachWeatherData(bt, bt_path, bt_name, w_dir, w_site_name):
 		bt = AppendWeatherInformation(weather_data, bt)
 	else:
 		bt['weather'] = []
-	bt.to_csv(os.path.join(bt_path, bt_name + "_Cleaned" + "_Normalized" + "_Weather.csv"), index = False)
+	bt = data.CompactFrame(bt)
+	WriteCSVAtomic(bt, os.path.join(bt_path, bt_name + "_Cleaned" + "_Normalized" + "_Weather.csv"))
 	return bt
 
 def AttachTrafficHistory(sub_bt, bt_path, bt_name, D, weights):
 	traffic_history = []; historical_window = D['traffic_system_memory']
 	if len(sub_bt) > 0:
 		print "Appending traffic history for site %d" % int(sub_bt.pair_id[0:1])
+		normalized_t = sub_bt.Normalized_t.tolist() #slicing a list is far cheaper than slicing the series
 		for i in range(len(sub_bt)):
 			if i == 0:
 				traffic_history.append(0)
 			else:
-				traffic_history.append(CalculateAntecedentTraffic(sub_bt.Normalized_t[max(0,i-historical_window):i][::-1], weights[0:historical_window], historical_window))
+				traffic_history.append(CalculateAntecedentTraffic(normalized_t[max(0,i-historical_window):i][::-1], weights[0:historical_window], historical_window))
 		sub_bt['norm_traffic_hist'] = traffic_history
 	else:
 		sub_bt['norm_traffic_hist'] = []
-	sub_bt.to_csv(os.path.join(bt_path, bt_name + "_CNW_TrafficHist.csv"), index = False)
+	sub_bt = data.CompactFrame(sub_bt)
+	WriteCSVAtomic(sub_bt, os.path.join(bt_path, bt_name + "_CNW_TrafficHist.csv"))
 	return sub_bt
 
 def AttachWeatherHistory(sub_bt, bt_path, bt_name, D, weights):
 	weather_history = []; historical_window = D['traffic_system_memory']
 	if len(sub_bt) > 0:
 		print "Appending weather history for site %d" % int(sub_bt.pair_id[0:1])
+		weather = sub_bt.weather.tolist() #slicing a list is far cheaper than slicing the categorical series
 		for i in range(len(sub_bt)):
 			if i == 0:
 				weather_history.append(0)
 			else:
-				weather_history.append(CalculateAntecedentWeather(sub_bt.weather[max(0,i-historical_window):i][::-1],weights[0:historical_window],D['weather_cost_facs'], historical_window))
+				weather_history.append(CalculateAntecedentWeather(weather[max(0,i-historical_window):i][::-1],weights[0:historical_window],D['weather_cost_facs'], historical_window))
 		sub_bt['weather_hist'] = weather_history
 	else:
 		sub_bt['weather_hist'] = []
-	sub_bt.to_csv(os.path.join(bt_path, bt_name + '_CNW_TrafficHist_WeatherHist.csv'), index = False)
+	sub_bt = data.CompactFrame(sub_bt)
+	WriteCSVAtomic(sub_bt, os.path.join(bt_path, bt_name + '_CNW_TrafficHist_WeatherHist.csv'))
 	return sub_bt
 
 def CalculateAntecedentWeather(weather_history, weights, weather_cost_facs, historical_window):
@@ -273,13 +287,25 @@ def GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
 	For instance, 11:00pm times could include 12:30am as 'similar' examples.  These would be on the
 	following day.  If 'S' in (subset), we will return days 0-4, weekdays, or 5-6, weekends.
 	If (analysis_day) assumes a non-negative value, use this day's data only"""
+	current_time, shifted_daytimes = AcceptableDaytimes(current_datetime, subset, time_of_day, time_range, day_of_week, analysis_day)
+	correct_daytimes, viable_days = GetCorrectDaytimes(traffic_sub_bt, day_of_week, current_time, subset, analysis_day)
+	for new_day_of_week, new_time in shifted_daytimes:
+		correct_daytimes = correct_daytimes.append(traffic_sub_bt[np.logical_and(np.logical_and(traffic_sub_bt.day_of_week == new_day_of_week,
+								  traffic_sub_bt.time_of_day < new_time + .001), traffic_sub_bt.time_of_day > new_time - .001)])
+	return correct_daytimes
+
+def AcceptableDaytimes(current_datetime, subset, time_of_day, time_range, day_of_week, analysis_day = -1):
+	"""Return the time of day matched exactly on every viable day (see GetCorrectDaytimes), and the list of
+	(day_of_week, time_of_day) pairs within (time_range) of it, as GetSub_Times_and_Days considers them."""
 	if time_of_day == "": #if the users have not insisted on a time of day
 		current_time = NCDC.GetTimeFromDateTime(current_datetime) #0-1, three decimal time of day (.875, e.g.)
 	else:
 		current_time, time_range = time_of_day, 0
-	current_day = current_datetime.day #day of the month (allows distinguishing similar times on other days)
-	correct_daytimes, viable_days = GetCorrectDaytimes(traffic_sub_bt, day_of_week, current_time, subset, analysis_day)
-
+	if analysis_day >= 0: #the same days GetCorrectDaytimes matches
+		viable_days = [analysis_day]
+	else:
+		viable_days = [5,6] if 'S' in subset else [0,1,2,3,4]
+	shifted_daytimes = []
 	time_shifts = GetAcceptableTimeRanges(time_range)
 	if len(time_shifts) > 0: #if time_range allows for other times to be considered
 		for d in viable_days: #checking each day, even if there is only one...
@@ -291,9 +317,8 @@ def GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
 				new_time = NCDC.GetTimeFromDateTime(new_datetime)
 				shift_day_of_week = LinDayOfWeekShift(day_of_week, shift)
 				new_day_of_week = AdjustDayOfWeek(testing_datetime.day, new_day, shift_day_of_week) #did we move into a new day?
-				correct_daytimes = correct_daytimes.append(traffic_sub_bt[np.logical_and(np.logical_and(traffic_sub_bt.day_of_week == new_day_of_week,
-										  traffic_sub_bt.time_of_day < new_time + .001), traffic_sub_bt.time_of_day > new_time - .001)])
-	return correct_daytimes
+				shifted_daytimes.append((new_day_of_week, new_time))
+	return current_time, shifted_daytimes
 
 def LinDayOfWeekShift(day_of_week, shift):
 	"""Given a (day_of_week), numbered 0-6, and a shift, -2, +3, e.g., return the new day of week."""
@@ -321,6 +346,7 @@ def	AddEmptyDic(a, pcts, PredictionDic):
 	"""For a given roadway (a), a list of percentages to consider (pcts), and a (PredictionDic),
 	fill each index with empty lists..."""
 	print "Insufficient data for site %d" % a
+	metrics.Count(a, 'empty_predictions')
 	for p in pcts:				#we cannot expand the dataset...and so we should return an empty list.
 		PredictionDic[str(a)][str(p)] = []
 	return PredictionDic
@@ -332,11 +358,13 @@ def NoPrediction(all_pair_ids, D):
 	for a in all_pair_ids.pair_id:
 		print 'Reporting times (without prediction) for roadway %d' % a
 		ReportDictionary[str(a)] = {'speed' : [], 'insert_time' : []}
-		sub_bt = pd.read_csv(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) +
-								"_" + "Cleaned_Normalized_Weather.csv")).fillna(' ')
+		weather_path = os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_" + "Cleaned_Normalized_Weather.csv")
+		if not os.path.exists(weather_path): #skipped in the build for too little data
+			continue
+		sub_bt = data.ReadPairFile(weather_path, usecols = ['insert_time', 'speed'])
 		sub_bt = sub_bt[np.logical_and(sub_bt.insert_time >= D['start_date'], sub_bt.insert_time <= D['end_date'])]
 		for i,t in zip(sub_bt.insert_time, sub_bt.speed):
-			if type(t) == str: #missing time...
+			if np.isnan(t): #missing time...
 				ReportDictionary[str(a)]['speed'].append('null')
 			else:
 				ReportDictionary[str(a)]['speed'].append(min(float(t), D['max_speed']))
@@ -347,86 +375,240 @@ def NoPrediction(all_pair_ids, D):
 
 def GenerateNormalizedPredictions(all_pair_ids, ps_and_cs, weather_fac_dic, day_of_week, current_datetime, pct_range,
 								  time_range, bt_path, bt_name, pcts, subset, pred_len, time_of_day, weather_kernel_pct,
-								  start_date, end_date, use_traffic_hist = True):
+								  start_date, end_date, use_traffic_hist = True, horizon_shift = 0, horizon_bands = None,
+								  analog_cap = 0, analog_seed = 0):
 	"""Iterate over all pair_ids and determine similar matches in terms of time_of_day,
 	weather, traffic, and day_of_week...and generate 288 five-minute predictions (a
-	24-hour prediction in 5-minute intervals)"""
+	24-hour prediction in 5-minute intervals).  A negative (horizon_shift) starts the predictions that
+	many five-minute steps before the matched time, as DepartureSweep requires.  (horizon_bands), from
+	HorizonBands, predicts farther steps at a coarser resolution, and (analog_cap), if above 0, bounds the
+	analogs of each pair_id to a stratified sample seeded by (analog_seed)."""
 	traffic_column = 'norm_traffic_hist' if use_traffic_hist else 'Normalized_t'
-	weather_severity_fac, min_matches, min_weather_kernel_size, min_traffic_bt_size = 2.5, 10, 2, 150 #change if needed
-	min_traffic_kernel_size = 50 #change if needed
 
 	PredictionDic = {}
 	for a in all_pair_ids.pair_id: #iterate over each pair_id and generate a string of predictions
-		PredictionDic[str(a)] = {}
-		if str(a) in ps_and_cs.keys(): #if we have access to current conditions at this locations
-			sub_bt = pd.read_csv(os.path.join(bt_path, "IndividualFiles", bt_name + "_" + str(a) +
-								"_" + "CNW_TrafficHist_WeatherHist.csv")).fillna(' ')
+		PredictionDic[str(a)] = {}; pair_start = time.time()
+		history_path = os.path.join(bt_path, "IndividualFiles", bt_name + "_" + str(a) + "_" + "CNW_TrafficHist_WeatherHist.csv")
+		if str(a) in ps_and_cs.keys() and not os.path.exists(history_path): #skipped in the build for too little data
+			PredictionDic = AddEmptyDic(a, pcts, PredictionDic)
+		elif str(a) in ps_and_cs.keys(): #if we have access to current conditions at this locations
+			sub_bt = data.ReadPairFile(history_path)
 			sub_bt = sub_bt[np.logical_and(sub_bt.insert_time >= start_date, sub_bt.insert_time <= end_date)]
 			L = len(sub_bt) #how many examples, and more importantly, when does this end...
+			metrics.Count(a, 'rows_loaded', L)
 			sub_bt.index = range(L) #re-index, starting from zero
-			if 'W' in subset:
-				weather_kernel_size = max(ps_and_cs[str(a)][1] * weather_kernel_pct, min_weather_kernel_size)
-				weather_sub_bt = sub_bt[np.logical_and(sub_bt.weather_hist <= ps_and_cs[str(a)][1] + weather_kernel_size,
-													   sub_bt.weather_hist >= ps_and_cs[str(a)][1] - weather_kernel_size)]
-			else:
-				weather_sub_bt = sub_bt
-			L_w = len(weather_sub_bt)
-			if L_w == 0:
-				print "NO HISTORICAL EXAMPLES OF THIS WEATHER TYPE AT ROADWAY %d." % a
-				PredictionDic = AddEmptyDic(a, pcts, PredictionDic) #Fill with empty lists
-			if 'T' in subset and PredictionDic[str(a)] == {}:
-				traffic_sub_bt = GetSub_Traffic(weather_sub_bt, ps_and_cs[str(a)][0], pct_range, L_w, traffic_column)
-				if len(traffic_sub_bt) < min_traffic_bt_size:
-					traffic_sub_bt = GetSub_Traffic(weather_sub_bt, ps_and_cs[str(a)][0], pct_range * 2, L_w, traffic_column)
-			else:
-				traffic_sub_bt = weather_sub_bt
-			#locate similar days/times, more lax search in less common weather
-			if ('Y' in subset or 'S' in subset) and PredictionDic[str(a)] == {}: #if we need to choose only certain days of the week
-				day_sub_bt	= GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
-								time_range * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week)
-				if len(day_sub_bt) < min_matches: #if our similarity requirements are too stringent
-					day_sub_bt = RelaxRequirements_GetMatches(traffic_sub_bt, current_datetime, subset, time_of_day, time_range,
-								ps_and_cs, a, weather_severity_fac, day_of_week, min_matches)
-					if len(day_sub_bt) < min_matches:
-						PredictionDic = AddEmptyDic(a, pcts, PredictionDic) #Fill with empty lists
-			elif ('0' in subset or '1' in subset or '2' in subset or '3' in subset
-				  or '4' in subset or '5' in subset or '6' in subset) and PredictionDic[str(a)] == {}: #it's a specific day-of-week
-				day_sub_bt = GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
-								time_range * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week, int(subset[-1]))
-				if len(day_sub_bt) < min_matches: #if our similarity requirements are too stringent
-					day_sub_bt = RelaxRequirements_GetMatches(traffic_sub_bt, current_datetime, subset, time_of_day, time_range,
-								ps_and_cs, a, weather_severity_fac, day_of_week, min_matches)
-					if len(day_sub_bt) < min_matches:
-						PredictionDic = AddEmptyDic(a, pcts, PredictionDic) #Fill with empty lists
-			else:
-				day_sub_bt = traffic_sub_bt
-			if len(day_sub_bt) > min_matches:
-				for p in pcts:
-					PredictionDic[str(a)][str(p)] = [] #will predict 5 min, 10 min, ... , 23hrs and 55min, 24 hrs
-								  #######Generate Predictions#####
-				print "Generating Predictions for site %d with a subset of length %d" % (a, len(day_sub_bt))
-				for ind in xrange(pred_len): #for generating of predictions at each forward step
-					viable_future_indices = [day_sub_bt.index[i] + ind + 1 for i in xrange(len(day_sub_bt)) if day_sub_bt.index[i] + ind + 1 < L]
-					prediction_sub = sub_bt.iloc[viable_future_indices]
-					if len(prediction_sub) > 0:
-						for p in pcts: #iterate over the percentiles required for estimation
-							if p == 'min': #if we're estimating a best case
-								PredictionDic[str(a)][str(p)].append(np.min(prediction_sub.Normalized_t))
-							elif p == 'max': #if we're estimating a worst case
-								PredictionDic[str(a)][str(p)].append(np.max(prediction_sub.Normalized_t))
-							else:
-								PredictionDic[str(a)][str(p)].append(np.percentile(prediction_sub.Normalized_t, p))
-					else:
-						for p in pcts:
-							PredictionDic[str(a)][str(p)].append(PredictionDic[str(a)][str(p)][-1])
-			else:
-				print "no predictions generated for %d" % a
+			PredictionDic[str(a)] = PairNormalizedPredictions(a, sub_bt, ps_and_cs, day_of_week, current_datetime, pct_range, time_range,
+															  pcts, subset, pred_len, time_of_day, weather_kernel_pct, traffic_column, horizon_shift,
+															  horizon_bands, analog_cap, analog_seed)
 		else: #use default...essentially dead-average conditions, flagged as -0.00001 rather than zero
-			PredictionDic = DefaultPredictions(a, D, pcts, PredictionDic)
+			PredictionDic = DefaultPredictions(a, None, pcts, PredictionDic, pred_len) #(pred_len) is given, so no parameter dictionary is read
+			metrics.Count(a, 'default_predictions')
+		metrics.SetValue(a, 'prediction_seconds', round(time.time() - pair_start, 4))
 	#with open(os.path.join(bt_path, 'CurrentPredictions.txt'), 'wb') as outfile:
 	#	json.dump(PredictionDic, outfile)
 	return PredictionDic
 
+def PairNormalizedPredictions(a, sub_bt, ps_and_cs, day_of_week, current_datetime, pct_range, time_range, pcts, subset,
+							  pred_len, time_of_day, weather_kernel_pct, traffic_column = 'norm_traffic_hist', horizon_shift = 0,
+							  horizon_bands = None, analog_cap = 0, analog_seed = 0):
+	"""Match the analogs of roadway (a) within its history (sub_bt), indexed from zero, and return its normalized
+	predictions as GenerateNormalizedPredictions does for every pair_id: a list per percentile, empty lists if too
+	few analogs match, or an empty dictionary if exactly the minimum number do.  If more than (analog_cap) match,
+	a stratified sample of that many is used (see SampleAnalogs)."""
+	no_predictions, analog_indices = PairAnalogs(a, sub_bt, ps_and_cs, day_of_week, current_datetime, pct_range, time_range, pcts,
+												 subset, time_of_day, weather_kernel_pct, traffic_column)
+	if analog_indices is None:
+		print "no predictions generated for %d" % a
+		return no_predictions
+	if analog_cap > 0 and len(analog_indices) > analog_cap:
+		analog_indices = SampleAnalogs(a, AnalogStrata(sub_bt.iloc[analog_indices]), analog_indices, analog_cap, analog_seed)
+	print "Generating Predictions for site %d with a subset of length %d" % (a, len(analog_indices))
+	grid = data.HistoryGrid(data.DaySlots(sub_bt.insert_time.values), sub_bt.Normalized_t.values)
+	return AnalogPredictions(a, grid, analog_indices, pcts, pred_len, horizon_shift, horizon_bands)
+
+def AnalogPredictions(a, grid, analog_indices, pcts, pred_len, horizon_shift = 0, horizon_bands = None):
+	"""The (pcts) of roadway (a)'s normalized history, on the HistoryGrid (grid), over the (pred_len) five-minute steps
+	after each of its (analog_indices), or empty lists if none of them has any history after it.  With
+	(horizon_bands), see BandedPredictions."""
+	#will predict 5 min, 10 min, ... , 23hrs and 55min, 24 hrs after each analog (shifted by horizon_shift)
+	if horizon_bands is not None: #coarser steps farther out, and none past the return to the diurnal median
+		return BandedPredictions(a, grid, analog_indices, pcts, pred_len, horizon_shift, horizon_bands)
+	horizon = HorizonMatrix(grid, analog_indices, pred_len, horizon_shift)
+	if np.isnan(horizon).all():
+		return AddEmptyDic(a, pcts, {str(a) : {}})[str(a)] #no analog has any history after it
+	return HorizonPercentiles(horizon, pcts)
+
+def HorizonBands(D):
+	"""The resolution bands of a multi-resolution prediction, [[first step, steps per column], ...], ending with a
+	band of width zero at (steps_to_diurnal_return), past which predictions are the diurnal median whatever the
+	analogs, or None if (D) asks for every step at full resolution."""
+	if D['multi_resolution'] == 0:
+		return None
+	bands = [list(band) for band in D['horizon_bands'] if band[0] < D['steps_to_diurnal_return']]
+	return bands + [[D['steps_to_diurnal_return'], 0]]
+
+def BandedPredictions(a, grid, analog_indices, pcts, pred_len, horizon_shift, horizon_bands):
+	"""As AnalogPredictions, but over the (horizon_bands) of HorizonBands: each band's steps are averaged, per
+	analog, over columns of the band's width, the (pcts) are taken of each column, and the percentiles are
+	interpolated back to every five-minute step.  Steps from the band of width zero on are left at zero, the
+	normalized diurnal median, without reading the analogs' history."""
+	columns, positions = [], []
+	ends = [band[0] for band in horizon_bands[1:]] + [pred_len]
+	for (first, width), end in zip(horizon_bands, ends):
+		end = min(end, pred_len)
+		if width == 0 or first >= end:
+			continue
+		band = HorizonMatrix(grid, analog_indices, end - first, horizon_shift + first) #steps first + 1, ..., end
+		if width > 1:
+			n_columns = (end - first + width - 1) / width
+			band = np.hstack([band, np.nan * np.zeros((band.shape[0], n_columns * width - band.shape[1]))]).reshape(band.shape[0], n_columns, width)
+			counts = np.sum(np.logical_not(np.isnan(band)), axis = 2)
+			band = np.where(counts > 0, np.nansum(band, axis = 2) / np.maximum(counts, 1), np.nan)
+			lengths = np.minimum(width, end - first - width * np.arange(n_columns))
+			positions.extend(first + width * np.arange(n_columns) + (lengths - 1) / 2.0) #the middle step of each column
+		else:
+			positions.extend(first + np.arange(end - first, dtype = float))
+		columns.append(band)
+	analog_steps = min(pred_len, horizon_bands[-1][0])
+	if len(columns) == 0 or np.isnan(np.hstack(columns)).all():
+		return AddEmptyDic(a, pcts, {str(a) : {}})[str(a)] #no analog has any history after it
+	percentiles = HorizonPercentiles(np.hstack(columns), pcts)
+	for p in percentiles.keys():
+		percentiles[p] = np.interp(np.arange(analog_steps), positions, percentiles[p]).tolist() + [0.0] * (pred_len - analog_steps)
+	return percentiles
+
+def PairAnalogs(a, sub_bt, ps_and_cs, day_of_week, current_datetime, pct_range, time_range, pcts, subset, time_of_day,
+				weather_kernel_pct, traffic_column = 'norm_traffic_hist'):
+	"""Match the analogs of roadway (a) within its history (sub_bt).  Returns the predictions to report if too few
+	match (see PairNormalizedPredictions) and None, or an empty dictionary and the index of every analog matched."""
+	weather_severity_fac, min_matches, min_weather_kernel_size, min_traffic_bt_size = 2.5, 10, 2, 150 #change if needed
+	min_traffic_kernel_size = 50 #change if needed
+	PredictionDic = {str(a) : {}}
+	if 'W' in subset:
+		weather_kernel_size = max(ps_and_cs[str(a)][1] * weather_kernel_pct, min_weather_kernel_size)
+		weather_sub_bt = sub_bt[np.logical_and(sub_bt.weather_hist <= ps_and_cs[str(a)][1] + weather_kernel_size,
+											   sub_bt.weather_hist >= ps_and_cs[str(a)][1] - weather_kernel_size)]
+	else:
+		weather_sub_bt = sub_bt
+	L_w = len(weather_sub_bt)
+	if L_w == 0:
+		print "NO HISTORICAL EXAMPLES OF THIS WEATHER TYPE AT ROADWAY %d." % a
+		PredictionDic = AddEmptyDic(a, pcts, PredictionDic) #Fill with empty lists
+	if 'T' in subset and PredictionDic[str(a)] == {}:
+		traffic_sub_bt = GetSub_Traffic(weather_sub_bt, ps_and_cs[str(a)][0], pct_range, L_w, traffic_column)
+		if len(traffic_sub_bt) < min_traffic_bt_size:
+			traffic_sub_bt = GetSub_Traffic(weather_sub_bt, ps_and_cs[str(a)][0], pct_range * 2, L_w, traffic_column)
+	else:
+		traffic_sub_bt = weather_sub_bt
+	#locate similar days/times, more lax search in less common weather
+	if ('Y' in subset or 'S' in subset) and PredictionDic[str(a)] == {}: #if we need to choose only certain days of the week
+		day_sub_bt	= GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
+						time_range * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week)
+		if len(day_sub_bt) < min_matches: #if our similarity requirements are too stringent
+			day_sub_bt = RelaxRequirements_GetMatches(traffic_sub_bt, current_datetime, subset, time_of_day, time_range,
+						ps_and_cs, a, weather_severity_fac, day_of_week, min_matches)
+			if len(day_sub_bt) < min_matches:
+				PredictionDic = AddEmptyDic(a, pcts, PredictionDic) #Fill with empty lists
+	elif ('0' in subset or '1' in subset or '2' in subset or '3' in subset
+		  or '4' in subset or '5' in subset or '6' in subset) and PredictionDic[str(a)] == {}: #it's a specific day-of-week
+		day_sub_bt = GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
+						time_range * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week, int(subset[-1]))
+		if len(day_sub_bt) < min_matches: #if our similarity requirements are too stringent
+			day_sub_bt = RelaxRequirements_GetMatches(traffic_sub_bt, current_datetime, subset, time_of_day, time_range,
+						ps_and_cs, a, weather_severity_fac, day_of_week, min_matches)
+			if len(day_sub_bt) < min_matches:
+				PredictionDic = AddEmptyDic(a, pcts, PredictionDic) #Fill with empty lists
+	else:
+		day_sub_bt = traffic_sub_bt
+	metrics.Count(a, 'analog_matches', len(day_sub_bt))
+	if len(day_sub_bt) > min_matches:
+		return PredictionDic[str(a)], day_sub_bt.index
+	return PredictionDic[str(a)], None
+
+def AnalogStrata(sub_bt):
+	"""The sampling stratum of every reading of (sub_bt): its year, weather category and whether it fell on a
+	weekend, as one integer per reading."""
+	years = np.floor(np.asarray(sub_bt.insert_time.values, dtype = float) / 1000).astype(int)
+	weather = pd.Series(np.asarray(sub_bt.weather.values, dtype = object)).map(dict((w, i) for i, w in enumerate(WEATHER_STRATA)))
+	weather = weather.fillna(len(WEATHER_STRATA)).values.astype(int) #any other category is a stratum of its own
+	return years * 100 + weather * 10 + (np.asarray(sub_bt.day_of_week.values, dtype = int) >= 5)
+
+def StratifiedSample(strata, cap, seed):
+	"""The sorted positions of (cap) of the entries of (strata), drawn without replacement so that each stratum keeps
+	its share of the whole (largest remainders rounding up), chosen at random within a stratum from (seed)."""
+	n = len(strata)
+	if cap <= 0 or n <= cap:
+		return np.arange(n)
+	codes, inverse, counts = np.unique(strata, return_inverse = True, return_counts = True)
+	shares = counts * float(cap) / n
+	quotas = np.floor(shares).astype(int)
+	remainders = np.argsort(-(shares - quotas), kind = 'mergesort')[:cap - quotas.sum()] #ties to the lower stratum code
+	quotas[remainders] += 1
+	order = np.lexsort((np.random.RandomState(seed).rand(n), inverse)) #grouped by stratum, in random order within each
+	rank = np.arange(n) - np.concatenate([[0], np.cumsum(counts)[:-1]])[inverse[order]]
+	return np.sort(order[rank < quotas[inverse[order]]])
+
+def SampleAnalogs(a, strata, analog_indices, analog_cap, analog_seed):
+	"""Bound the (analog_indices) of roadway (a) to a sample of (analog_cap), stratified by the (strata) of those
+	analogs, from AnalogStrata, so that the percentiles keep the mix of years, weather and day types of the full
+	set.  The same matches and (analog_seed) always give the same sample.  The ratio kept is reported as the pair's
+	'analog_sampling_ratio'."""
+	analog_indices = np.asarray(analog_indices)
+	sampled = analog_indices[StratifiedSample(strata, analog_cap, analog_seed)]
+	ratio = len(sampled) / float(len(analog_indices))
+	print "Sampled %d of %d analogs for site %d (ratio %.3f)" % (len(sampled), len(analog_indices), a, ratio)
+	metrics.SetValue(a, 'analog_sampling_ratio', round(ratio, 4))
+	return sampled
+
+def HorizonMatrix(grid, analog_indices, pred_len, horizon_shift = 0):
+	"""Gather the history on the HistoryGrid (grid) 1 + (horizon_shift), ..., (pred_len) + (horizon_shift) five-minute
+	steps after each of the readings (analog_indices) into an array of shape (analogs, pred_len), with NaN where the
+	history has a gap or runs out.  An analog's horizon is one strided read of the grid, a window of (pred_len) slots."""
+	values = grid['values']
+	starts = grid['positions'][np.asarray(analog_indices, dtype = int)] + 1 + horizon_shift
+	horizon = np.empty((len(starts), pred_len)); horizon.fill(np.nan)
+	inside = np.logical_and(starts >= 0, starts + pred_len <= len(values))
+	if inside.any():
+		windows = as_strided(values, shape = (len(values) - pred_len + 1, pred_len), strides = (values.strides[0], values.strides[0]))
+		horizon[inside] = windows[starts[inside]]
+	edges = np.flatnonzero(np.logical_not(inside)) #windows reaching before the first slot or past the last
+	if len(edges) > 0:
+		indices = starts[edges][:, None] + np.arange(pred_len)[None, :]
+		valid = np.logical_and(indices >= 0, indices < len(values))
+		horizon[edges] = np.where(valid, values[np.clip(indices, 0, max(len(values) - 1, 0))], np.nan)
+	return horizon
+
+def HorizonPercentiles(horizon, pcts):
+	"""Given a (horizon) matrix from HorizonMatrix, return each of the (pcts) at every step, as lists keyed by
+	str(pct).  Steps at which no analog has history repeat the previous step's value."""
+	has_data = np.logical_not(np.isnan(horizon).all(axis = 0))
+	fill_from = np.maximum.accumulate(np.where(has_data, np.arange(horizon.shape[1]), -1))
+	fill_from[fill_from < 0] = np.argmax(has_data) #any leading steps without data take the first step with data
+	ordered = np.sort(horizon[:, has_data], axis = 0) #NaNs sort last
+	counts = np.sum(np.logical_not(np.isnan(ordered)), axis = 0)
+	percentiles = {}
+	for p in pcts:
+		if p == 'min': #if we're estimating a best case
+			values = ordered[0]
+		elif p == 'max': #if we're estimating a worst case
+			values = ordered[counts - 1, np.arange(len(counts))]
+		else:
+			values = SortedPercentile(ordered, counts, p)
+		step_values = np.zeros(horizon.shape[1])
+		step_values[has_data] = values
+		percentiles[str(p)] = step_values[fill_from].tolist()
+	return percentiles
+
+def SortedPercentile(ordered, counts, p):
+	"""The (p)th percentile of each column of (ordered), sorted with its (counts) valid values first, interpolated
+	exactly as np.nanpercentile does, but for every column at once rather than one column at a time."""
+	columns = np.arange(len(counts))
+	indices = p / 100. * (counts - 1)
+	below = np.floor(indices).astype(int)
+	above = np.minimum(below + 1, counts - 1)
+	weights_above = indices - below
+	return ordered[below, columns] * (1.0 - weights_above) + ordered[above, columns] * weights_above
+
 def RelaxRequirements_GetMatches(traffic_sub_bt, current_datetime, subset, time_of_day, time_range,
 								ps_and_cs, a, weather_severity_fac, day_of_week, min_matches):
 	###Step 1: convert from a specific day 'e.g. Tuesday' to a more general classification 'e.g. weekday'
@@ -436,31 +618,35 @@ def RelaxRequirements_GetMatches(traffic_sub_bt, current_datetime, subset, time_
 		subset = subset.replace('O','Y')
 	matches = GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
 								time_range * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week)
+	metrics.Count(a, 'relaxation_steps')
 	if len(matches) > min_matches:
 		return matches
 	else:
 		###Step 2: flex the temporal requirements so twice as many matches are plausible.
 		matches = GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
 								time_range * 2 * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week)
+		metrics.Count(a, 'relaxation_steps')
 		if len(matches) > min_matches:
 			return matches
 		else:
 			###Step 3: flex the temporal requirements to once again double matches...
 			matches = GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
 						time_range * 4 * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week)
+			metrics.Count(a, 'relaxation_steps')
 			if len(matches) > min_matches:
 				return matches
 			else:
 				###Step 4: flex the requirements by a factor of two once more
 				matches = GetSub_Times_and_Days(traffic_sub_bt, current_datetime, subset, time_of_day,
 						time_range * 8 * max(int(ps_and_cs[str(a)][1]/weather_severity_fac),1), day_of_week)
+				metrics.Count(a, 'relaxation_steps')
 				return matches
 
-def DefaultPredictions(a, D, pcts, PredictionDic):
+def DefaultPredictions(a, D, pcts, PredictionDic, pred_len = None):
 	"""For a given roadway (a) and parameter dictionary (D), update all percentiles (pct) in (PredictionDict)
-	with default predictions."""
+	with default predictions, (pred_len) long, by default D['pred_duration'].  (D) may be None if (pred_len) is given."""
 	print "No current information available for site %d, using default." % a
-	pred_list = [-0.00001 for i in range(D['pred_duration'])]
+	pred_list = [-0.00001 for i in range(D['pred_duration'] if pred_len is None else pred_len)]
 	for p in pcts: #NOTE, WITHOUT CURRENT INFO, ALL PERCENTILES WILL BE THE SAME (DEFAULT)
 		PredictionDic[str(a)][str(p)] = pred_list
 	return PredictionDic
@@ -498,7 +684,8 @@ def UnNormalizePredictions(PredictionDic, DiurnalDic, MaximumDic, day_of_week, c
 				if len(norm_seq) == 0:
 					UnNormDic[str(road)][str(p)] = []
 				else:
-					UnNormDic[str(road)][str(p)] = [round((min(n + s, max_speed)* float(min(smoother, i+1))/smoother + float(max(0,smoother-i-1))/smoother * float(ps_and_cs[str(road)][2])) * float(steps_to_diurnal_return - i)/steps_to_diurnal_return + float(i)/steps_to_diurnal_return * s, 0) for i, (n,s) in enumerate(zip(norm_seq, std_seq['50']))]
+					UnNormDic[str(road)][str(p)] = UnNormalizeSequence(norm_seq, std_seq['50'], max_speed, ps_and_cs[str(road)][2],
+																	   smoother, steps_to_diurnal_return)
 			if len(PredictionDic[str(road)].keys()) > 0:		
 				print 'SpreadingPercentiles for road %s' % road
 				spread_percentiles = SpreadPercentiles(UnNormDic[str(road)], std_seq, min_spread_fac, smoother)
@@ -509,16 +696,28 @@ def UnNormalizePredictions(PredictionDic, DiurnalDic, MaximumDic, day_of_week, c
 				UnNormDic[str(road)][str(p)] = None							
 	return UnNormDic
 
+def RoundHalfAway(values):
+	"""Round an array to whole numbers, halves away from zero, as the builtin round(value, 0) does."""
+	return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+def UnNormalizeSequence(norm_seq, std_seq, max_speed, current_speed, smoother, steps_to_diurnal_return):
+	"""Add the diurnal median (std_seq) back onto a normalized prediction (norm_seq), capped at (max_speed), easing in
+	from the (current_speed) over (smoother) steps and returning to the diurnal median over (steps_to_diurnal_return)."""
+	k = min(len(norm_seq), len(std_seq))
+	n, s = np.asarray(norm_seq[:k], dtype = float), np.asarray(std_seq[:k], dtype = float)
+	i = np.minimum(np.arange(k, dtype = float), steps_to_diurnal_return) #fully returned from then on
+	eased = np.minimum(n + s, max_speed) * np.minimum(smoother, i + 1) / smoother + np.maximum(0, smoother - i - 1) / smoother * float(current_speed)
+	return RoundHalfAway(eased * (steps_to_diurnal_return - i) / steps_to_diurnal_return + i / steps_to_diurnal_return * s).tolist()
+
 def SpreadPercentiles(roadway_percentiles, std_seq, min_spread_fac, smoother):
 	spread_percentiles = {}
 	for percentile in std_seq.keys():
-		spread_percentiles[percentile] = []
-		for i, (pred_percentile_speed, diurnal_percentile_speed, pred_median_speed, diurnal_median_speed) in enumerate(zip(roadway_percentiles[percentile], std_seq[percentile], roadway_percentiles['50'], std_seq['50'])):
-			min_acceptable_percentile_spread = float(min(i,smoother*2))/(smoother*2) * min_spread_fac * (diurnal_percentile_speed - diurnal_median_speed)
-			if abs(pred_percentile_speed - pred_median_speed) < abs(min_acceptable_percentile_spread):
-				spread_percentiles[percentile].append(round(roadway_percentiles['50'][i] + min_acceptable_percentile_spread,0))
-			else:
-				spread_percentiles[percentile].append(roadway_percentiles[percentile][i])
+		k = min(len(roadway_percentiles[percentile]), len(std_seq[percentile]), len(roadway_percentiles['50']), len(std_seq['50']))
+		pred_percentile, pred_median = np.asarray(roadway_percentiles[percentile][:k], dtype = float), np.asarray(roadway_percentiles['50'][:k], dtype = float)
+		diurnal_spread = np.asarray(std_seq[percentile][:k], dtype = float) - np.asarray(std_seq['50'][:k], dtype = float)
+		min_acceptable_percentile_spread = np.minimum(np.arange(k), smoother*2).astype(float) / (smoother*2) * min_spread_fac * diurnal_spread
+		too_tight = np.abs(pred_percentile - pred_median) < np.abs(min_acceptable_percentile_spread)
+		spread_percentiles[percentile] = np.where(too_tight, RoundHalfAway(pred_median + min_acceptable_percentile_spread), pred_percentile).tolist()
 	return spread_percentiles
 	
 def PctMap(pct_keys):
@@ -592,46 +791,72 @@ def GetJSON(f_path, f_name):
 	json_data = open(os.path.join(f_path, f_name)).read()
 	return json.loads(json_data)
 
-def DefineMaximums(D, all_pair_ids):
+def WriteJSON(obj, f_path, f_name):
+	"""Write (obj) as a JSON named (f_name) at (f_path).  The JSON is written to a temporary file and renamed
+	into place, so a crash mid-write never leaves a truncated file that looks complete."""
+	temp_path = os.path.join(f_path, f_name) + ".tmp" + str(os.getpid())
+	with open(temp_path, 'wb') as outfile:
+		json.dump(obj, outfile)
+	os.rename(temp_path, os.path.join(f_path, f_name))
+	return None
+
+def WriteCSVAtomic(df, file_path):
+	"""Write the data frame (df) to (file_path) without its index, via a temporary file and a rename,
+	so readers see either the previous file or the complete new one."""
+	temp_path = file_path + ".tmp" + str(os.getpid())
+	FormatFloat32(df).to_csv(temp_path, index = False)
+	os.rename(temp_path, file_path)
+	return None
+
+def FormatFloat32(df):
+	"""Return (df) with its float32 columns formatted to seven significant digits, so that they are stored as
+	50.7 rather than 50.7000007629.  Other columns are written as they are."""
+	float32_columns = [c for c in df.columns if df[c].dtype == np.float32]
+	if len(float32_columns) == 0:
+		return df
+	return df.assign(**dict((c, ['' if np.isnan(v) else '%.7g' % v for v in df[c]]) for c in float32_columns))
+
+def DefineMaximums(D, all_pair_ids, write = True):
 	"""To avoid predictions of unrealistically high travel speeds, given a dictionary (D) of parameters,
-	and a list of (all_pair_ids), return the maximum recorded speed from (DiurnalDic)
-	for the given roadway as a limit on predictions."""
+	and a list of (all_pair_ids), return the maximum recorded speed from the statistics catalog
+	for the given roadway as a limit on predictions, also written to MaximumDic.txt if (write)."""
 	MaximumDic = {}
 	for a in all_pair_ids.pair_id:
-		print "Defining maximum travel times for roadway %d" % a
-		processed_file_path = os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" +
-							str(a) + "_" + "Cleaned_Normalized_Weather.csv")
-		if os.path.exists(processed_file_path):
-			site_df = pd.read_csv(processed_file_path)
-			max_time = np.max(site_df.speed)
+		pair_stats = stats.GetPairStats(D, a) #kept up to date as the pair is cleaned and appended to
+		if pair_stats is not None and pair_stats['max_speed'] is not None:
+			max_time = pair_stats['max_speed']
 			if math.isnan(max_time):
 				MaximumDic[str(a)] = 0.001
 			else:
 				MaximumDic[str(a)] = max_time
 		else:
 			MaximumDic[str(a)] = 0.001 #the flag for a missing minimum time (avoids division by 0)
-	with open(os.path.join(D['update_path'], 'MaximumDic.txt'), 'wb') as outfile:
-		json.dump(MaximumDic, outfile)
+	if write:
+		WriteJSON(MaximumDic, D['update_path'], 'MaximumDic.txt')
 	return MaximumDic
 
 
-def GetZip(url, f_type):
-	"""Download a file found at the (url) provided of (f_type) 'csv' or 'zip'."""
-	f_type = '.' + f_type
-	try: # Open the url
-		f = urlopen(url)
+def GetZip(D, url, f_type):
+	"""Download a file found at the (url) provided of (f_type) 'csv' or 'zip' as the BlueToad archive, unless the
+	copy already there is current (see ArchiveDownload).  Return whether the archive was replaced."""
+	import ArchiveDownload as download
+	from urllib2 import URLError, HTTPError
+	dest_path = os.path.join(D['bt_path'], D['bt_name'] + '.' + f_type)
+	try:
 		print "downloading " + url
-		with open(os.path.join(D['bt_path'], "massdot_bluetoad_data" + f_type), "wb") as local_file: # Open our local file for writing
-			local_file.write(f.read())
+		return download.Download(url, dest_path, D['download_timeout'], D['download_retries'], D['archive_sha1'])
 	#handle errors
 	except HTTPError, e:
 		print "HTTP Error:", e.code, url
 	except URLError, e:
 		print "URL Error:", e.reason, url
-	return None
+	except IOError, e: #timed out or failed verification: the copy already there, if any, is kept
+		print "Download Error:", e, url
+	return False
 
 def Unzip(fname, out_path):
 	"""Unzip the file provided (fname), and write to a file in the (out_path) directory."""
+	import zipfile as Z
 	fh = open(os.path.join(out_path,fname + ".zip"), 'rb')
 	z = Z.ZipFile(fh)
 	for name in z.namelist():
@@ -642,13 +867,16 @@ def Unzip(fname, out_path):
 def SubBt_Cleaned_to_PreNormalized(D, a):
 	"""The cleaned bt file must be transformed from its original 'cleaned' format to a form with '/N' examples removed,
 	strings converted to floats, and a day-of-week column added where needed.  Use the parameter dictionary (D) to convert roadway (a)"""
-	sub_bt = pd.read_csv(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned.csv"))
+	sub_bt = data.ReadPairFile(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned.csv"),
+							   data.SPLIT_FILE_DTYPES)
+	raw_rows = len(sub_bt) #before '\N' readings are removed
 	if len(sub_bt) > 0:
 		sub_bt = data.CleanBlueToad(sub_bt, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a)) #remove "/N" examples
 		sub_bt = data.FloatConvert(sub_bt, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a)) #convert strings to float where possible
 		sub_bt = AddDayOfWeekColumn(sub_bt, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a)) #0-Mon, 6-Sun
 	else:
 		sub_bt['time_of_day'], sub_bt['day_of_week'] = [], []
+	stats.WritePairStats(D, a, stats.ComputePairStats(sub_bt, raw_rows))
 	return sub_bt
 
 def HardCodedParameters():
@@ -659,6 +887,7 @@ def HardCodedParameters():
 	"bt_name" : "massdot_bluetoad_data",
 	"pred_duration" : 288, #hours of prediction
 	"default_roadway_pattern" : 5587, #if we have no diurnal cycle, which roadway's pattern shall we use????
+	"neighbour_roads" : 3, #...unless the roadway has located neighbours travelling the same direction, whose mean pattern we use
 	"weather_site_name" : "closest", "weather_site_default" : "BostonAirport",
 	'w_def': 'Boston, Logan International Airport ',
 	'steps_to_smooth': 12, #how long until our prediction fully reflects future estimates?
@@ -676,9 +905,36 @@ def HardCodedParameters():
 	"path_to_lat_lons" : "https://github.com/apcollier/hacking-travel/blob/master/js/segments.js",
 	"path_to_current" : "http://acollier.com/traffichackers/data/current.json", #traffichackers.com/data/predictions/similar_dow.json
 	"CoordsDic_name" : "RoadwayCoordsDic.txt", "NOAA_df_name" : "WeatherSites_MA.csv",
+	"volume_name" : "RoadVolumes.csv", "volume_max_miles" : 0.5, #MassDOT's historical road volume counts, and how far a roadway's sensor may be
 	"WeatherInfo" : "ClosestWeatherSite.txt",
+	"speed_buffer_name" : "SpeedBuffer.json", #ring buffer of the last traffic_system_memory speeds per roadway
+	"append_history" : 0, #set to any value other than 0 to append the live snapshot to each roadway's history
+	"metrics_path" : os.path.join("update"), #where the run's _metrics.json and _metrics.prom are written
+	"bundle_path" : os.path.join("update", "bundles"), "bundle_keep" : 3, #compiled model bundles, and how many versions to keep
+	"use_bundle" : 0, #set to any value other than 0 to predict from the current bundle without rebuilding stale files
+	"departure_sweep" : None, #[steps before, steps after] the start time, to predict for each departure in between
+	"routes_name" : "CommuterRoutes.json", #commuter routes, as lists of consecutive pair_ids, for which route tables are written
+	"route_tables" : 0, #set to any value other than 0 to write door-to-door travel times along each commuter route
+	"multi_resolution" : 0, #set to any value other than 0 to predict farther steps at the coarser resolutions of horizon_bands
+	"horizon_bands" : [[0, 1], [72, 3], [288, 12]], #[first step, steps averaged per column]: five-minute to 6 hours, then 15-minute, then hourly
+	"analog_cap" : 0, #if above 0, predict each roadway from at most this many analogs, a sample stratified by year, weather and day type
+	"analog_seed" : 0, #seed of the analog sample, so that the same matches are always sampled alike
+	"deadline_seconds" : 0, #if above 0, predict pairs in order of priority and fall back for those left this many seconds into the run
+	"schedule_priority" : "busiest", #'busiest' (most readings per day) or 'changed' (conditions changed most since the last cycle) first
+	"recompute_changed" : 0, #set to any value other than 0 to recompute only the pairs whose conditions changed since the last cycle
+	"change_thresholds" : [5.0, 1.0, 3.0], #changes in [traffic state, weather history, current speed (mph)] beyond which a pair is recomputed
+	"reuse_max_minutes" : 30, #how long a pair's predictions may be carried forward before they are recomputed regardless
+	"fallback_max_minutes" : 30, #how old the predictions a pair falls back on at the deadline may be before it falls back on the defaults
+	"hour_tables" : 1, #set to 0 to predict fixed-hour (-hr) queries from the history even where a current HourTables table exists
+	"shard" : None, #(i, N) to build and predict only the pair_ids of shard i of N, writing a partial output
+	"min_pair_rows" : 288, #roadways with fewer readings than this (one day) are not built or predicted
+	"memory_ceiling_mb" : 0, #if above 0, split the archive in chunks and build one roadway at a time within this many MB
 	"WeatherURL" : "http://w1.weather.gov/xml/current_obs/",
-	"bluetoad_type" : "csv", #can be set to 'csv' or 'zip'
+	"bluetoad_type" : "csv", #can be set to 'csv' or 'zip' (read from within the zip, without extracting it)
+	"build_jobs" : 1, #worker processes building stale pairs at once
+	"refresh_archive" : 0, #set to any value other than 0 to download the archive again if the server's copy changed
+	"download_timeout" : 60, "download_retries" : 3, #seconds without data before a transfer is resumed, and how many times
+	"archive_sha1" : None, #if set, the sha1 the downloaded archive must have
 	"path_to_blue_toad_csv" :  "http://acollier.com/traffichackers/model_history.csv",
 	"path_to_blue_toad_zip" : "https://raw.githubusercontent.com/hackreduce/MassDOThack/master/Road_RTTM_Volume/massdot_bluetoad_data.zip",
 
@@ -696,79 +952,115 @@ def PrePrep(D):
 	NOAA_df = pd.read_csv(os.path.join(D['data_path'], D['NOAA_df_name']))
 	if not os.path.exists(os.path.join(D["update_path"])): os.makedirs(os.path.join(D["update_path"])) #add directories if missing
 	if not os.path.exists(os.path.join(D["bt_path"])): os.makedirs(os.path.join(D["bt_path"]))
-	if "zip" in D['bluetoad_type']: #if we are downloading a large .zip to unpack before running
-		if not os.path.exists(os.path.join(D['bt_path'], D['bt_name'] + ".zip")): #download all data, then run a full update if it does not exist.
-			if not os.path.exists(os.path.join(D['bt_path'], D['bt_name'] + ".csv")):
-				url = D['path_to_blue_toad_speed_zip']
-				GetZip(url, 'zip'); Unzip(D['bt_name'], D['bt_path']) #download the file, and unzip it.
-	elif "csv" in D['bluetoad_type']: #if we are downloading a .csv before running
-		if not os.path.exists(os.path.join(D['bt_path'], D['bt_name'] + ".csv")):
-			url = D['path_to_blue_toad_speed_csv']
-			GetZip(url, 'csv')
+	with locks.ArtifactLock(D, "archive"): #a concurrent run waits for the download rather than reading it half-written
+		if "zip" in D['bluetoad_type']: #if we are downloading a large .zip, read without unpacking it
+			if D['refresh_archive'] != 0 or not os.path.exists(data.ArchivePath(D, D['bt_name'])): #a .csv unpacked earlier is still read
+				GetZip(D, D['path_to_blue_toad_zip'], 'zip')
+		elif "csv" in D['bluetoad_type']: #if we are downloading a .csv before running
+			if D['refresh_archive'] != 0 or not os.path.exists(os.path.join(D['bt_path'], D['bt_name'] + ".csv")):
+				GetZip(D, D['path_to_blue_toad_csv'], 'csv')
 	if not os.path.exists(os.path.join(D["update_path"], "IndividualFiles")): os.makedirs(os.path.join(D["update_path"], "IndividualFiles"))
 	return NOAA_df
 
 def PredictionModule(all_pair_ids, pairs_and_conditions, D, subset, time_of_day,
 					DiurnalDic, MaximumDic, day_of_week, current_datetime):
 	"""Generate forward predictions, then unnormalize and return in dictionary form"""
-	PredictionDic = GenerateNormalizedPredictions(all_pair_ids, pairs_and_conditions, D['weather_fac_dic'],
+	if time_of_day != "" and D['hour_tables'] != 0: #read fixed-hour predictions from the precomputed tables where current
+		import HourTables as tables
+		PredictionDic, missed = tables.LookupNormalizedPredictions(D, all_pair_ids, pairs_and_conditions, subset, time_of_day, D['pred_duration'],
+																   HorizonBands(D), D['analog_cap'], D['analog_seed'])
+		all_pair_ids = pd.DataFrame({'pair_id' : missed})
+	else:
+		PredictionDic = {}
+	if len(all_pair_ids) > 0:
+		PredictionDic.update(GenerateNormalizedPredictions(all_pair_ids, pairs_and_conditions, D['weather_fac_dic'],
 									day_of_week, current_datetime, D['pct_range'], D['time_range'],
 									D['update_path'], D['bt_name'], D['pct_tile_list'], subset,
-									D['pred_duration'], time_of_day, D['weather_kernel_pct'], D['start_date'], D['end_date'])
+									D['pred_duration'], time_of_day, D['weather_kernel_pct'], D['start_date'], D['end_date'],
+									horizon_bands = HorizonBands(D), analog_cap = D['analog_cap'], analog_seed = D['analog_seed']))
 	CurrentPredDic = UnNormalizePredictions(PredictionDic, DiurnalDic, MaximumDic, day_of_week, current_datetime, D['pred_duration'], 										time_of_day, D['max_speed'], pairs_and_conditions, D['steps_to_smooth'], D['steps_to_diurnal_return'], D['min_spread_fac'])
 	return CurrentPredDic
 
+def DepartureSweep(all_pair_ids, pairs_and_conditions, D, subset, time_of_day, DiurnalDic, MaximumDic, day_of_week,
+				   current_datetime, steps_before, steps_after):
+	"""Predict for every departure from (steps_before) five-minute steps before the start time to (steps_after)
+	steps after it in one pass.  Analogs are matched once, at the start time, then a single horizon spanning every
+	departure is gathered, unnormalized, and sliced for each departure.  When predicting from current conditions,
+	departures cannot precede the present, so (steps_before) only applies with a chosen (time_of_day)."""
+	if time_of_day == "": steps_before = 0
+	span = steps_before + steps_after + D['pred_duration']
+	PredictionDic = GenerateNormalizedPredictions(all_pair_ids, pairs_and_conditions, D['weather_fac_dic'],
+									day_of_week, current_datetime, D['pct_range'], D['time_range'],
+									D['update_path'], D['bt_name'], D['pct_tile_list'], subset,
+									span, time_of_day, D['weather_kernel_pct'], D['start_date'], D['end_date'], horizon_shift = -steps_before)
+	first_day, first_datetime, first_time = day_of_week, current_datetime, time_of_day
+	if time_of_day != "": #the span starts (steps_before) earlier, which may be the previous day
+		first_time = time_of_day - steps_before / 288.0
+		if first_time < 0:
+			first_time, first_day, first_datetime = first_time + 1, (day_of_week + 6) % 7, current_datetime - datetime.timedelta(days = 1)
+		first_time = NCDC.RoundToNearestNth(first_time, 288, 3)
+	SpanDic = UnNormalizePredictions(PredictionDic, DiurnalDic, MaximumDic, first_day, first_datetime, span, first_time, D['max_speed'],
+									 pairs_and_conditions, D['steps_to_smooth'], D['steps_to_diurnal_return'], D['min_spread_fac'])
+	first_departure = datetime.datetime.strptime(SpanDic['Start'][:19], "%Y-%m-%dT%H:%M:%S")
+	departures = range(steps_before + steps_after + 1)
+	SweepDic = {'Departures' : [(first_departure + datetime.timedelta(minutes = 5 * j)).isoformat() for j in departures]}
+	for road in SpanDic.keys():
+		if road == 'Start': continue
+		SweepDic[road] = {}
+		for p in SpanDic[road].keys():
+			span_seq = SpanDic[road][p]
+			SweepDic[road][p] = span_seq if not span_seq else [span_seq[j:j + D['pred_duration']] for j in departures]
+	return SweepDic
+
 def main(D, output_file_name, subset, time_of_day):
 	"""Main module"""
-	NOAA_df = PrePrep(D) #create directories and/or download bluetoad data if required.
-	data.GetBlueToad(D, D['bt_name']) #read it in and re-format dates
-	weights = list(pd.read_csv(os.path.join(D['data_path'],'DecaySeries.csv')).Weight)
-	all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
-	if not os.path.exists(os.path.join(D['update_path'], 'DiurnalDictionary.txt')): #if this dictionary doesn't exist, we'll fill it
-		DiurnalDic = {} #To be appended, site by site
-	else: #just read it it from file
-		DiurnalDic = GetJSON(D['update_path'], "DiurnalDictionary.txt")
-	DD_flag = False #assume we do NOT need to alter DiurnalDic...
-	if os.path.exists(os.path.join(D['data_path'], D['CoordsDic_name'])):	#if we've already built it
-		RoadwayCoordsDic = GetJSON(D['data_path'], D['CoordsDic_name'])
-	else:
-		RoadwayCoordsDic = mass.GetLatLons(D['data_path'], "Roadway_LatLonData.txt")
-	if not os.path.exists(os.path.join(D['update_path'], D['WeatherInfo'])): #if we lack minimums for each site
-		NOAADic = NCDC.BuildClosestNOAADic(NOAA_df, all_pair_ids.pair_id, D) #which weather site for which roadway?
+	if D['shard'] is not None:
+		import Shards as shards #only needed when this run is one of several
+	if D['use_bundle'] != 0 and bundle.CurrentVersion(D) is not None: #predict straight from the prebuilt lookups
+		with metrics.Timer('LoadBundle'):
+			B = bundle.LoadBundle(D)
+		weights, all_pair_ids, NOAA_df = B['weights'], pd.DataFrame({'pair_id' : B['pair_ids']}), pd.DataFrame(B['NOAA_df'])
+		pair_ids = all_pair_ids if D['shard'] is None else shards.ShardPairIds(D, all_pair_ids, D['shard'])
+		NOAADic, DiurnalDic, MaximumDic = B['NOAADic'], B['DiurnalDic'], B['MaximumDic']
+		road_index = spatial.BuildRoadIndex(B['RoadwayCoordsDic'], B['road_directions'])
 	else:
-		NOAADic = GetJSON(D['update_path'], D['WeatherInfo']) #read in the locations of closest weather sites
-	DD_flag = False
-	for a in all_pair_ids.pair_id: #process by site,
-		flag = 0; ##Check if we've gone through the normalization steps...
-		if not os.path.exists(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned_Normalized.csv")):
-			sub_bt = SubBt_Cleaned_to_PreNormalized(D, a); flag = 1 #to note that this process is already done.
-		if str(a) + "_0" not in DiurnalDic.keys(): #if the DiurnalDictionary is still empty
-			if not flag: #if we need to process the sub_bt data frame again.
-				sub_bt = SubBt_Cleaned_to_PreNormalized(D, a); flag = 1 #to note that this process is already done.
-			DiurnalDic.update(GenerateDiurnalDic(sub_bt, D['update_path'], five_minute_fractions, D['pct_tile_list'], D['window'])); DD_flag = True
-		if not os.path.exists(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned_Normalized.csv")):
-			sub_bt = NormalizeTravelTime(sub_bt, DiurnalDic, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a))
-		if not os.path.exists(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned_Normalized_Weather.csv")):
-			sub_bt = pd.read_csv(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned_Normalized.csv"))
-			sub_bt = AttachWeatherData(sub_bt, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a), D['weather_dir'], D["weather_site_default"])
-		if not os.path.exists(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_CNW_TrafficHist.csv")):
-			sub_bt = pd.read_csv(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned_Normalized_Weather.csv"))
-			sub_bt = AttachTrafficHistory(sub_bt, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a), D, weights)
-		if not os.path.exists(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_CNW_TrafficHist_WeatherHist.csv")):
-			sub_bt = pd.read_csv(os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_CNW_TrafficHist.csv"))
-			sub_bt = AttachWeatherHistory(sub_bt, os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a), D, weights)
-	#Write full DiurnalDictionary to a .txt file as a .json
-	if DD_flag:
-		with open(os.path.join(D['update_path'], 'DiurnalDictionary.txt'), 'wb') as outfile:
-			json.dump(DiurnalDic, outfile)
-	if not os.path.exists(os.path.join(D['update_path'], 'MaximumDic.txt')): #if we lack minimums for each site
-		MaximumDic = DefineMaximums(D, all_pair_ids)
-	else:
-		MaximumDic = GetJSON(D['update_path'], "MaximumDic.txt") #read in the minimum predictions
+		import BuildGraph as graph #only needed when the per-pair files may be stale
+		with metrics.Timer('PrePrep'):
+			NOAA_df = PrePrep(D) #create directories and/or download bluetoad data if required.
+		weights = list(pd.read_csv(os.path.join(D['data_path'],'DecaySeries.csv')).Weight)
+		all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
+		pair_ids = all_pair_ids if D['shard'] is None else shards.ShardPairIds(D, all_pair_ids, D['shard']) #read the plan once, so a replan cannot change the shard's pairs between its build and its predictions
+		with locks.ArtifactLock(D, "coords"):
+			if os.path.exists(os.path.join(D['data_path'], D['CoordsDic_name'])):	#if we've already built it
+				RoadwayCoordsDic = GetJSON(D['data_path'], D['CoordsDic_name'])
+			else:
+				RoadwayCoordsDic = mass.GetLatLons(D['data_path'], "Roadway_LatLonData.txt")
+		road_directions = spatial.RoadDirections(D['data_path'])
+		road_index = spatial.BuildRoadIndex(RoadwayCoordsDic, road_directions) #nearest same-direction roadways, for missing diurnal cycles
+		with locks.ArtifactLock(D, "closest_sites"):
+			if not os.path.exists(os.path.join(D['update_path'], D['WeatherInfo'])): #if we lack minimums for each site
+				NOAADic = NCDC.BuildClosestNOAADic(NOAA_df, all_pair_ids.pair_id, D) #which weather site for which roadway?
+			else:
+				NOAADic = GetJSON(D['update_path'], D['WeatherInfo']) #read in the locations of closest weather sites
+		#split, clean, normalize, and attach weather/history to each site, rebuilding only what is stale
+		if D['shard'] is None:
+			DiurnalDic, MaximumDic = graph.BuildAll(D, all_pair_ids, weights)
+			with metrics.Timer('CompileBundle'), locks.ArtifactLock(D, "bundle"): #so that the next run with --bundle can skip all of the above
+				bundle.CompileBundle(D, DiurnalDic, MaximumDic, NOAADic, RoadwayCoordsDic, road_directions, weights, all_pair_ids, NOAA_df)
+		else: #build this shard's pairs only, but borrow diurnal cycles from any pair already built
+			_, MaximumDic = graph.BuildAll(D, pair_ids, weights, assemble = False)
+			DiurnalDic = graph.AssembleDiurnalDic(D, all_pair_ids, write = False)
+	if D['append_history'] != 0: #grow the pool of historical analogs with the live snapshot
+		import LiveHistoryStore as history
+		with metrics.Timer('AppendFromFeed'):
+			history.AppendFromFeed(D, pair_ids, DiurnalDic, NOAA_df, weights)
 	if D['predict'] != 0: #if we are generating forward predictions
-		day_of_week, current_datetime, pairs_and_conditions = mass.GetCurrentInfo(D['path_to_speed_history'], DiurnalDic, D['traffic_system_memory'], weights, D['path_to_current'], D['default_roadway_pattern'], D['pct_tile_list'])
+		with metrics.Timer('GetCurrentInfo'):
+			day_of_week, current_datetime, pairs_and_conditions = mass.GetCurrentInfo(D['path_to_speed_history'], DiurnalDic, D['traffic_system_memory'], weights, D['path_to_current'], D['default_roadway_pattern'], D['pct_tile_list'],
+												D['update_path'], D['speed_buffer_name'], road_index, D['neighbour_roads'])
 		if time_of_day == "": #if we are interested in predictions based on current conditions
-			pairs_and_conditions = NCDC.RealTimeWeather(D, NOAADic, NOAA_df, pairs_and_conditions, weights)
+			with metrics.Timer('RealTimeWeather'):
+				pairs_and_conditions = NCDC.RealTimeWeather(D, NOAADic, NOAA_df, pairs_and_conditions, weights)
 		else: #zero-out the normalized conditions, historical analysis starts from a normalized baseline of zero (typical conditions)
 			if subset[-1] in ['0','1','2','3','4','5','6']: #if there is a prescribed day_of_week...
 				day_of_week = int(subset[-1]) #force day_of_week to chosen day rather than current day
@@ -779,12 +1071,34 @@ def main(D, output_file_name, subset, time_of_day):
 			for k in pairs_and_conditions.keys():
 				pairs_and_conditions[k][0], pairs_and_conditions[k][1] = 0,0
 		if 'O' in subset: subset += str(day_of_week) #this means we are running the model based on whatever 'today' is.
-		CurrentPredDic = PredictionModule(all_pair_ids, pairs_and_conditions, D, subset, time_of_day,
-							DiurnalDic, MaximumDic, day_of_week, current_datetime)
+		if D['departure_sweep'] is not None: #predictions for a range of departure times, rather than one
+			with metrics.Timer('DepartureSweep'):
+				CurrentPredDic = DepartureSweep(pair_ids, pairs_and_conditions, D, subset, time_of_day, DiurnalDic, MaximumDic,
+												day_of_week, current_datetime, D['departure_sweep'][0], D['departure_sweep'][1])
+		elif D['deadline_seconds'] > 0 or D['recompute_changed'] != 0: #stream each pair as it is ready, reusing or falling back where allowed
+			import CycleScheduler as scheduler
+			with metrics.Timer('ScheduledPredictions'):
+				CurrentPredDic = scheduler.ScheduledPredictions(D, pair_ids, pairs_and_conditions, subset, time_of_day, DiurnalDic, MaximumDic,
+								day_of_week, current_datetime, output_file_name if D['shard'] is None else shards.PartialName(output_file_name, D['shard']))
+		else:
+			with metrics.Timer('PredictionModule'):
+				CurrentPredDic = PredictionModule(pair_ids, pairs_and_conditions, D, subset, time_of_day,
+								DiurnalDic, MaximumDic, day_of_week, current_datetime)
+		if D['route_tables'] != 0 and D['shard'] is None: #chain the segment predictions along each commuter route (sharded runs, once merged)
+			import RouteEngine as route
+			with metrics.Timer('RouteTables'):
+				RouteDic = route.RouteTables(D, CurrentPredDic, route.LoadRoutes(D))
+				WriteJSON(RouteDic, D['update_path'], os.path.splitext(output_file_name)[0] + "_routes.json")
 	else: #no need to spend time on gathering similar sets and unnormalizing
-		CurrentPredDic = NoPrediction(all_pair_ids, D) #if we are simply reporting a JSON for the relevant time subset
-	with open(os.path.join(D['update_path'], output_file_name), 'wb') as outfile:
-		json.dump(CurrentPredDic, outfile)
+		with metrics.Timer('NoPrediction'):
+			CurrentPredDic = NoPrediction(pair_ids, D) #if we are simply reporting a JSON for the relevant time subset
+	with metrics.Timer('WriteOutput'):
+		if D['shard'] is None:
+			WriteJSON(CurrentPredDic, D['update_path'], output_file_name)
+		else: #a partial output, for Shards.py merge to assemble
+			shards.WritePartial(D, CurrentPredDic, output_file_name, D['shard'], pair_ids.pair_id)
+			output_file_name = shards.PartialName(output_file_name, D['shard'])
+	metrics.WriteMetrics(D['metrics_path'], os.path.splitext(output_file_name)[0]) #per-stage and per-pair metrics, as JSON and Prometheus text
 	return None
 
 if __name__ == "__main__":
@@ -812,6 +1126,35 @@ if __name__ == "__main__":
 						type = int, default = 9999999)
 	parser.add_argument("-p", "--predict", help = "set to any value other than 0 to make predictions rather than report the data itself.",
 						type = int, default = 1)
+	parser.add_argument("-a", "--append", help = "set to any value other than 0 to append the live current.json snapshot to the historical archive.",
+						type = int, default = None)
+	parser.add_argument("-mp", "--metrics_path", help = "directory for the run's metrics (JSON and Prometheus textfile), default of the update directory.",
+						type = str, default = '')
+	parser.add_argument("-mc", "--memory_ceiling", help = "build within this many MB of memory, splitting the BlueToad archive in chunks (0 for no ceiling).",
+						type = int, default = -1)
+	parser.add_argument("-sw", "--sweep", help = "predict for every departure from MIN_BEFORE minutes before to MIN_AFTER minutes after the start, given as 'MIN_BEFORE,MIN_AFTER' (e.g. '120,120').",
+						type = str, default = '')
+	parser.add_argument("-r", "--routes", help = "set to any value other than 0 to also write travel times along each commuter route, as <output>_routes.json.",
+						type = int, default = None)
+	parser.add_argument("-b", "--bundle", help = "set to any value other than 0 to predict from the current model bundle, skipping the build.",
+						type = int, default = None)
+	parser.add_argument("-sh", "--shard", help = "build and predict only shard i of N, given as 'i/N' (e.g. '2/4'), writing a partial output for 'python Shards.py merge'.",
+						type = str, default = '')
+	parser.add_argument("-mr", "--multi_resolution", help = "set to any value other than 0 to predict farther steps at 15-minute, then hourly, resolution, and none past the return to the diurnal median.",
+						type = int, default = None)
+	parser.add_argument("-ac", "--analog_cap", help = "predict each roadway from at most this many historical matches, sampled across years, weather and day types (0 for all).",
+						type = int, default = None)
+	parser.add_argument("-dl", "--deadline", help = "stream each roadway's predictions to <output>.ndjson as it is ready, and fall back on the previous cycle's (or defaults) for those left this many seconds into the run.",
+						type = int, default = None)
+	parser.add_argument("-pr", "--priority", help = "with (-dl), which roadways to predict first: 'busiest' (default) or 'changed' (conditions changed most since the last cycle).",
+						choices = ['busiest', 'changed'], default = None)
+	parser.add_argument("-rc", "--recompute_changed", help = "set to any value other than 0 to recompute only roadways whose conditions changed since the last cycle, carrying the others' predictions forward.",
+						type = int, default = None)
+	parser.add_argument("-j", "--jobs", help = "worker processes building stale roadways at once, default of 1.",
+						type = int, default = None)
+	parser.add_argument("-ra", "--refresh_archive", help = "set to any value other than 0 to download the BlueToad archive again if it changed on the server (a conditional, resumable request).",
+						type = int, default = None)
+	parser.add_argument("--profile", help = "capture a CPU profile of the run, written beside the output as a .prof file.", action = "count")
 	args = parser.parse_args()
 
 	subset = '' #to be added based on user provided arguments:
@@ -835,6 +1178,23 @@ if __name__ == "__main__":
 
 	#define whether predictive analytics are necessary
 	D['predict'] = args.predict
+	if args.append is not None: D['append_history'] = args.append
+	if args.metrics_path != '': D['metrics_path'] = args.metrics_path
+	if args.bundle is not None: D['use_bundle'] = args.bundle
+	if args.routes is not None: D['route_tables'] = args.routes
+	if args.multi_resolution is not None: D['multi_resolution'] = args.multi_resolution
+	if args.analog_cap is not None: D['analog_cap'] = args.analog_cap
+	if args.deadline is not None: D['deadline_seconds'] = args.deadline
+	if args.priority is not None: D['schedule_priority'] = args.priority
+	if args.recompute_changed is not None: D['recompute_changed'] = args.recompute_changed
+	if args.refresh_archive is not None: D['refresh_archive'] = args.refresh_archive
+	if args.jobs is not None: D['build_jobs'] = max(args.jobs, 1)
+	if args.shard != '':
+		import Shards as shards
+		D['shard'] = shards.ParseShard(args.shard)
+	if args.sweep != '':
+		D['departure_sweep'] = [int(m) / 5 for m in args.sweep.split(",")] #in five-minute steps
+	if args.memory_ceiling >= 0: D['memory_ceiling_mb'] = args.memory_ceiling
 
 	if args.hour != '' and ":" in args.hour and len(args.hour) == 5: #if we are looking for a specific day/time pairing historically rather than a prediction based on current conditions
 		hour, minute = args.hour.split(":")
@@ -844,4 +1204,10 @@ if __name__ == "__main__":
 	else:
 		time_of_day = ""
 	print out_name, subset, D['pred_duration'], time_of_day
-	main(D, out_name, subset, time_of_day)
+	if args.profile >= 1: #profile the whole run and list the costliest functions
+		import cProfile, pstats
+		profile_path = os.path.join(D['update_path'], os.path.splitext(out_name)[0] + ".prof")
+		cProfile.run("main(D, out_name, subset, time_of_day)", profile_path)
+		pstats.Stats(profile_path).sort_stats('cumulative').print_stats(30)
+	else:
+		main(D, out_name, subset, time_of_day)
@@ -0,0 +1,335 @@
+"""This module decides which per-pair files must be (re)built before predictions can be made.  Each pair_id
+passes through a fixed chain of stages, from splitting the BlueToad archive to attaching weather history.  Every
+stage is keyed by a hash of its upstream stage and of the parameters and data files it depends on, and the hashes
+of completed stages are recorded in a per-pair manifest.  A stage is rebuilt only when its output is missing or
+its key has changed, and rebuilding a stage rebuilds everything downstream of it."""
+
+import os
+import json
+import hashlib
+import time
+import gc
+import resource
+import multiprocessing
+import BlueToadAnalysis as BTA
+import MassDotDataTypes as data
+import NCDC_WeatherProcessor as NCDC
+import RunMetrics as metrics
+import PairStatistics as stats
+import BuildLocks as locks
+import LiveHistoryStore as history
+
+STAGES = ['split', 'clean', 'diurnal', 'normalized', 'weather', 'traffic_hist', 'weather_hist']
+
+def StageOutputs(D, a):
+	"""Return the file written by each stage for roadway (a)."""
+	base = os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a))
+	return {'split' : base + "_Cleaned.csv",
+			'clean' : base + "_Cleaned.csv", #cleaning rewrites the split file in place
+			'diurnal' : base + "_Diurnal.json",
+			'normalized' : base + "_Cleaned_Normalized.csv",
+			'weather' : base + "_Cleaned_Normalized_Weather.csv",
+			'traffic_hist' : base + "_CNW_TrafficHist.csv",
+			'weather_hist' : base + "_CNW_TrafficHist_WeatherHist.csv"}
+
+def ManifestPath(D, a):
+	return os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Manifest.json")
+
+def HashObject(obj):
+	"""Return a stable sha1 of any json-serializable (obj)."""
+	return hashlib.sha1(json.dumps(obj, sort_keys = True)).hexdigest()
+
+def FileHash(file_path, hash_cache):
+	"""Return the sha1 of the contents of (file_path), or None if it does not exist.  Hashes are cached in
+	(hash_cache) by size and modification time, so the BlueToad archive is only re-read after it changes."""
+	if not os.path.exists(file_path):
+		return None
+	stat = os.stat(file_path)
+	signature = [stat.st_size, int(stat.st_mtime)]
+	if file_path in hash_cache and hash_cache[file_path][0:2] == signature:
+		return hash_cache[file_path][2]
+	sha = hashlib.sha1()
+	with open(file_path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), ''):
+			sha.update(chunk)
+	hash_cache[file_path] = signature + [sha.hexdigest()]
+	return hash_cache[file_path][2]
+
+def WeatherFile(D):
+	"""The NCDC file read by AttachWeatherData for the default weather site.  It is generated from the monthly
+	files first if needed, so that its hash does not change between the first build and the next."""
+	site_name = D["weather_site_default"]
+	with locks.ArtifactLock(D, "weather_" + site_name): #so that no other run reads it half-written
+		if not os.path.exists(os.path.join(D['weather_dir'], site_name + "_NCDC.csv")):
+			NCDC.GetWeatherData(D['weather_dir'], site_name)
+	return os.path.join(D['weather_dir'], site_name + "_NCDC.csv")
+
+def InputHashes(D, hash_cache):
+	"""Hash the shared inputs: the BlueToad archive (.csv or .zip), the decay weights, and the weather record."""
+	return {'source' : FileHash(data.ArchivePath(D, D['bt_name']), hash_cache),
+			'weights' : FileHash(os.path.join(D['data_path'], 'DecaySeries.csv'), hash_cache),
+			'weather' : FileHash(WeatherFile(D), hash_cache)}
+
+def StageKeys(D, input_hashes, manifest):
+	"""Chain the key of every stage from its upstream key and the inputs listed below.  If the BlueToad archive
+	is absent (e.g. removed after splitting), the split stage keeps whatever key it was last built with."""
+	stage_inputs = {'split' : [input_hashes['source'] if input_hashes['source'] is not None else manifest.get('split')],
+					'clean' : [],
+					'diurnal' : [D['pct_tile_list'], D['window']],
+					'normalized' : [],
+					'weather' : [input_hashes['weather'], D['weather_site_default']],
+					'traffic_hist' : [input_hashes['weights'], D['traffic_system_memory']],
+					'weather_hist' : [input_hashes['weights'], D['traffic_system_memory'], D['weather_cost_facs']]}
+	keys, upstream = {}, None
+	for stage in STAGES:
+		keys[stage] = HashObject([stage, upstream] + stage_inputs[stage]) if stage != 'split' else HashObject(stage_inputs[stage])
+		upstream = keys[stage]
+	return keys
+
+def ReadManifest(D, a):
+	if os.path.exists(ManifestPath(D, a)):
+		return BTA.GetJSON("", ManifestPath(D, a))
+	return {}
+
+def StaleStages(D, a, keys, manifest):
+	"""Return the stages of roadway (a) which must be rebuilt: the first stage whose output is missing or whose key
+	differs from the (manifest), and every stage after it."""
+	outputs = StageOutputs(D, a)
+	for ind, stage in enumerate(STAGES):
+		if not os.path.exists(outputs[stage]) or manifest.get(stage) != keys[stage]:
+			return STAGES[ind:]
+	return []
+
+def AdoptLegacyPair(D, a, keys, LegacyDiurnalDic):
+	"""Pairs built before manifests existed are adopted as up to date if every output exists, rather than forcing
+	a full rebuild.  The per-pair diurnal file is split out of the legacy DiurnalDictionary.txt."""
+	outputs = StageOutputs(D, a)
+	pair_diurnal = dict((k, v) for k, v in LegacyDiurnalDic.items() if k.split("_")[0] == str(a))
+	if not os.path.exists(outputs['diurnal']) and len(pair_diurnal) > 0:
+		BTA.WriteJSON(pair_diurnal, "", outputs['diurnal'])
+	if all([os.path.exists(outputs[stage]) for stage in STAGES]):
+		BTA.WriteJSON(keys, "", ManifestPath(D, a))
+		return keys
+	return {}
+
+def RunStages(D, a, stale, keys, manifest, weights):
+	"""Run the (stale) stages of roadway (a) in order, recording each completed stage in its manifest so that an
+	interrupted build resumes from the stage it stopped in.  Every file is written via a rename, so an output never
+	exists in a truncated state.  Live snapshots appended to the roadway's history are re-applied from its live log."""
+	outputs = StageOutputs(D, a)
+	bt_path, bt_name = os.path.join(D['update_path'], "IndividualFiles"), D['bt_name'] + "_" + str(a)
+	sub_bt = None
+	for stage in stale:
+		if stage == 'split':
+			pass #run for all stale pairs at once by BuildAll, since it requires reading the full archive
+		elif stage == 'clean':
+			sub_bt = history.ApplyLiveLog(D, a, BTA.SubBt_Cleaned_to_PreNormalized(D, a), True)
+		elif stage == 'diurnal':
+			if sub_bt is None: sub_bt = history.ApplyLiveLog(D, a, data.ReadPairFile(outputs['clean']), False)
+			BTA.WriteJSON(BTA.GenerateDiurnalDic(sub_bt, D['update_path'], BTA.five_minute_fractions, D['pct_tile_list'], D['window'],
+												 stats.GetPairStats(D, a)['mean_speed']), "", outputs['diurnal'])
+		elif stage == 'normalized':
+			if sub_bt is None: sub_bt = history.ApplyLiveLog(D, a, data.ReadPairFile(outputs['clean']), False)
+			sub_bt = BTA.NormalizeTravelTime(sub_bt, BTA.GetJSON("", outputs['diurnal']), bt_path, bt_name)
+		elif stage == 'weather':
+			sub_bt = data.ReadPairFile(outputs['normalized'])
+			sub_bt = BTA.AttachWeatherData(sub_bt, bt_path, bt_name, D['weather_dir'], D["weather_site_default"])
+			sub_bt = history.RestoreLiveWeather(D, a, sub_bt, outputs['weather'])
+		elif stage == 'traffic_hist':
+			sub_bt = data.ReadPairFile(outputs['weather'])
+			sub_bt = BTA.AttachTrafficHistory(sub_bt, bt_path, bt_name, D, weights)
+		elif stage == 'weather_hist':
+			sub_bt = data.ReadPairFile(outputs['traffic_hist'])
+			sub_bt = BTA.AttachWeatherHistory(sub_bt, bt_path, bt_name, D, weights)
+			tail_state_path = os.path.join(bt_path, bt_name + "_TailState.json")
+			if os.path.exists(tail_state_path): os.remove(tail_state_path) #live appends restart from the rebuilt history
+		manifest[stage] = keys[stage]
+		BTA.WriteJSON(manifest, "", ManifestPath(D, a))
+		if stage == 'clean' and stats.IsSparse(D, stats.GetPairStats(D, a)):
+			print "Skipping the remaining stages for site %d, which has too little data" % a
+			break
+	return manifest
+
+def DiurnalOutdated(D, all_pair_ids):
+	"""Whether DiurnalDictionary.txt is missing or older than any of the per-pair diurnal files it combines."""
+	dictionary_path = os.path.join(D['update_path'], 'DiurnalDictionary.txt')
+	if not os.path.exists(dictionary_path):
+		return True
+	assembled = os.path.getmtime(dictionary_path)
+	for a in all_pair_ids.pair_id:
+		diurnal_path = StageOutputs(D, a)['diurnal']
+		if os.path.exists(diurnal_path) and os.path.getmtime(diurnal_path) >= assembled:
+			return True
+	return False
+
+def AssembleDiurnalDic(D, all_pair_ids, write = True):
+	"""Combine the per-pair diurnal files into the single DiurnalDictionary.txt the prediction code reads, or
+	only return them if not (write)."""
+	DiurnalDic = {}
+	for a in all_pair_ids.pair_id:
+		diurnal_path = StageOutputs(D, a)['diurnal']
+		if os.path.exists(diurnal_path):
+			DiurnalDic.update(BTA.GetJSON("", diurnal_path))
+	if write:
+		BTA.WriteJSON(DiurnalDic, D['update_path'], 'DiurnalDictionary.txt')
+	return DiurnalDic
+
+def PlanBuild(D, all_pair_ids):
+	"""Return the stale stages of every pair_id, along with the stage keys and manifests used to decide."""
+	hash_cache_name = 'FileHashes.json'
+	hash_cache = BTA.GetJSON(D['update_path'], hash_cache_name) if os.path.exists(os.path.join(D['update_path'], hash_cache_name)) else {}
+	input_hashes = InputHashes(D, hash_cache)
+	BTA.WriteJSON(hash_cache, D['update_path'], hash_cache_name)
+	legacy_path = os.path.join(D['update_path'], 'DiurnalDictionary.txt')
+	LegacyDiurnalDic = None
+	plan = {}
+	for a in all_pair_ids.pair_id:
+		manifest = ReadManifest(D, a)
+		keys = StageKeys(D, input_hashes, manifest)
+		if manifest == {}:
+			if LegacyDiurnalDic is None:
+				LegacyDiurnalDic = BTA.GetJSON(D['update_path'], 'DiurnalDictionary.txt') if os.path.exists(legacy_path) else {}
+			manifest = AdoptLegacyPair(D, a, keys, LegacyDiurnalDic)
+		plan[a] = {'stale' : StaleStages(D, a, keys, manifest), 'keys' : keys, 'manifest' : manifest}
+	return plan
+
+def CheckMemoryCeiling(D, a):
+	"""Under a memory ceiling, release roadway (a)'s frames before the next pair is read, and record the resident
+	memory left behind and the peak so far.  Checked after every pair, so that the first pair to take the peak past
+	(D)['memory_ceiling_mb'] stops the build with a MemoryError naming it.  The stages it finished are kept."""
+	gc.collect()
+	rss_mb = metrics.CurrentRSS()
+	peak_mb = max(rss_mb, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+	metrics.SetValue(a, 'rss_mb', round(rss_mb, 1))
+	metrics.SetValue(a, 'peak_rss_mb', round(peak_mb, 1))
+	if peak_mb > D['memory_ceiling_mb']:
+		raise MemoryError("Site %d took the build to %.0f MB of resident memory, over its %d MB ceiling; raise the ceiling (-mc) or build with fewer jobs (-j)"
+						  % (a, peak_mb, D['memory_ceiling_mb']))
+	return rss_mb
+
+def TaskMemory():
+	"""The resident memory of this process and its peak so far, in MB, taken as a worker starts a pair."""
+	gc.collect()
+	return metrics.CurrentRSS(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def CheckMemoryShare(D, a, start, share_mb):
+	"""The worker's version of CheckMemoryCeiling.  A forked worker shares the parent's pages and is reused across
+	pairs, so only its growth over its resident memory at the (start) of roadway (a), as returned by TaskMemory, is
+	held to its (share_mb) of the ceiling.  The worker's own peak counts only if it rose during this pair."""
+	gc.collect()
+	rss_mb = metrics.CurrentRSS()
+	peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+	growth_mb = max(rss_mb, peak_mb if peak_mb > start[1] else rss_mb) - start[0]
+	metrics.SetValue(a, 'rss_mb', round(rss_mb, 1))
+	metrics.SetValue(a, 'growth_mb', round(growth_mb, 1))
+	if growth_mb > share_mb:
+		raise MemoryError("Site %d took its worker %.0f MB past its starting resident memory, over its %.0f MB share of the %d MB ceiling; raise the ceiling (-mc) or build with fewer jobs (-j)"
+						  % (a, growth_mb, share_mb, D['memory_ceiling_mb']))
+	return growth_mb
+
+def SplitPairs(D, to_split, keys):
+	"""Split the pair_ids of (to_split) out of the BlueToad archive, except those another run has split since they
+	were planned.  The split is recorded in each pair's manifest, replacing the stages built from the previous split,
+	so that a concurrent run sees the split done and everything after it stale."""
+	with locks.ArtifactLock(D, "split"):
+		to_split = [a for a in to_split if 'split' in StaleStages(D, a, keys[a], ReadManifest(D, a))]
+		if len(to_split) > 0:
+			data.GetBlueToad(D, D['bt_name'], to_split, only_listed = True) #read the archive once for every pair that needs it
+			for a in to_split:
+				BTA.WriteJSON({'split' : keys[a]['split']}, "", ManifestPath(D, a))
+	return to_split
+
+def BuildPair(D, a, keys, weights, wait = True):
+	"""Rebuild the stale stages of roadway (a) while holding its lock, planning them again once the lock is held, since
+	another run may have built them in the meantime.  Returns the stages rebuilt, or None if another run holds the
+	lock and not (wait)."""
+	with locks.ArtifactLock(D, "pair_" + str(a), wait) as acquired:
+		if not acquired:
+			return None
+		manifest = ReadManifest(D, a)
+		stale = StaleStages(D, a, keys, manifest)
+		if 'clean' not in stale and stats.IsSparse(D, stats.GetPairStats(D, a)):
+			print "Skipping site %d, which has too little data" % a
+			return []
+		if len(stale) == 0:
+			print "Site %d was built by another run" % a
+			return []
+		print "Rebuilding stages %s for site %d" % (", ".join(stale), a)
+		pair_start = time.time()
+		RunStages(D, a, stale, keys, manifest, weights)
+		metrics.SetValue(a, 'build_seconds', round(time.time() - pair_start, 4))
+		metrics.SetValue(a, 'stages_rebuilt', len(stale))
+	return stale
+
+def BuildPairTask(task):
+	"""Build one roadway in a worker of BuildPairs, without waiting on a lock held by another run.  Returns the
+	pair_id, the stages rebuilt (None if deferred), and the pair's metrics, which would otherwise stay in the worker.
+	A (share_mb) of the memory ceiling is given to workers of a pool, and None when building in this process."""
+	D, a, keys, weights, share_mb = task
+	start = TaskMemory() if share_mb is not None else None
+	stale = BuildPair(D, a, keys, weights, wait = False)
+	if stale is not None and share_mb is not None:
+		CheckMemoryShare(D, a, start, share_mb)
+	elif stale is not None and D.get('memory_ceiling_mb', 0) > 0:
+		CheckMemoryCeiling(D, a)
+	return a, stale, metrics.pair_counters.get(str(a), {})
+
+def BuildPairs(D, all_pair_ids, plan, weights, processes):
+	"""Rebuild the stale stages of every pair with enough data in (plan), over (processes).  Pairs are independent
+	once split: each writes only its own files, diurnal cycle and manifest, so they are built concurrently, the
+	largest first, and a build interrupted at any pair resumes from the pairs and stages it had not finished.
+	Under a memory ceiling, which covers the whole build, each worker's growth over the memory it held before
+	a pair is kept to an equal share of it.  Pairs another run is building are waited on once every other pair is done."""
+	to_build = []
+	for a in all_pair_ids.pair_id:
+		if 'clean' not in plan[a]['stale'] and stats.IsSparse(D, stats.GetPairStats(D, a)):
+			print "Skipping site %d, which has too little data" % a
+		elif len(plan[a]['stale']) > 0:
+			to_build.append(a)
+	split_bytes = dict((a, os.path.getsize(StageOutputs(D, a)['split']) if os.path.exists(StageOutputs(D, a)['split']) else 0) for a in to_build)
+	processes = min(processes, len(to_build))
+	share_mb = None
+	if processes > 1 and D.get('memory_ceiling_mb', 0) > 0: #(processes) pairs are resident at once
+		share_mb = float(D['memory_ceiling_mb']) / processes
+	tasks = [(D, a, plan[a]['keys'], weights, share_mb) for a in to_build]
+	if processes > 1:
+		tasks.sort(key = lambda task: -split_bytes[task[1]]) #the largest first, so that no worker is left with one at the end
+		pool = multiprocessing.Pool(processes)
+		built = pool.map(BuildPairTask, tasks, chunksize = 1)
+		pool.close(); pool.join()
+	else:
+		built = map(BuildPairTask, tasks)
+	deferred = []
+	for a, stale, pair_metrics in built:
+		metrics.pair_counters.setdefault(str(a), {}).update(pair_metrics)
+		if stale is None:
+			deferred.append(a)
+	for a in sorted(deferred):
+		BuildPair(D, a, plan[a]['keys'], weights)
+		if D.get('memory_ceiling_mb', 0) > 0:
+			CheckMemoryCeiling(D, a)
+	return None
+
+def BuildAll(D, all_pair_ids, weights, assemble = True):
+	"""Bring every pair's files up to date, rebuilding only the stale stages of pairs with enough data, then refresh
+	DiurnalDictionary.txt if anything it summarizes changed, and PairStatistics.json and MaximumDic.txt.
+	Returns (DiurnalDic, MaximumDic).  A shard, building only some of the pair_ids, does not (assemble) the shared
+	files, which would then cover its own pairs alone, and returns the per-pair files of its (all_pair_ids) instead."""
+	with metrics.Timer('PlanBuild'):
+		plan = PlanBuild(D, all_pair_ids)
+	to_split = [a for a in plan if 'split' in plan[a]['stale']]
+	if len(to_split) > 0:
+		with metrics.Timer('GetBlueToad'):
+			SplitPairs(D, to_split, dict((a, plan[a]['keys']) for a in to_split))
+	with metrics.Timer('BuildPairs'):
+		BuildPairs(D, all_pair_ids, plan, weights, D['build_jobs'])
+	if not assemble:
+		return AssembleDiurnalDic(D, all_pair_ids, write = False), BTA.DefineMaximums(D, all_pair_ids, write = False)
+	with locks.ArtifactLock(D, "summaries"): #one run at a time refreshes the shared files
+		if DiurnalOutdated(D, all_pair_ids):
+			DiurnalDic = AssembleDiurnalDic(D, all_pair_ids)
+		else:
+			DiurnalDic = BTA.GetJSON(D['update_path'], "DiurnalDictionary.txt")
+		stats.AssembleCatalog(D, all_pair_ids)
+		MaximumDic = BTA.DefineMaximums(D, all_pair_ids) #read from the catalog, which live appends also keep current
+	return DiurnalDic, MaximumDic
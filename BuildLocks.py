@@ -0,0 +1,56 @@
+"""This module keeps concurrent runs sharing one update directory (e.g. the two launched together by upload.sh) from
+building the same artifact twice.  Every artifact that may be missing or stale at the start of a run -- the BlueToad
+archive, the weather record, each roadway's files, the shared summaries, the model bundle -- is built while holding
+an exclusive lock named after it.  A second run needing the same artifact waits on the lock, then checks again and,
+finding it built, only reads it.  Locks are advisory flock()s on files under update/locks, released by the
+operating system if their process dies, so a crashed run never leaves a lock behind."""
+
+import os
+import time
+import errno
+import fcntl
+import contextlib
+import RunMetrics as metrics
+
+global held
+held = set() #names of the locks this process holds, so that nested requests for the same artifact do not deadlock
+
+def LockPath(D, name):
+	"""The file locked to build the artifact (name)."""
+	return os.path.join(D['update_path'], "locks", name + ".lock")
+
+@contextlib.contextmanager
+def ArtifactLock(D, name, wait = True):
+	"""Hold the exclusive lock on the artifact (name) for the enclosed block, waiting for any other process holding
+	it, and yield True.  The time spent waiting is recorded as the 'LockWait' stage.  If not (wait), a lock held
+	elsewhere yields False at once, and the block must leave the artifact alone."""
+	if name in held:
+		yield True
+		return
+	if not os.path.exists(os.path.dirname(LockPath(D, name))):
+		try:
+			os.makedirs(os.path.dirname(LockPath(D, name)))
+		except OSError: #made by another process in the meantime
+			pass
+	lock_file = open(LockPath(D, name), 'a')
+	try:
+		fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		busy = False
+	except IOError, e:
+		if e.errno not in [errno.EAGAIN, errno.EACCES]:
+			lock_file.close(); raise
+		busy = True
+	try:
+		if busy and not wait:
+			yield False
+			return
+		if busy:
+			print "Waiting for another process building %s" % name
+			wait_start = time.time()
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			metrics.AddStageTime('LockWait', time.time() - wait_start)
+		held.add(name)
+		yield True
+	finally:
+		held.discard(name)
+		lock_file.close() #releases the lock
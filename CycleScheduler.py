@@ -0,0 +1,199 @@
+"""This module schedules the pairs of a prediction cycle against a deadline.  Rather than predicting every pair and
+writing the output only once all are done, BlueToadAnalysis with (--deadline) predicts the pairs one at a time in
+order of priority -- the busiest roadways first, or those whose conditions changed most since the last cycle -- and
+appends each to a newline-delimited JSON stream, update/<output>.ndjson, as soon as it is ready.
+
+Once the next pair would overrun the deadline, counted from the start of the run, each remaining pair falls back on
+the previous cycle's predictions, moved forward to this cycle's start, for up to fallback_max_minutes after they were
+computed, or failing those, on the default predictions (the diurnal cycle, eased in from the current speed).  Every fallback is recorded in the stream and under
+'Fallbacks' in the output, so a slow cycle publishes its last pairs a little stale rather than publishing nothing.
+
+With (--recompute_changed), only the pairs whose traffic state, weather or speed moved beyond change_thresholds
+since their predictions were last computed are recomputed.  The others carry their previous predictions forward by
+the five-minute steps elapsed, for up to reuse_max_minutes, so a quiet cycle touches few roadways.
+
+The stream opens with a header line, {"header" : {...}}, has one line per pair,
+{"pair_id", "source" : "model" | "reused" | "previous" | "default", "computed", "conditions", "predictions"}, and
+closes with a summary line, {"summary" : {...}}.  The next cycle reads it back for its fallbacks, its reuse, and the
+conditions it compares."""
+
+import os
+import json
+import time
+import datetime
+import pandas as pd
+import BlueToadAnalysis as BTA
+import ParseRealTimeMassDot as mass
+import PairStatistics as stats
+import RunMetrics as metrics
+
+PRIORITIES = ['busiest', 'changed']
+MODEL, REUSED, PREVIOUS, DEFAULT = 'model', 'reused', 'previous', 'default' #where a pair's predictions came from
+
+def StreamPath(D, output_file_name):
+	"""The stream written beside the output (output_file_name)."""
+	return os.path.join(D['update_path'], os.path.splitext(output_file_name)[0] + ".ndjson")
+
+def ReadStream(stream_path):
+	"""The header of the stream at (stream_path) and its pair lines by pair_id, or None and {} if there is none.
+	A stream cut short by a crash still gives the pairs it finished."""
+	header, records = None, {}
+	if not os.path.exists(stream_path):
+		return header, records
+	with open(stream_path) as infile:
+		for line in infile:
+			try:
+				record = json.loads(line)
+			except ValueError: #the line being written when the cycle stopped
+				break
+			if 'header' in record:
+				header = record['header']
+			elif 'pair_id' in record:
+				records[str(record['pair_id'])] = record
+	return header, records
+
+def EmitLine(stream, record):
+	"""Append (record) to the (stream), flushed so that readers see it at once."""
+	stream.write(json.dumps(record) + "\n")
+	stream.flush()
+	return None
+
+def ReadingsPerDay(D, pair_ids):
+	"""The mean number of readings per day of each of (pair_ids), from the statistics catalog.  BlueToad readings are
+	the vehicles detected, so the busiest corridors have the most.  Pairs not yet cataloged count as empty."""
+	busy = {}
+	for a in pair_ids:
+		pair_stats = stats.GetPairStats(D, a)
+		if pair_stats is None or pair_stats['count'] == 0:
+			busy[a] = 0.0
+			continue
+		span = mass.YYYYDOY_to_Datetime(pair_stats['last_insert_time']) - mass.YYYYDOY_to_Datetime(pair_stats['first_insert_time'])
+		busy[a] = pair_stats['count'] / max(span.total_seconds() / 86400.0, 1.0)
+	return busy
+
+def ConditionChange(current, previous):
+	"""How far the conditions of a pair, [traffic state, weather history, current speed], moved from the (previous)
+	cycle's to the (current) ones: the sum of the absolute changes.  A pair without (current) conditions, whose
+	predictions are the defaults, comes last; one the previous cycle did not see comes first."""
+	if current is None:
+		return -1.0
+	if previous is None:
+		return float('inf')
+	return sum([abs(float(c) - float(p)) for c, p in zip(current, previous)])
+
+def PairOrder(D, pair_ids, ps_and_cs, previous_records, priority):
+	"""(pair_ids) in the order to predict them: by (priority), the busiest first or the most changed first (see
+	ConditionChange), ties going to the busier pair, then the lower pair_id."""
+	if priority not in PRIORITIES:
+		raise ValueError("Pairs are prioritized by %s, not '%s'" % (" or ".join(PRIORITIES), priority))
+	busy = ReadingsPerDay(D, pair_ids)
+	if priority == 'changed':
+		change = dict((a, ConditionChange(ps_and_cs.get(str(a)), previous_records.get(str(a), {}).get('conditions'))) for a in pair_ids)
+		return sorted(pair_ids, key = lambda a: (-change[a], -busy[a], a))
+	return sorted(pair_ids, key = lambda a: (-busy[a], a))
+
+def ParseStart(start):
+	return datetime.datetime.strptime(start[:19], "%Y-%m-%dT%H:%M:%S")
+
+def ShiftedPrevious(record, previous_start, start, pred_len):
+	"""The previous cycle's predictions in (record), which began at (previous_start), moved forward to begin at
+	(start), and padded to (pred_len) steps by holding their last step.  None if they cannot cover this start."""
+	steps = int(round((start - previous_start).total_seconds() / 300.0))
+	if steps < 0:
+		return None
+	shifted = {}
+	for p, seq in record['predictions'].iteritems():
+		if not seq: #None or an empty list, reported as such
+			shifted[p] = seq
+		elif len(seq) <= steps:
+			return None
+		else:
+			seq = seq[steps:steps + pred_len]
+			shifted[p] = seq + [seq[-1]] * (pred_len - len(seq))
+	return shifted
+
+def DefaultPair(D, a, ps_and_cs, DiurnalDic, MaximumDic, day_of_week, current_datetime, time_of_day):
+	"""The predictions of roadway (a) from DefaultPredictions, unnormalized as PredictionModule would."""
+	PredictionDic = BTA.DefaultPredictions(a, D, D['pct_tile_list'], {str(a) : {}})
+	return BTA.UnNormalizePredictions(PredictionDic, DiurnalDic, MaximumDic, day_of_week, current_datetime, D['pred_duration'], time_of_day,
+									  D['max_speed'], ps_and_cs, D['steps_to_smooth'], D['steps_to_diurnal_return'], D['min_spread_fac'])[str(a)]
+
+def ReusedPredictions(D, record, current, previous_start, start):
+	"""The predictions of a pair's previous (record), which began at (previous_start), moved forward to begin at
+	(start), if the pair's (current) conditions are each within D['change_thresholds'] of the conditions they were
+	computed from, no more than D['reuse_max_minutes'] before (start).  Otherwise None, and the pair is recomputed."""
+	if record['source'] not in [MODEL, REUSED] or current is None or record['conditions'] is None:
+		return None
+	if (start - ParseStart(record['computed'])).total_seconds() > 60 * D['reuse_max_minutes']:
+		return None
+	if any([abs(float(c) - float(p)) > threshold for c, p, threshold in zip(current, record['conditions'], D['change_thresholds'])]):
+		return None
+	return ShiftedPrevious(record, previous_start, start, D['pred_duration'])
+
+def FallbackPredictions(D, record, previous_start, start):
+	"""The predictions of a pair's previous (record), which began at (previous_start), moved forward to begin at
+	(start) for a pair left at the deadline, if they were computed no more than D['fallback_max_minutes'] before
+	(start).  A record of defaults, or one from before fallbacks kept the time they were computed, gives None."""
+	if record['source'] == DEFAULT or record.get('computed') is None:
+		return None
+	if (start - ParseStart(record['computed'])).total_seconds() > 60 * D['fallback_max_minutes']:
+		return None
+	return ShiftedPrevious(record, previous_start, start, D['pred_duration'])
+
+def ScheduledPredictions(D, all_pair_ids, ps_and_cs, subset, time_of_day, DiurnalDic, MaximumDic, day_of_week, current_datetime,
+						 output_file_name):
+	"""Predict (all_pair_ids) as PredictionModule does, but one pair at a time in the order of D['schedule_priority'],
+	streaming each to the stream of (output_file_name).  With D['recompute_changed'], pairs whose conditions have
+	not changed reuse their previous predictions (see ReusedPredictions).  With D['deadline_seconds'], the pairs left
+	once the next would end that long after the start of the run fall back on the previous cycle's predictions or
+	the defaults.  Returns the predictions, with their 'Fallbacks'."""
+	stream_path = StreamPath(D, output_file_name)
+	previous_header, previous_records = ReadStream(stream_path)
+	start = BTA.UnNormalizePredictions({}, DiurnalDic, MaximumDic, day_of_week, current_datetime, D['pred_duration'], time_of_day, D['max_speed'],
+									   ps_and_cs, D['steps_to_smooth'], D['steps_to_diurnal_return'], D['min_spread_fac'])['Start']
+	if previous_header is None or previous_header['subset'] != subset or previous_header['time_of_day'] != time_of_day:
+		previous_records = {} #another kind of prediction, which cannot stand in for this one
+	reuse = D['recompute_changed'] != 0 and len(previous_records) > 0 and previous_header['pred_len'] == D['pred_duration']
+	order = PairOrder(D, list(all_pair_ids.pair_id), ps_and_cs, previous_records, D['schedule_priority'])
+	deadline = metrics.run_started + D['deadline_seconds'] if D['deadline_seconds'] > 0 else float('inf')
+	PredDic, fallbacks, reused, pair_seconds = {'Start' : start}, {}, [], []
+	with open(stream_path, 'wb') as stream:
+		EmitLine(stream, {'header' : {'Start' : start, 'subset' : subset, 'time_of_day' : time_of_day, 'pred_len' : D['pred_duration'],
+									  'priority' : D['schedule_priority'],
+									  'deadline' : datetime.datetime.fromtimestamp(deadline).isoformat() if deadline < float('inf') else None}})
+		for a in order:
+			conditions = [float(c) for c in ps_and_cs[str(a)]] if str(a) in ps_and_cs else None
+			predictions, computed = None, start
+			if reuse and str(a) in previous_records:
+				predictions = ReusedPredictions(D, previous_records[str(a)], conditions, ParseStart(previous_header['Start']), ParseStart(start))
+			expected = sum(pair_seconds) / len(pair_seconds) if pair_seconds else 0 #so that the next pair is not started if it would overrun
+			if predictions is not None: #carried forward, still keyed to the conditions it was computed from
+				source, computed, conditions = REUSED, previous_records[str(a)]['computed'], previous_records[str(a)]['conditions']
+				reused.append(a)
+				metrics.Count(a, 'reused_predictions')
+			elif time.time() + expected < deadline:
+				pair_start = time.time()
+				predictions, source = BTA.PredictionModule(pd.DataFrame({'pair_id' : [a]}), ps_and_cs, D, subset, time_of_day, DiurnalDic,
+														   MaximumDic, day_of_week, current_datetime)[str(a)], MODEL
+				pair_seconds.append(time.time() - pair_start)
+			else:
+				source = PREVIOUS
+				if str(a) in previous_records:
+					predictions = FallbackPredictions(D, previous_records[str(a)], ParseStart(previous_header['Start']), ParseStart(start))
+					computed = previous_records[str(a)]['computed'] #kept, so that a pair falling back cycle after cycle ages out
+				if predictions is None:
+					predictions, source, computed = DefaultPair(D, a, ps_and_cs, DiurnalDic, MaximumDic, day_of_week, current_datetime, time_of_day), DEFAULT, None
+				fallbacks[str(a)] = source
+				metrics.Count(a, 'deadline_fallbacks')
+			PredDic[str(a)] = predictions
+			EmitLine(stream, {'pair_id' : int(a), 'source' : source, 'computed' : computed, 'conditions' : conditions, 'predictions' : predictions})
+		sources = [fallbacks.get(str(a), REUSED if a in reused else MODEL) for a in order]
+		EmitLine(stream, {'summary' : dict([('pairs', len(order)), ('seconds', round(sum(pair_seconds), 2))] +
+										   [(kind, sources.count(kind)) for kind in [MODEL, REUSED, PREVIOUS, DEFAULT]])})
+	if len(reused) > 0:
+		print "Reused the predictions of %d of %d pairs whose conditions had not changed" % (len(reused), len(order))
+	if len(fallbacks) > 0:
+		print "Deadline reached: %d of %d pairs fell back (%d on the previous cycle, %d on defaults)" % (len(fallbacks), len(order),
+																										  sources.count(PREVIOUS), sources.count(DEFAULT))
+	PredDic['Fallbacks'] = fallbacks
+	return PredDic
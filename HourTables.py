@@ -0,0 +1,167 @@
+"""This module precomputes the analogs of the predictions asked for with (-hr HH:MM).  With a fixed hour, traffic
+and weather are ignored, so the analogs matched for a roadway depend only on its history, the day option (a day of
+the week, weekdays, or weekends) and the five-minute slot of the day.  An offline job matches them for every slot
+and day option into one table per roadway, and fixed-hour queries then read their slot's analogs from the table
+rather than reading and searching the whole history.  The percentiles of the analogs' histories, and the
+unnormalizing, are still computed per query, exactly as from the history, for any length and percentiles.
+
+A table is kept under update/HourTables as an .npz of the roadway's normalized history on its five-minute grid (see
+HistoryGrid) with the grid position of every reading, the analog indices of every slot and day option concatenated,
+the offset of each slot's analogs, and the sampling stratum of every reading (for (-ac)), beside a json of its
+metadata.  It is keyed by the stage key of the history it was matched in, the history's number of readings, and the
+matching parameters, so the table of a roadway rebuilt or appended to since, or matched under other parameters, is
+ignored until it is recomputed."""
+
+import os
+import time
+import datetime
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import BlueToadAnalysis as BTA
+import BuildGraph as graph
+import MassDotDataTypes as data
+import NCDC_WeatherProcessor as NCDC
+import RunMetrics as metrics
+import PairStatistics as stats
+
+TABLE_OPTIONS = ['0', '1', '2', '3', '4', '5', '6', 'Y', 'S'] #the subsets of monday...sunday, weekday and weekend
+ANALOGS, EMPTY_LISTS, NO_PREDICTIONS = '0', '1', '2' #how each slot was left by PairAnalogs
+MATCHING_DATETIME = datetime.datetime(2000, 1, 3) #with a fixed hour, matching depends on neither the date nor the time given
+TABLE_FORMAT = 2 #tables of an earlier layout are ignored, and matched again
+MATCHING_PARAMETERS = ['pct_range', 'time_range', 'pct_tile_list', 'weather_kernel_pct'] #the parameters BuildPairTable matches with
+
+def TableDirectory(D):
+	return os.path.join(D['update_path'], "HourTables")
+
+def MetadataPath(D, a):
+	"""Where the metadata of roadway (a)'s table is stored."""
+	return os.path.join(TableDirectory(D), D['bt_name'] + "_" + str(a) + "_HourTable.json")
+
+def MatchingParameters(D):
+	return dict((name, D[name]) for name in MATCHING_PARAMETERS)
+
+def HistoryKey(D, a):
+	"""The key of the table of roadway (a): the stage key of its history, from its manifest, with its number of
+	readings from its statistics, which live appends carry forward, and the matching parameters of (D).  None if
+	it has not been built."""
+	stage_key = graph.ReadManifest(D, a).get('weather_hist')
+	if stage_key is None:
+		return None
+	pair_stats = stats.GetPairStats(D, a)
+	return graph.HashObject([stage_key, pair_stats['count'] if pair_stats is not None else None, MatchingParameters(D)])
+
+def SlotTime(slot):
+	"""The time of day of five-minute (slot), as BlueToadAnalysis rounds an (-hr) time."""
+	return NCDC.RoundToNearestNth(slot / 288.0, 288, 3)
+
+def ReadMetadata(D, a):
+	"""Return the metadata of roadway (a)'s table, or None if it has none, it was matched in another history, or it
+	has an earlier layout."""
+	if not os.path.exists(MetadataPath(D, a)):
+		return None
+	metadata = BTA.GetJSON("", MetadataPath(D, a))
+	return metadata if metadata['key'] == HistoryKey(D, a) and metadata.get('format', 1) == TABLE_FORMAT else None
+
+def BuildPairTable(task):
+	"""Match and write the table of roadway (a), unless it is current.  Run in a worker."""
+	D, a = task
+	if ReadMetadata(D, a) is not None:
+		return a, 0
+	key = HistoryKey(D, a) #read before the history, so a table racing a rebuild is keyed to the older history
+	history_path = os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_CNW_TrafficHist_WeatherHist.csv")
+	if key is None or not os.path.exists(history_path):
+		return a, 0 #not built, or skipped for too little data
+	start = time.time()
+	sub_bt = data.ReadPairFile(history_path)
+	sub_bt.index = range(len(sub_bt))
+	status, analogs, offsets = dict((option, []) for option in TABLE_OPTIONS), [], [0]
+	conditions = {str(a) : [0, 0, 0]} #typical traffic and weather, as main sets for a fixed hour
+	for option in TABLE_OPTIONS:
+		day_of_week = int(option) if option not in ['Y', 'S'] else (5 if option == 'S' else 0)
+		for slot in xrange(288):
+			no_predictions, analog_indices = BTA.PairAnalogs(a, sub_bt, conditions, day_of_week, MATCHING_DATETIME, D['pct_range'],
+															 D['time_range'], D['pct_tile_list'], option, SlotTime(slot), D['weather_kernel_pct'])
+			if analog_indices is not None:
+				status[option].append(ANALOGS)
+				analogs.extend(analog_indices)
+			else:
+				status[option].append(NO_PREDICTIONS if no_predictions == {} else EMPTY_LISTS)
+			offsets.append(len(analogs))
+	table_name = D['bt_name'] + "_" + str(a) + "_HourTable_" + key[:10] + ".npz"
+	temp_path = os.path.join(TableDirectory(D), table_name + ".tmp" + str(os.getpid()))
+	with open(temp_path, 'wb') as outfile:
+		grid = data.HistoryGrid(data.DaySlots(sub_bt.insert_time.values), sub_bt.Normalized_t.values)
+		np.savez(outfile, grid = grid['values'], positions = grid['positions'],
+				 analogs = np.array(analogs, dtype = np.int32), offsets = np.array(offsets, dtype = np.int64),
+				 strata = np.asarray(BTA.AnalogStrata(sub_bt), dtype = np.int32))
+	os.rename(temp_path, os.path.join(TableDirectory(D), table_name))
+	previous = BTA.GetJSON("", MetadataPath(D, a))['table'] if os.path.exists(MetadataPath(D, a)) else None
+	BTA.WriteJSON({'key' : key, 'format' : TABLE_FORMAT, 'options' : TABLE_OPTIONS, 'table' : table_name, 'rows' : len(sub_bt),
+				   'parameters' : MatchingParameters(D),
+				   'status' : dict((option, "".join(status[option])) for option in TABLE_OPTIONS),
+				   'built' : time.strftime("%Y-%m-%dT%H:%M:%S")}, "", MetadataPath(D, a))
+	if previous is not None and previous != table_name and os.path.exists(os.path.join(TableDirectory(D), previous)):
+		os.remove(os.path.join(TableDirectory(D), previous)) #a reader that already opened it keeps its copy
+	return a, round(time.time() - start, 2)
+
+def BuildTables(D, all_pair_ids, processes):
+	"""Match the table of every roadway in (all_pair_ids) whose table is missing or stale, over (processes)."""
+	if not os.path.exists(TableDirectory(D)): os.makedirs(TableDirectory(D))
+	tasks = [(D, a) for a in all_pair_ids.pair_id]
+	if processes > 1:
+		pool = multiprocessing.Pool(processes)
+		built = pool.map(BuildPairTable, tasks, chunksize = 1)
+		pool.close(); pool.join()
+	else:
+		built = map(BuildPairTable, tasks)
+	return dict((a, seconds) for a, seconds in built if seconds > 0)
+
+def LookupNormalizedPredictions(D, all_pair_ids, ps_and_cs, subset, time_of_day, pred_len, horizon_bands = None,
+								analog_cap = 0, analog_seed = 0):
+	"""Answer a fixed-hour query from the tables: return the normalized predictions of every roadway whose table is
+	current, exactly as GenerateNormalizedPredictions would (at the resolution of (horizon_bands), and from at most
+	(analog_cap) analogs), and the list of pair_ids to predict from their history."""
+	slot = int(round(time_of_day * 288))
+	if subset not in TABLE_OPTIONS or slot >= 288 or D.get('start_date', 0) != 0 or D.get('end_date', 9999999) != 9999999:
+		return {}, list(all_pair_ids.pair_id) #another day option, or a restricted span of history
+	pcts, index = D['pct_tile_list'], TABLE_OPTIONS.index(subset) * 288 + slot
+	PredictionDic, missed = {}, []
+	for a in all_pair_ids.pair_id:
+		metadata = ReadMetadata(D, a) if str(a) in ps_and_cs else None
+		if metadata is None:
+			missed.append(a)
+			continue
+		status = metadata['status'][subset][slot]
+		if status == NO_PREDICTIONS:
+			print "no predictions generated for %d" % a
+			PredictionDic[str(a)] = {}
+		elif status == EMPTY_LISTS:
+			PredictionDic[str(a)] = {}
+			PredictionDic = BTA.AddEmptyDic(a, pcts, PredictionDic)
+		else:
+			table = np.load(os.path.join(TableDirectory(D), metadata['table']))
+			offsets = table['offsets']
+			analog_indices = table['analogs'][offsets[index]:offsets[index + 1]]
+			if analog_cap > 0 and len(analog_indices) > analog_cap:
+				analog_indices = BTA.SampleAnalogs(a, table['strata'][analog_indices], analog_indices, analog_cap, analog_seed)
+			grid = {'values' : table['grid'], 'positions' : table['positions']}
+			PredictionDic[str(a)] = BTA.AnalogPredictions(a, grid, analog_indices, pcts, pred_len, horizon_bands = horizon_bands)
+			table.close()
+		metrics.Count(a, 'table_lookups')
+	return PredictionDic, missed
+
+if __name__ == "__main__":
+	D = BTA.HardCodedParameters()
+	environment_vars = BTA.GetJSON("","config.json") if os.path.exists("config.json") else {}
+	for key in environment_vars:
+		D[key] = environment_vars[key]
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-j", "--jobs", help = "worker processes, default of one per core", type = int, default = multiprocessing.cpu_count())
+	args = parser.parse_args()
+
+	start_time = time.time()
+	all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
+	built = BuildTables(D, all_pair_ids, max(args.jobs, 1))
+	print "Matched %d fixed-hour tables in %.1f s, under %s" % (len(built), time.time() - start_time, TableDirectory(D))
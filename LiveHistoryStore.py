@@ -0,0 +1,195 @@
+"""This module appends live current.json snapshots to each pair's processed history, so that the pool of
+historical analogs grows with every cycle rather than only when the archive is rebuilt.  The derived columns
+(Normalized_t, weather, norm_traffic_hist, and weather_hist) are computed from a small per-pair tail state
+carried over between appends, so each append costs O(new rows) rather than a pass over the full history.  The raw
+snapshots are also kept in a per-pair live log, from which the build graph re-applies them whenever the history is
+rebuilt from the archive."""
+
+import os
+import numpy as np
+import pandas as pd
+import BlueToadAnalysis as BTA
+import MassDotDataTypes as data
+import ParseRealTimeMassDot as mass
+import NCDC_WeatherProcessor as NCDC
+import PairStatistics as stats
+import BuildLocks as locks
+
+def TailStatePath(D, a):
+	"""Where the carried-over tail state for roadway (a) is stored."""
+	return os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_TailState.json")
+
+def HistoryPath(D, a, suffix):
+	"""Path to the processed history of roadway (a) with the given file (suffix)."""
+	return os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_" + suffix + ".csv")
+
+def LiveLogPath(D, a):
+	"""Where the raw snapshots appended to roadway (a) are logged."""
+	return os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_LiveLog.csv")
+
+LIVE_LOG_COLUMNS = ['insert_time', 'speed', 'weather']
+
+def LogSnapshots(D, a, new_rows):
+	"""Append the insert_time, speed and weather of the (new_rows) of roadway (a) to its live log."""
+	log_path = LiveLogPath(D, a)
+	BTA.FormatFloat32(new_rows[LIVE_LOG_COLUMNS]).to_csv(log_path, mode = 'a', header = not os.path.exists(log_path), index = False)
+	return None
+
+def ReadLiveLog(D, a):
+	"""Return the live log of roadway (a), or None if nothing has been appended to it."""
+	if not os.path.exists(LiveLogPath(D, a)):
+		return None
+	live_log = pd.read_csv(LiveLogPath(D, a), dtype = {'insert_time' : 'float64', 'speed' : 'float32', 'weather' : 'object'})
+	live_log['weather'] = live_log.weather.fillna(' ')
+	return live_log
+
+def ApplyLiveLog(D, a, sub_bt, cleaned):
+	"""Add the logged snapshots of roadway (a) to its (sub_bt), as read or rebuilt from its cleaned archive file, so
+	that rebuilding the history keeps every live observation appended to it.  Snapshots the archive now covers (at or
+	before its last insert_time) are dropped from the log.  If the roadway was just (cleaned), which summarized the
+	archive alone, its statistics are carried forward over the logged rows."""
+	live_log = ReadLiveLog(D, a)
+	if live_log is None:
+		return sub_bt
+	covered = live_log.insert_time <= (float(sub_bt.insert_time.max()) if len(sub_bt) > 0 else 0)
+	if covered.any():
+		live_log = live_log[~covered]
+		BTA.WriteCSVAtomic(live_log, LiveLogPath(D, a))
+	if len(live_log) == 0:
+		return sub_bt
+	live_rows = data.CompactFrame(pd.DataFrame({'pair_id' : a, 'insert_time' : live_log.insert_time.values, 'speed' : live_log.speed.values,
+												'time_of_day' : [round(t - int(t), 3) for t in live_log.insert_time],
+												'day_of_week' : [BTA.GetDayOfWeek(int(t)) for t in live_log.insert_time]}))
+	if cleaned:
+		stats.UpdatePairStats(D, a, live_rows)
+	print "Re-applying %d live observations to site %d" % (len(live_rows), a)
+	return data.CompactFrame(pd.concat([sub_bt, live_rows], ignore_index = True))
+
+def RestoreLiveWeather(D, a, sub_bt, file_path):
+	"""Give the logged rows of roadway (a)'s (sub_bt) the weather observed when they were appended, rather than that
+	of the NCDC record, and rewrite the weather file at (file_path)."""
+	live_log = ReadLiveLog(D, a)
+	if live_log is None or len(live_log) == 0 or len(sub_bt) == 0:
+		return sub_bt
+	logged = dict(zip(live_log.insert_time, live_log.weather))
+	sub_bt['weather'] = [logged.get(t, w) for t, w in zip(sub_bt.insert_time, sub_bt.weather.astype(object))]
+	sub_bt = data.CompactFrame(sub_bt)
+	BTA.WriteCSVAtomic(sub_bt, file_path)
+	return sub_bt
+
+def GetTailState(D, a):
+	"""Return the tail state for roadway (a): the number of rows in its history, the last insert_time, and the
+	last traffic_system_memory values of Normalized_t and weather.  If no state has been written yet, it is
+	bootstrapped once from the processed history file."""
+	if os.path.exists(TailStatePath(D, a)):
+		return BTA.GetJSON("", TailStatePath(D, a))
+	sub_bt = data.ReadPairFile(HistoryPath(D, a, "CNW_TrafficHist_WeatherHist"), usecols = ['insert_time', 'Normalized_t', 'weather'])
+	tail = sub_bt[-D['traffic_system_memory']:]
+	return {'rows' : len(sub_bt),
+			'last_insert_time' : float(tail.insert_time.iloc[-1]) if len(tail) > 0 else 0,
+			'Normalized_t' : [float(n) for n in tail.Normalized_t],
+			'weather' : [str(w) for w in tail.weather]}
+
+def WriteTailState(D, a, tail_state):
+	"""Write the (tail_state) of roadway (a) to file."""
+	BTA.WriteJSON(tail_state, "", TailStatePath(D, a))
+	return None
+
+def BuildAppendedRows(a, snapshots, tail_state, DiurnalDic, weights, D):
+	"""Given a list of (snapshots), each an (insert_time, speed, weather) tuple ordered in time, and the roadway's
+	(tail_state), return a data frame of new rows with every derived column filled in, plus the updated tail state.
+	Snapshots at or before the last stored insert_time are skipped so that replays do not duplicate rows."""
+	historical_window = D['traffic_system_memory']
+	norm_tail, weather_tail = list(tail_state['Normalized_t']), list(tail_state['weather'])
+	rows, last_insert_time = tail_state['rows'], tail_state['last_insert_time']
+	new_rows = {'pair_id' : [], 'insert_time' : [], 'speed' : [], 'time_of_day' : [], 'day_of_week' : [],
+				'Normalized_t' : [], 'weather' : [], 'norm_traffic_hist' : [], 'weather_hist' : []}
+	for insert_time, speed, weather in snapshots:
+		if insert_time <= last_insert_time:
+			continue
+		day_of_week = BTA.GetDayOfWeek(int(insert_time))
+		time_index = int((insert_time - int(insert_time)) * 288 + .0001)
+		diurnal_key = str(a) + "_" + str(day_of_week)
+		if diurnal_key not in DiurnalDic: #no baseline to normalize against for this roadway
+			continue
+		if rows == 0: #the first row of a history has no antecedent conditions, as in AttachTrafficHistory
+			traffic_hist, weather_hist = 0, 0
+		else:
+			traffic_hist = BTA.CalculateAntecedentTraffic(norm_tail[::-1], weights[0:historical_window], historical_window)
+			weather_hist = BTA.CalculateAntecedentWeather(weather_tail[::-1], weights[0:historical_window], D['weather_cost_facs'], historical_window)
+		normalized_t = round(speed - DiurnalDic[diurnal_key]['50'][time_index], 2)
+		for column, value in zip(['pair_id', 'insert_time', 'speed', 'time_of_day', 'day_of_week', 'Normalized_t', 'weather',
+								  'norm_traffic_hist', 'weather_hist'],
+								 [a, insert_time, speed, round(insert_time - int(insert_time), 3), day_of_week, normalized_t, weather,
+								  traffic_hist, weather_hist]):
+			new_rows[column].append(value)
+		norm_tail = (norm_tail + [float(np.float32(normalized_t))])[-historical_window:] #as a rebuild reads it back from file
+		weather_tail = (weather_tail + [weather])[-historical_window:]
+		rows += 1; last_insert_time = insert_time
+	tail_state = {'rows' : rows, 'last_insert_time' : last_insert_time, 'Normalized_t' : norm_tail, 'weather' : weather_tail}
+	return data.CompactFrame(pd.DataFrame(new_rows)), tail_state
+
+#every file downstream of the cleaned one, so that a rebuild starting at any later stage reads the appended rows.
+#The cleaned file, rewritten from the archive, takes them from the live log instead.
+APPENDED_FILES = ["Cleaned_Normalized", "Cleaned_Normalized_Weather", "CNW_TrafficHist", "CNW_TrafficHist_WeatherHist"]
+
+def AppendToCSV(new_rows, file_path):
+	"""Append (new_rows) to the csv at (file_path), matching its existing column order.  Columns the history
+	carries that a live snapshot cannot provide are left blank."""
+	columns = list(pd.read_csv(file_path, nrows = 0).columns)
+	for column in columns:
+		if column not in new_rows.columns:
+			new_rows[column] = ''
+	BTA.FormatFloat32(new_rows[columns]).to_csv(file_path, mode = 'a', header = False, index = False)
+	return None
+
+def AppendSnapshots(D, a, snapshots, DiurnalDic, weights):
+	"""Append the (snapshots) of roadway (a) to each of its processed histories and its live log, and carry its tail
+	state forward.  Returns the number of rows appended.  The roadway's build lock is held throughout, so that a
+	concurrent run neither appends the same snapshot again nor rebuilds the files being appended to."""
+	with locks.ArtifactLock(D, "pair_" + str(a)):
+		if not os.path.exists(HistoryPath(D, a, "CNW_TrafficHist_WeatherHist")):
+			return 0 #the roadway has not been built yet, the next full build will include these times
+		tail_state = GetTailState(D, a)
+		new_rows, tail_state = BuildAppendedRows(a, snapshots, tail_state, DiurnalDic, weights, D)
+		if len(new_rows) > 0:
+			for suffix in APPENDED_FILES:
+				AppendToCSV(new_rows, HistoryPath(D, a, suffix))
+			LogSnapshots(D, a, new_rows)
+			stats.UpdatePairStats(D, a, new_rows)
+		WriteTailState(D, a, tail_state)
+	return len(new_rows)
+
+def GetCurrentWeatherType(D, NOAA_df):
+	"""Return the current weather classification at the default weather site, the same site whose NCDC
+	record AttachWeatherData uses for the stored history.  If NOAA cannot be reached, assume clear skies."""
+	radio_code = NOAA_df.Code[list(NOAA_df.Location).index(D['w_def'])]
+	try:
+		return NCDC.GetRealTimeFromSite(D['WeatherURL'], radio_code)
+	except Exception, e:
+		print "Unable to read current weather for %s (%s), assuming clear skies" % (radio_code, e)
+		return ' '
+
+def AppendFromFeed(D, all_pair_ids, DiurnalDic, NOAA_df, weights):
+	"""Retrieve the live current.json snapshot and append every non-stale roadway speed to that roadway's
+	processed history."""
+	current_time, current_data = mass.RetrieveJSON(D['path_to_current'], 'current')
+	current_datetime = BTA.RoundToFive(mass.ConvertCurrentTimeToDatetime(current_time))
+	insert_time = round(NCDC.GetTimeFromDateTime(current_datetime, False) + NCDC.GetTimeFromDateTime(current_datetime, True), 3)
+	weather = GetCurrentWeatherType(D, NOAA_df)
+	appended = 0
+	for a in all_pair_ids.pair_id:
+		if str(a) in current_data and not current_data[str(a)]['stale']:
+			appended += AppendSnapshots(D, a, [(insert_time, float(current_data[str(a)]['speed']), weather)], DiurnalDic, weights)
+	print "Appended %d live observations to the historical archive" % appended
+	return appended
+
+if __name__ == "__main__":
+	D = BTA.HardCodedParameters()
+	environment_vars = BTA.GetJSON("","config.json")
+	for key in environment_vars:
+		D[key] = environment_vars[key]
+	NOAA_df = pd.read_csv(os.path.join(D['data_path'], D['NOAA_df_name']))
+	weights = list(pd.read_csv(os.path.join(D['data_path'],'DecaySeries.csv')).Weight)
+	all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
+	AppendFromFeed(D, all_pair_ids, BTA.GetJSON(D['update_path'], "DiurnalDictionary.txt"), NOAA_df, weights)
@@ -2,11 +2,92 @@
 Boston transportation data, including more detailed descriptions of the variables used."""
 
 import os
+import sys
+import datetime
 import pandas as pd
 import numpy as np
 import NCDC_WeatherProcessor as NCDC
 import ParseRealTimeMassDot as mass
+import BlueToadAnalysis as BTA
 import math
+import gc
+import json
+import hashlib
+import zipfile
+import SpatialIndex as spatial
+
+#compact in-memory and stored types.  insert_time holds YYYYDOY.fff and so needs the precision of a float64;
+#every other float fits a float32, and the handful of weather classifications are held as a categorical.
+ARCHIVE_DTYPES = {'pair_id' : 'int32', 'insert_time' : 'object', 'speed' : 'object'}
+SPLIT_FILE_DTYPES = {'pair_id' : 'int32', 'insert_time' : 'float64', 'speed' : 'object'} #before '\\N' speeds are removed
+PAIR_FILE_DTYPES = {'pair_id' : 'int32', 'insert_time' : 'float64', 'speed' : 'float32', 'time_of_day' : 'float32',
+					'day_of_week' : 'int8', 'Normalized_t' : 'float32', 'weather' : 'category',
+					'norm_traffic_hist' : 'float32', 'weather_hist' : 'float32'}
+ROAD_VOLUME_DTYPES = {'Loc ID' : 'int32', 'County' : 'category', 'Community' : 'category', 'On' : 'category', 'From' : 'object',
+					  'To' : 'object', 'Approach' : 'object', 'At' : 'category', 'Dir' : 'object', 'Latitude' : 'float64',
+					  'Longitude' : 'float64', 'Latest' : 'int32', 'Latest_Date' : 'int32'} #the names repeat across thousands of sensors
+
+def RowBytes(dtypes, text_widths):
+	"""The in-memory size of one row read with (dtypes): the item size of each typed column, and for each object
+	column a pointer to a str of its (text_widths) characters."""
+	return sum([np.dtype(np.intp).itemsize + sys.getsizeof(' ' * text_widths[c]) if t == 'object' else np.dtype(t).itemsize
+				for c, t in dtypes.items()])
+
+ARCHIVE_ROW_BYTES = RowBytes(ARCHIVE_DTYPES, {'insert_time' : 19, 'speed' : 5}) #'MM/DD/YYYY HH:MM:SS', and up to '99.99'
+
+def ReadPairFile(file_path, dtypes = PAIR_FILE_DTYPES, usecols = None):
+	"""Read a per-pair file at (file_path) with the compact (dtypes).  Missing weather is read as clear skies (' ')."""
+	df = pd.read_csv(file_path, dtype = dict((c, t) for c, t in dtypes.items() if t != 'category'), usecols = usecols)
+	return CompactFrame(df, dtypes)
+
+def CompactFrame(df, dtypes = PAIR_FILE_DTYPES):
+	"""Cast every column of (df) listed in (dtypes) to its compact type, in place, and return (df)."""
+	for column in df.columns:
+		if column not in dtypes or str(df[column].dtype) == dtypes[column]:
+			continue
+		if dtypes[column] == 'category':
+			df[column] = df[column].fillna(' ').astype('category')
+		else:
+			df[column] = df[column].astype(dtypes[column])
+	return df
+
+def StoredFloat(value):
+	"""Return (value), a float32, as the seven significant digits to which it is written to file."""
+	return float('%.7g' % value)
+
+def ArchiveChunkRows(D):
+	"""Rows of the BlueToad archive to read at once so that a chunk, and the per-pair copies made from it, stay within
+	a quarter of the memory ceiling (D)['memory_ceiling_mb'].  A ceiling of 0 reads the archive whole (None)."""
+	if D.get('memory_ceiling_mb', 0) <= 0:
+		return None
+	return max(10000, int(D['memory_ceiling_mb'] * 1048576 / 4 / ARCHIVE_ROW_BYTES))
+
+def DaySlots(insert_time):
+	"""Convert YYYYDOY.XXX (insert_time) values to absolute five-minute slots: the proleptic ordinal of the day times
+	288, plus the five-minute interval of the day.  Day-of-year counts from 0, as in YYYYDOY_to_Datetime."""
+	days = np.floor(insert_time).astype(int)
+	ordinals = {}
+	for day in np.unique(days):
+		ordinals[day] = datetime.date(day / 1000, 1, 1).toordinal() + day % 1000
+	return np.array([ordinals[d] for d in days], dtype = np.int64) * 288 + TimeSlots(insert_time - days)
+
+def TimeSlots(time_of_day):
+	"""The five-minute interval of the day, 0-287, of each three-decimal (time_of_day)."""
+	return np.mod(np.round(np.asarray(time_of_day, dtype = float) * 288).astype(int), 288)
+
+def HistoryGrid(slots, values):
+	"""Lay the (values) of a roadway's readings, taken at the absolute five-minute (slots) of DaySlots, over a dense
+	grid of every slot from the first reading to the last.  Returns {'first_slot', 'values' (NaN where there was no
+	reading), 'valid' (where there was), 'positions' (the grid position of each reading)}: grid position p + k is
+	always k five-minute steps after position p, however many readings are missing in between."""
+	slots = np.asarray(slots, dtype = np.int64)
+	first_slot = slots.min() if len(slots) > 0 else 0
+	positions = slots - first_slot
+	grid, valid = np.empty(positions.max() + 1 if len(slots) > 0 else 0), np.zeros(positions.max() + 1 if len(slots) > 0 else 0, dtype = bool)
+	grid.fill(np.nan)
+	grid[positions] = np.asarray(values, dtype = np.float64) #of two readings rounded to one slot, the later is kept
+	valid[positions] = True
+	return {'first_slot' : first_slot, 'values' : grid, 'valid' : valid, 'positions' : positions}
 
 def GetRoadVolume_Historical(file_path, Cleaned, file_name):
 	"""(Cleaned) is a boolean variable describing whether a pre-developed data frame has already
@@ -25,55 +106,138 @@ def GetRoadVolume_Historical(file_path, Cleaned, file_name):
 	Longitude: Longitude of sensor location, Ex: -71.25355, type = float
 	Latest: Most recent volume measurement in car/day, Ex: 5600, type = int
 	Latest_Date: Date at which the latest volume measurement was taken, Ex: '20060101', type = int
-	"""
 	
-	type_dict = {'Loc ID' : 'int',
-				'County' : 'str',
-				'Community' : 'str',
-				'On' : 'str',
-				'From' : 'str',
-				'To' : 'str',
-				'Approach' : 'str',
-				'At' : 'str',
-				'Dir' : 'float',
-				'Latitude' : 'float',
-				'Longitude' : 'float',
-				'Latest': 'int',
-				'Latest_Date' : 'int'}
-
-	days_in_month = np.cumsum([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]) #to covert into day_of_year		
-	leap_years = [1900 + 4*x for x in range(50)] #runs until 2096 for potential leap_years
-				
+	ReadRoadVolumes reads the same file with these types, from a binary cache of it.
+	"""
 	if not Cleaned: #if we are going to need to parse a given file
-		f = open(os.path.join(file_path, file_name)).readlines()
-		Road_Volumes_df = {}
-		col_list = f[0].strip().split(',') #maintains order, even if dictionaries do not
-		for col in col_list: #assume a header will define the names of columns
-			Road_Volumes_df[col] = [] #empty list to be filled by examples or filler
-		for line in f[1:]: #grab the data from the remaining rows in the file
-			split_line = line.strip().split(',')
-			for val,col in zip(split_line,col_list): #add an element to the list
-				var_type = type_dict[col] #is this an 'int', 'str', etc?
-				if val == "": #if this is blank, fill with a default for the var_type
-					if var_type == 'str':
-						Road_Volumes_df[col].append("no_data")
-					else: #whether the var is a float or int, a '-999' is acceptable
-						Road_Volumes_df[col].append(-999)
-				elif 'Date' in col: #if this is a date that requires conversion
-					Road_Volumes_df[col].append(SlashDateToNumerical(val, days_in_month, leap_years))
-				else:
-					Road_Volumes_df[col].append(val)
-		Road_Volumes_df = pd.DataFrame(Road_Volumes_df)
+		Road_Volumes_df = ParseRoadVolumes(os.path.join(file_path, file_name))
 		#remove '.csv', and add 'Cleaned'
-		Road_Volumes_df.to_csv(os.path.join(file_path, file_name + "_Cleaned.csv"),
-								index = False) 
+		BTA.WriteCSVAtomic(Road_Volumes_df, os.path.join(file_path, file_name + "_Cleaned.csv"))
 		return Road_Volumes_df
 	else: #if the file is already cleaned - simply read it into memory and return it
-		return pd.read_csv(file_path, file_name + "_Cleaned.csv")
-		
-def GetBlueToad(D, file_name):
+		return pd.read_csv(os.path.join(file_path, file_name + "_Cleaned.csv"))
+
+def VolumeDates(dates):
+	"""Convert MM/DD/YYYY or YYYY-MM-DD (dates) to YYYYDOY, as SlashDateToNumerical does, parsing each distinct date
+	once.  Dates already numerical (YYYYMMDD) are kept as they are, and blank dates are -999."""
+	dates = pd.Series(dates).fillna("").astype(str).str.strip()
+	lookup = {"" : -999}
+	for separator, date_format in [("/", "%m/%d/%Y"), ("-", "%Y-%m-%d")]:
+		distinct = pd.Series(dates[dates.str.contains(separator)].unique())
+		parsed = pd.to_datetime(distinct, format = date_format)
+		lookup.update(zip(distinct, parsed.dt.year * 1000 + parsed.dt.dayofyear - 1)) #thus, the first day of the year is 0
+	for date in dates.unique():
+		if date not in lookup:
+			lookup[date] = int(float(date))
+	return dates.map(lookup).astype('int32').values
+
+def ParseRoadVolumes(source_path):
+	"""Read the road volume file at (source_path) with the types of ROAD_VOLUME_DTYPES.  Blank strings are read as
+	"no_data" and blank numbers as -999, as GetRoadVolume_Historical always filled them."""
+	volumes = pd.read_csv(source_path, dtype = object, skipinitialspace = True)
+	for column in volumes.columns:
+		dtype = ROAD_VOLUME_DTYPES.get(column, 'object')
+		if 'Date' in column: #if this is a date that requires conversion
+			volumes[column] = VolumeDates(volumes[column])
+		elif dtype in ['object', 'category']:
+			volumes[column] = volumes[column].fillna("no_data").astype(dtype) #categories hold each name once
+		else:
+			volumes[column] = pd.to_numeric(volumes[column], errors = 'coerce').fillna(-999).astype(dtype)
+	return volumes
+
+def VolumeKey(source_path):
+	"""The key of the road volume file at (source_path): the start of the sha1 of its contents."""
+	with open(source_path, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()[:10]
+
+def VolumeCachePath(file_path, file_name, key):
+	return os.path.join(file_path, os.path.splitext(file_name)[0] + "_Typed_" + key + ".pkl")
+
+def ReadRoadVolumes(file_path, file_name):
+	"""Return the road volume file (file_name) in (file_path), typed by ParseRoadVolumes.  The typed frame is cached
+	beside the file, keyed by its contents, so it is only parsed again once the file changes."""
+	key = VolumeKey(os.path.join(file_path, file_name))
+	cache_path = VolumeCachePath(file_path, file_name, key)
+	if os.path.exists(cache_path):
+		return pd.read_pickle(cache_path)
+	volumes = ParseRoadVolumes(os.path.join(file_path, file_name))
+	temp_path = cache_path + ".tmp" + str(os.getpid())
+	volumes.to_pickle(temp_path)
+	os.rename(temp_path, cache_path)
+	stale_prefix = os.path.splitext(file_name)[0] + "_Typed_"
+	for cached in os.listdir(file_path): #the caches of earlier versions of the file
+		if cached.startswith(stale_prefix) and cached.endswith(".pkl") and cached != os.path.basename(cache_path):
+			os.remove(os.path.join(file_path, cached))
+	return volumes
+
+def JoinVolumeSensors(volumes, RoadwayCoordsDic, max_miles):
+	"""Join every roadway of (RoadwayCoordsDic) to its nearest volume sensor in (volumes), if one lies within
+	(max_miles) of the roadway's average lat/lon.  Returns {pair_id : {'Loc ID', 'On', 'At', 'miles', 'Latest',
+	'Latest_Date'}}.  A sensor listed more than once counts by its latest measurement."""
+	volumes = volumes[(volumes.Latest >= 0)].sort_values('Latest_Date').drop_duplicates('Loc ID', keep = 'last')
+	index = spatial.BuildIndex(list(volumes['Loc ID']), volumes.Latitude, volumes.Longitude)
+	roads = sorted(RoadwayCoordsDic.keys())
+	if len(index['ids']) == 0 or len(roads) == 0:
+		return {}
+	distances = spatial.GreatCircleMatrix(index, [RoadwayCoordsDic[r]['Lat'] for r in roads], [RoadwayCoordsDic[r]['Lon'] for r in roads])
+	sensors = volumes.set_index('Loc ID')
+	joined = {}
+	for row, closest in enumerate(np.argmin(distances, axis = 1)): #all roadways in one batch
+		r, miles = roads[row], distances[row, closest]
+		if miles > max_miles:
+			continue
+		sensor = sensors.loc[index['ids'][closest]]
+		joined[r] = {'Loc ID' : int(index['ids'][closest]), 'On' : str(sensor.On), 'At' : str(sensor.At), 'miles' : round(float(miles), 3),
+					 'Latest' : int(sensor.Latest), 'Latest_Date' : int(sensor.Latest_Date)}
+	return joined
+
+def PairVolumes(D, RoadwayCoordsDic = None):
+	"""Return the nearest volume sensor of every roadway, as JoinVolumeSensors, for the volume file D['volume_name']
+	in the data directory, or {} if there is none.  The join is kept in update/PairVolumes.json, keyed by the volume
+	file, the roadway coordinates and D['volume_max_miles'], so the volumes of a pair are read without rescanning."""
+	if not os.path.exists(os.path.join(D['data_path'], D['volume_name'])):
+		return {}
+	if RoadwayCoordsDic is None:
+		RoadwayCoordsDic = BTA.GetJSON(D['data_path'], D['CoordsDic_name'])
+	key = VolumeKey(os.path.join(D['data_path'], D['volume_name'])) + "_" + hashlib.sha1(json.dumps([RoadwayCoordsDic, D['volume_max_miles']],
+																									  sort_keys = True)).hexdigest()[:10]
+	join_path = os.path.join(D['update_path'], "PairVolumes.json")
+	if os.path.exists(join_path):
+		joined = BTA.GetJSON("", join_path)
+		if joined['key'] == key:
+			return joined['pairs']
+	pairs = JoinVolumeSensors(ReadRoadVolumes(D['data_path'], D['volume_name']), RoadwayCoordsDic, D['volume_max_miles'])
+	BTA.WriteJSON({'key' : key, 'pairs' : pairs}, D['update_path'], "PairVolumes.json")
+	return pairs
+
+def ArchivePath(D, file_name):
+	"""The BlueToad archive (file_name): its .zip if D['bluetoad_type'] is 'zip' and it has been downloaded, or else
+	its .csv."""
+	zip_path = os.path.join(D['bt_path'], file_name + ".zip")
+	if "zip" in D['bluetoad_type'] and os.path.exists(zip_path):
+		return zip_path
+	return os.path.join(D['bt_path'], file_name + ".csv")
+
+def ReadArchive(D, file_name, **kwargs):
+	"""pd.read_csv the BlueToad archive (file_name) with (kwargs).  From a .zip, the .csv within it is decompressed
+	as it is read, in chunks if (kwargs) give a chunksize, rather than extracted to disk first."""
+	archive_path = ArchivePath(D, file_name)
+	if not archive_path.endswith(".zip"):
+		return pd.read_csv(archive_path, **kwargs)
+	with zipfile.ZipFile(archive_path) as archive:
+		member = [name for name in archive.namelist() if name.endswith(".csv")][0]
+		stream = archive.open(member) #has its own handle on the file, and so outlives the ZipFile
+	if kwargs.get('chunksize') is not None:
+		return pd.read_csv(stream, **kwargs) #closed once the last chunk is read and the reader released
+	try:
+		return pd.read_csv(stream, **kwargs)
+	finally:
+		stream.close()
+
+def GetBlueToad(D, file_name, rebuild_ids = [], only_listed = False):
 	"""(D) contains the relative path to the cleaned or uncleaned file. (file_name) is the name
-	of the file within that directory.
+	of the file within that directory.  Pair_ids listed in (rebuild_ids) are split out again even
+	if their cleaned file already exists; if (only_listed), no other pair_id is split, even if it has no cleaned file.
 	
 	pair_id: Identifies a pair of bluetooth sensors in a particular direction, Ex: 60, type = int
 	insert_time: The time at which the measurement was made, Ex: 20120613.609, type = float
@@ -91,31 +255,68 @@ def GetBlueToad(D, file_name):
 	#if we haven't found generated unique ids to be used to break the massive data file into its constituents
 	if os.path.exists(os.path.join(D['data_path'], "all_pair_ids.csv")): 	
 		all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
+	elif ArchiveChunkRows(D) is not None: #under a memory ceiling, gather the ids one chunk at a time
+		all_pair_ids = []
+		for chunk in ReadArchive(D, file_name, dtype = ARCHIVE_DTYPES, usecols = ['pair_id'],
+								 chunksize = ArchiveChunkRows(D)):
+			all_pair_ids = mass.unique(all_pair_ids + list(chunk.pair_id))
+		all_pair_ids = pd.DataFrame({"pair_id" : all_pair_ids})
+		BTA.WriteCSVAtomic(all_pair_ids, os.path.join(D['data_path'], "all_pair_ids.csv"))
 	else:
 		if not bt_read: 
-			BlueToad_df = pd.read_csv(os.path.join(D['bt_path'], file_name + ".csv")); bt_read = True
+			BlueToad_df = ReadArchive(D, file_name, dtype = ARCHIVE_DTYPES); bt_read = True
 		all_pair_ids = mass.unique(BlueToad_df.pair_id)
 		all_pair_ids = pd.DataFrame({"pair_id" : all_pair_ids})
-		all_pair_ids.to_csv(os.path.join(D['data_path'], "all_pair_ids.csv"), index = False)
+		BTA.WriteCSVAtomic(all_pair_ids, os.path.join(D['data_path'], "all_pair_ids.csv"))
+	to_split = [a for a in all_pair_ids.pair_id if a in rebuild_ids or not only_listed and not
+				os.path.exists(os.path.join(D['update_path'], "IndividualFiles", file_name + "_" + str(a) + "_Cleaned.csv"))]
+	if len(to_split) > 0 and ArchiveChunkRows(D) is not None:
+		return SplitBlueToadChunked(D, file_name, to_split, days_in_month, leap_years)
 	#Now, convert our dates to the relevant format
-	for a in all_pair_ids.pair_id:
+	for a in to_split: #if the cleaned file doesn't exist, perform the cleaning and write it to file
 		out_path = os.path.join(D['update_path'], "IndividualFiles", file_name + "_" + str(a) + "_Cleaned.csv") #where would the clean file be?
-		if not os.path.exists(out_path): #if the cleaned file doesn't exist, perform the cleaning and write it to file
-			if not bt_read: 
-				BlueToad_df = pd.read_csv(os.path.join(D['bt_path'], file_name + ".csv")); bt_read = True
-			sub_bt = BlueToad_df[BlueToad_df.pair_id == a]
-			cleaned_dates = []
-			print "Converting date for site %d" % a
-			for i in sub_bt.insert_time: 
-				slash_date, colon_time = i.split(" ")
-				num_date = SlashDateToNumerical(slash_date, days_in_month, leap_years) + ColonTimeToDecimal(colon_time)
-				num_date = NCDC.RoundToNearestNth(num_date, 288, 3)
-				cleaned_dates.append(num_date)
-			sub_bt.insert_time = cleaned_dates #replace with suitable numerical, ordinal dates
-			del(cleaned_dates) #to conserve memory
-			sub_bt.to_csv(out_path, index = False)
+		if not bt_read: 
+			BlueToad_df = ReadArchive(D, file_name, dtype = ARCHIVE_DTYPES); bt_read = True
+		sub_bt = BlueToad_df[BlueToad_df.pair_id == a]
+		print "Converting date for site %d" % a
+		sub_bt.insert_time = ConvertDates(sub_bt.insert_time, days_in_month, leap_years) #replace with suitable numerical, ordinal dates
+		BTA.WriteCSVAtomic(sub_bt, out_path)
 	return None	
 
+def ConvertDates(insert_times, days_in_month, leap_years):
+	"""Convert 'MM/DD/YYYY HH:MM:SS' (insert_times) to YYYYDOY.fff, rounded to the nearest five minutes."""
+	cleaned_dates = []
+	for i in insert_times: 
+		slash_date, colon_time = i.split(" ")
+		num_date = SlashDateToNumerical(slash_date, days_in_month, leap_years) + ColonTimeToDecimal(colon_time)
+		cleaned_dates.append(NCDC.RoundToNearestNth(num_date, 288, 3))
+	return cleaned_dates
+
+def SplitBlueToadChunked(D, file_name, to_split, days_in_month, leap_years):
+	"""Split the archive into the per-pair files of (to_split) while holding only one chunk of it in memory: each
+	chunk's rows are appended to a temporary file per pair, and the files are renamed into place once the whole
+	archive has been read, so an interrupted split never leaves a partial file that looks complete."""
+	out_paths = dict((a, os.path.join(D['update_path'], "IndividualFiles", file_name + "_" + str(a) + "_Cleaned.csv")) for a in to_split)
+	temp_paths = dict((a, out_paths[a] + ".tmp" + str(os.getpid())) for a in to_split)
+	columns, started = None, set()
+	for ind, chunk in enumerate(ReadArchive(D, file_name, dtype = ARCHIVE_DTYPES,
+											chunksize = ArchiveChunkRows(D))):
+		print "Splitting chunk %d of the BlueToad archive" % ind
+		columns = list(chunk.columns)
+		chunk = chunk[chunk.pair_id.isin(to_split)]
+		for a, sub_bt in chunk.groupby('pair_id'):
+			sub_bt = sub_bt.copy()
+			sub_bt.insert_time = ConvertDates(sub_bt.insert_time, days_in_month, leap_years)
+			sub_bt.to_csv(temp_paths[a], mode = 'a' if a in started else 'w', header = a not in started, index = False)
+			started.add(a)
+		del(chunk); gc.collect() #to conserve memory
+	for a in to_split:
+		if a not in started: #no rows for this pair_id, write the header alone
+			pd.DataFrame(columns = columns).to_csv(temp_paths[a], index = False)
+	for a in to_split:
+		os.rename(temp_paths[a], out_paths[a])
+	return None
+
 def CleanBlueToad(BlueToad_df, file_path, file_name):
 	"""Having converted BlueToad dates, remove those rows from the data frame in which the listed
 	travel time is '\\N'."""
@@ -124,19 +325,18 @@ def CleanBlueToad(BlueToad_df, file_path, file_name):
 	mask = BlueToad_df.applymap(lambda x: x in ["\\N"]) #we can add to this if needed...basically, 
 	#the "mask" removes any row that contains anything in the banned set
 	BlueToad_df = BlueToad_df[-mask.any(axis=1)] #not numbers? remove 'em!
-	BlueToad_df.to_csv(os.path.join(file_path, file_name + "_Cleaned.csv"),
-						index = False)
+	BTA.WriteCSVAtomic(BlueToad_df, os.path.join(file_path, file_name + "_Cleaned.csv"))
 	return BlueToad_df
 	
 def FloatConvert(BlueToad_df, file_path, file_name):
 	"""Convert the travel_time column from strings to floats."""
 	print "Reformatting Travel Times As Floats...for site %d" % int(BlueToad_df.pair_id[0:1])
-	BlueToad_df.speed = BlueToad_df.speed.astype('float64')
+	BlueToad_df.speed = BlueToad_df.speed.astype(PAIR_FILE_DTYPES['speed'])
 	print "Rounding time of days..."
 	BlueToad_df['time_of_day'] = [round(math.modf(BlueToad_df.insert_time[i])[0],3) for i in BlueToad_df.index]
+	BlueToad_df = CompactFrame(BlueToad_df)
 	print "Writing to File"
-	BlueToad_df.to_csv(os.path.join(file_path, file_name + "_Cleaned.csv"),
-						index = False)
+	BTA.WriteCSVAtomic(BlueToad_df, os.path.join(file_path, file_name + "_Cleaned.csv"))
 	return BlueToad_df
 
 def SlashDateToNumerical(date, days_in_month, leap_years):
@@ -0,0 +1,185 @@
+"""This module compiles every lookup a prediction run needs into one versioned model bundle: the diurnal cycles of
+every roadway as a single memory-mappable array, and the maximum speeds, closest weather sites, roadway coordinates
+and directions, decay weights, pair_ids, and NOAA site list as one small JSON.  A prediction run maps the bundle
+instead of parsing each dictionary, and the last few versions are kept so that a bad build can be rolled back by
+pointing CURRENT at an earlier one."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import numpy as np
+
+DIURNAL_NAME, LOOKUPS_NAME, CURRENT_NAME = "diurnal.npy", "lookups.json", "CURRENT"
+
+class DiurnalMapping(object):
+	"""Reads like the DiurnalDic built by GenerateDiurnalDic, {'<pair_id>_<day>' : {'<pct>' : [288 speeds]}}, but
+	draws each entry from the memory-mapped (diurnal) array of shape (roads, 7, percentiles, 288) on first use.
+	Entries added afterwards, such as the cycles borrowed from neighbouring roadways, are held alongside it."""
+	def __init__(self, diurnal, roads, pcts, present):
+		self.diurnal, self.pcts, self.present = diurnal, pcts, present
+		self.road_rows = dict((r, ind) for ind, r in enumerate(roads))
+		self.entries = {}
+
+	def __contains__(self, key):
+		return key in self.entries or self.Stored(key)
+
+	def Stored(self, key):
+		"""Whether (key) is one of the road/day pairs held in the bundle itself."""
+		road, day = key.rsplit("_", 1)
+		return road in self.road_rows and day.isdigit() and int(day) < 7 and bool(self.present[self.road_rows[road], int(day)])
+
+	def __getitem__(self, key):
+		if key not in self.entries:
+			if key not in self:
+				raise KeyError(key)
+			road, day = key.rsplit("_", 1)
+			cycles = self.diurnal[self.road_rows[road], int(day)]
+			self.entries[key] = dict((p, cycles[ind].tolist()) for ind, p in enumerate(self.pcts))
+		return self.entries[key]
+
+	def __setitem__(self, key, value):
+		self.entries[key] = value
+
+	def keys(self):
+		stored = [r + "_" + str(day) for r in self.road_rows for day in xrange(7) if self.present[self.road_rows[r], day]]
+		return stored + [k for k in self.entries if not self.Stored(k)]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+def BundlePath(D, version = None):
+	"""The directory holding every bundle, or the one holding (version)."""
+	return D['bundle_path'] if version is None else os.path.join(D['bundle_path'], version)
+
+def ListVersions(D):
+	"""Every complete bundle version, oldest first.  Versions are named by build time, so they sort in order."""
+	if not os.path.exists(BundlePath(D)):
+		return []
+	return sorted([v for v in os.listdir(BundlePath(D)) if os.path.exists(os.path.join(BundlePath(D, v), LOOKUPS_NAME))])
+
+def CurrentVersion(D):
+	"""The version CURRENT points to, or None if no bundle has been compiled."""
+	current_path = os.path.join(BundlePath(D), CURRENT_NAME)
+	if not os.path.exists(current_path):
+		return None
+	version = open(current_path).read().strip()
+	return version if version in ListVersions(D) else None
+
+def SetCurrent(D, version):
+	"""Point CURRENT at (version), via a temporary file and a rename so readers never see a partial name."""
+	current_path = os.path.join(BundlePath(D), CURRENT_NAME)
+	temp_path = current_path + ".tmp" + str(os.getpid())
+	with open(temp_path, 'wb') as outfile:
+		outfile.write(version + "\n")
+	os.rename(temp_path, current_path)
+	return version
+
+def DiurnalArray(DiurnalDic, pct_tile_list):
+	"""Pack (DiurnalDic) into an array of shape (roads, 7, percentiles, 288), with a (roads, 7) mask of the
+	road/day pairs present.  Diurnal cycles are whole speeds, so float32 holds them exactly."""
+	pcts = [str(p) for p in pct_tile_list]
+	roads = sorted(set([k.rsplit("_", 1)[0] for k in DiurnalDic]))
+	diurnal = np.zeros((len(roads), 7, len(pcts), 288), dtype = np.float32)
+	present = np.zeros((len(roads), 7), dtype = bool)
+	for r, road in enumerate(roads):
+		for day in xrange(7):
+			diurnal_key = road + "_" + str(day)
+			if diurnal_key in DiurnalDic:
+				present[r, day] = True
+				for ind, p in enumerate(pcts):
+					diurnal[r, day, ind, :] = DiurnalDic[diurnal_key][p]
+	return roads, pcts, diurnal, present
+
+def BuildLookups(D, MaximumDic, NOAADic, RoadwayCoordsDic, road_directions, weights, all_pair_ids, NOAA_df):
+	"""Everything other than the diurnal cycles that a prediction run reads from file, as one json-able dictionary."""
+	return {'MaximumDic' : MaximumDic, 'NOAADic' : NOAADic, 'RoadwayCoordsDic' : RoadwayCoordsDic,
+			'road_directions' : road_directions, 'weights' : [float(w) for w in weights],
+			'pair_ids' : [int(a) for a in all_pair_ids.pair_id],
+			'NOAA_df' : dict((c, NOAA_df[c].tolist()) for c in NOAA_df.columns)}
+
+def CompileBundle(D, DiurnalDic, MaximumDic, NOAADic, RoadwayCoordsDic, road_directions, weights, all_pair_ids, NOAA_df):
+	"""Write a new bundle version and point CURRENT at it, unless its contents are identical to the current
+	version's.  The version is written under a temporary name and renamed into place, then all but the last
+	(D)['bundle_keep'] versions are removed.  Returns the version now current."""
+	roads, pcts, diurnal, present = DiurnalArray(DiurnalDic, D['pct_tile_list'])
+	lookups = BuildLookups(D, MaximumDic, NOAADic, RoadwayCoordsDic, road_directions, weights, all_pair_ids, NOAA_df)
+	lookups.update({'roads' : roads, 'pcts' : pcts, 'present' : present.tolist()})
+	content_hash = hashlib.sha1(json.dumps(lookups, sort_keys = True) + diurnal.tostring()).hexdigest()
+	current = CurrentVersion(D)
+	if current is not None and ReadLookups(D, current).get('content_hash') == content_hash:
+		return current
+	version = time.strftime("%Y%m%dT%H%M%S") + "-" + content_hash[:8]
+	lookups.update({'version' : version, 'content_hash' : content_hash, 'built' : time.strftime("%Y-%m-%dT%H:%M:%S")})
+	temp_path = BundlePath(D, version) + ".tmp" + str(os.getpid())
+	os.makedirs(temp_path)
+	np.save(os.path.join(temp_path, DIURNAL_NAME), diurnal)
+	with open(os.path.join(temp_path, LOOKUPS_NAME), 'wb') as outfile:
+		json.dump(lookups, outfile)
+	os.rename(temp_path, BundlePath(D, version))
+	print "Compiled model bundle %s" % version
+	SetCurrent(D, version)
+	PruneVersions(D)
+	return version
+
+def PruneVersions(D):
+	"""Remove all but the newest (D)['bundle_keep'] versions, never removing the current one."""
+	current = CurrentVersion(D)
+	for version in ListVersions(D)[:-D['bundle_keep']]:
+		if version != current:
+			shutil.rmtree(BundlePath(D, version))
+	return None
+
+def Rollback(D, version = None):
+	"""Point CURRENT at (version), or at the version before the current one if none is given."""
+	versions = ListVersions(D)
+	if version is None:
+		current = CurrentVersion(D)
+		earlier = [v for v in versions if current is None or v < current]
+		if len(earlier) == 0:
+			raise ValueError("No bundle older than %s to roll back to" % current)
+		version = earlier[-1]
+	elif version not in versions:
+		raise ValueError("No bundle version %s in %s" % (version, BundlePath(D)))
+	print "Rolling back to model bundle %s" % version
+	return SetCurrent(D, version)
+
+def ReadLookups(D, version):
+	return json.load(open(os.path.join(BundlePath(D, version), LOOKUPS_NAME)))
+
+def LoadBundle(D, version = None):
+	"""Return the lookups of (version), by default the current one, with the diurnal cycles memory-mapped under
+	'DiurnalDic' as a DiurnalMapping."""
+	version = CurrentVersion(D) if version is None else version
+	if version is None:
+		raise ValueError("No model bundle has been compiled in %s" % BundlePath(D))
+	lookups = ReadLookups(D, version)
+	diurnal = np.load(os.path.join(BundlePath(D, version), DIURNAL_NAME), mmap_mode = 'r')
+	lookups['DiurnalDic'] = DiurnalMapping(diurnal, lookups['roads'], lookups['pcts'], np.array(lookups['present'], dtype = bool))
+	return lookups
+
+if __name__ == "__main__":
+	import BlueToadAnalysis as BTA
+	D = BTA.HardCodedParameters()
+	environment_vars = BTA.GetJSON("","config.json") if os.path.exists("config.json") else {}
+	for key in environment_vars:
+		D[key] = environment_vars[key]
+	parser = argparse.ArgumentParser()
+	parser.add_argument("action", choices = ['list', 'rollback'], help = "list the bundle versions, or roll back to an earlier one")
+	parser.add_argument("-v", "--version", help = "the version to roll back to, by default the one before the current version", type = str, default = None)
+	args = parser.parse_args()
+	if args.action == 'list':
+		current = CurrentVersion(D)
+		for version in ListVersions(D):
+			print ("* " if version == current else "  ") + version
+	else:
+		try:
+			Rollback(D, args.version)
+		except ValueError, e:
+			print e; sys.exit(1)
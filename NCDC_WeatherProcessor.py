@@ -7,16 +7,15 @@ import os
 import pandas as pd
 import numpy as np
 import BlueToadAnalysis as BTA
-import math
-import urllib2 as url
-import BeautifulSoup as SOUP
-import json
 import datetime as dt
+import SpatialIndex as spatial
 
 global days_in_months 
 global leaps
+global site_coord_indices
 days_in_months = np.cumsum([31,28,31,30,31,30,31,31,30,31,30,31]) #for date conversion
 leaps = [1900 + 4 * x for x in range(50)] #for leap year determination
+site_coord_indices = {} #spatial indices of weather site coordinate files, so each file is read only once
 
 def GetTimeFromDateTime(now, time = True, d_i_m = days_in_months, ls = leaps):
 	"""Given a (now) from datetime.datetime.now, return the standard YYYYDOY.XXX 
@@ -102,6 +101,7 @@ def RealTimeWeather(D, NOAADic, NOAA_df, pairs_conds, weights):
 	return pairs_conds	
 		
 def GetHistoricalFromSite(weather_url, radio_code, steps_back, weather_cost_facs, weights, NOAA_site_conditions):
+	import urllib2 as url, BeautifulSoup as SOUP #only needed for live weather
 	page = url.urlopen(weather_url + radio_code + ".html")
 	parsed_page = SOUP.BeautifulSoup(page)
 	table_data = parsed_page.findAll('td')
@@ -174,6 +174,7 @@ def GetFirstValid_td_index(table_data):
 def GetRealTimeFromSite(weather_url, radio_code):
 	"""Given a four-letter (radio_code) string for NOAA, return the current weather conditions as one of four classifications
 	from the site within the (weather_url) webspace."""
+	import urllib2 as url, BeautifulSoup as SOUP #only needed for live weather
 	page = url.urlopen(weather_url + radio_code + ".rss")
 	parsed_page = SOUP.BeautifulSoup(page)
 	titles = parsed_page.findAll('title') #grab the bullet points from the key page	
@@ -212,9 +213,15 @@ def ConvertWeatherDate(w_date, w_time, N, dec, d_i_m = days_in_months, ls = leap
 
 def ShortestDist(LatLon_df, Lat, Lon):
 	"""Given a (Lat), a (Lon) and a (LatLon_df) containing columns of lats and lons, return the row
-	of that data frame corresponding to the site closest to Lat,Lon."""
-	distances = [(Lat-x)**2 + (Lon-y)**2 for x,y in zip(LatLon_df.Lat, LatLon_df.Lon)]
-	return distances.index(np.min(distances))
+	of that data frame corresponding to the site closest to Lat,Lon in great-circle terms."""
+	return int(np.argmin(spatial.GreatCircleMatrix(spatial.BuildIndex(range(len(LatLon_df)), LatLon_df.Lat, LatLon_df.Lon), [Lat], [Lon])[0]))
+
+def GetSiteCoordIndex(data_path):
+	"""Return the spatial index of WeatherSite_Coords.csv in (data_path), reading the file only on first use."""
+	if data_path not in site_coord_indices:
+		w_site_coords = pd.read_csv(os.path.join(data_path, "WeatherSite_Coords.csv"))
+		site_coord_indices[data_path] = spatial.BuildIndex(list(w_site_coords.Site), w_site_coords.Lat, w_site_coords.Lon)
+	return site_coord_indices[data_path]
 	
 def GetWSiteName(D, a, RoadwayCoordsDic):
 	"""For a given pair_id (a), with the relevant dictionary to store paths (D), either we already
@@ -224,10 +231,9 @@ def GetWSiteName(D, a, RoadwayCoordsDic):
 	if D['weather_site_name'] != 'closest': #i.e. if this is already filled with a site name
 		return D['weather_site_name']
 	else: #we need to choose the appropriate NCDC climate gauge
-		w_site_coords = pd.read_csv(os.path.join(D['data_path'],"WeatherSite_Coords.csv"))
-		if str(a) in RoadwayCoordsDic.keys(): #if these roadways' coordinates are listed
+		if str(a) in RoadwayCoordsDic: #if these roadways' coordinates are listed
 			lat, lon = RoadwayCoordsDic[str(a)]['Lat'], RoadwayCoordsDic[str(a)]['Lon']
-			return w_site_coords.Site[ShortestDist(w_site_coords, lat, lon)]
+			return spatial.Nearest(GetSiteCoordIndex(D['data_path']), [lat], [lon])[0]
 		else:
 			return D['weather_site_default']
 
@@ -238,26 +244,25 @@ def BuildClosestNOAADic(NOAA_df, pair_ids, D):
 	shall be chosen from (D)."""
 	RoadwayCoords = BTA.GetJSON(D['data_path'], D['CoordsDic_name']);
 	NOAA_site_dic = {}
-	for p in pair_ids:
-		NOAA_site_dic[str(p)] = ChooseClosestSite(p, RoadwayCoords, NOAA_df, D) #whichever weather site is closest in Euclidean terms
-	with open(os.path.join(D['update_path'], 'ClosestWeatherSite.txt'), 'wb') as outfile:
-		json.dump(NOAA_site_dic, outfile)
+	located = [str(p) for p in pair_ids if str(p) in RoadwayCoords]
+	closest_sites = spatial.Nearest(spatial.BuildIndex(list(NOAA_df['Location']), NOAA_df.Lat, NOAA_df.Lon),
+									[RoadwayCoords[p]['Lat'] for p in located], [RoadwayCoords[p]['Lon'] for p in located])
+	for p in pair_ids: #without coordinates, use the default site
+		NOAA_site_dic[str(p)] = D['weather_site_default']
+	for p, site in zip(located, closest_sites): #whichever weather site is closest in great-circle terms, for all roadways at once
+		NOAA_site_dic[p] = site if site is not None else D['weather_site_default']
+	BTA.WriteJSON(NOAA_site_dic, D['update_path'], 'ClosestWeatherSite.txt')
 	return NOAA_site_dic
 	
 def ChooseClosestSite(roadway, RoadwayCoords, NOAA_df, D):
 	"""Given a (roadway), a dictionary (RoadwayCoords) containing the lat/lon of roadways, a dictionary (D) containing the default 
 	location to use if the roadway's coordinates are unknown, and a list of NOAA sites and their lat/lon coordinates (NOAA_duf)
-	return the closest site in terms of euclidian distance."""
-	if str(roadway) not in RoadwayCoords.keys(): #if this roadway does not contain coordinates for use, return the default site	
+	return the closest site in great-circle terms.  BuildClosestNOAADic answers this for all roadways at once."""
+	if str(roadway) not in RoadwayCoords: #if this roadway does not contain coordinates for use, return the default site	
 		return D['weather_site_default']
-	else:
-		road_lat, road_lon = RoadwayCoords[str(roadway)]['Lat'], RoadwayCoords[str(roadway)]['Lon']
-	min_dist = 9999; closest_site = D['weather_site_default']
-	for lat, lon, site in zip(NOAA_df.Lat, NOAA_df.Lon, NOAA_df['Location']):
-		euclidian_dist = math.sqrt((lat-road_lat)**2 + (lon-road_lon)**2)
-		if euclidian_dist < min_dist: #if this is the closest site we've seen
-			min_dist = euclidian_dist; closest_site = site
-	return closest_site
+	road_lat, road_lon = RoadwayCoords[str(roadway)]['Lat'], RoadwayCoords[str(roadway)]['Lon']
+	closest_site = spatial.Nearest(spatial.BuildIndex(list(NOAA_df['Location']), NOAA_df.Lat, NOAA_df.Lon), [road_lat], [road_lon])[0]
+	return closest_site if closest_site is not None else D['weather_site_default']
 	
 			
 def GetWeatherData(weather_dir, site_name):
@@ -268,7 +273,8 @@ def GetWeatherData(weather_dir, site_name):
 	else: #if the relevant .csv file must be generated (generally a 5-10 second process)
 		file_list = GetRelevantFileList(site_name, weather_dir)
 		full_site = BuildSiteDataFrame(weather_dir, file_list)
-		full_site.to_csv(os.path.join(weather_dir, site_name + "_NCDC.csv"), index = False)
+		BTA.WriteCSVAtomic(full_site, os.path.join(weather_dir, site_name + "_NCDC.csv"))
+		return full_site
 	
 if __name__ == "__main__":
 	script_name, site_name = sys.argv
@@ -0,0 +1,79 @@
+"""This module keeps a catalog of summary statistics for every pair_id: its number of readings, min/max/mean speed,
+first and last insert_time, readings per day of the week, and the fraction of '\\N' readings dropped in cleaning.
+The statistics are computed once as each pair is cleaned and carried forward as live readings are appended, so
+that the maximum speeds, the diurnal default, and the decision to skip pairs with too little data never require
+another pass over the data."""
+
+import os
+import numpy as np
+import BlueToadAnalysis as BTA
+import MassDotDataTypes as data
+
+def StatsPath(D, a):
+	"""Where the statistics of roadway (a) are stored."""
+	return os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Stats.json")
+
+def ComputePairStats(sub_bt, raw_rows = None):
+	"""Summarize the cleaned (sub_bt) of one roadway.  (raw_rows) is the number of rows before '\\N' readings were
+	removed, if known."""
+	count = len(sub_bt)
+	day_counts = np.bincount(np.asarray(sub_bt.day_of_week, dtype = int), minlength = 7) if count > 0 else np.zeros(7, dtype = int)
+	return {'count' : count,
+			'min_speed' : data.StoredFloat(np.min(sub_bt.speed)) if count > 0 else None,
+			'max_speed' : data.StoredFloat(np.max(sub_bt.speed)) if count > 0 else None,
+			'mean_speed' : float(np.mean(sub_bt.speed)) if count > 0 else None,
+			'first_insert_time' : float(np.min(sub_bt.insert_time)) if count > 0 else None,
+			'last_insert_time' : float(np.max(sub_bt.insert_time)) if count > 0 else None,
+			'day_of_week_counts' : [int(c) for c in day_counts[:7]],
+			'raw_count' : raw_rows,
+			'dropped_fraction' : round(float(raw_rows - count) / raw_rows, 6) if raw_rows else None}
+
+def WritePairStats(D, a, pair_stats):
+	BTA.WriteJSON(pair_stats, "", StatsPath(D, a))
+	return pair_stats
+
+def GetPairStats(D, a):
+	"""Return the statistics of roadway (a).  Pairs cleaned before the catalog existed are summarized once from
+	their cleaned file (without a dropped fraction); pairs not yet cleaned return None."""
+	if os.path.exists(StatsPath(D, a)):
+		return BTA.GetJSON("", StatsPath(D, a))
+	cleaned_path = os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned.csv")
+	if not os.path.exists(cleaned_path) or 'day_of_week' not in open(cleaned_path).readline(): #not yet cleaned
+		return None
+	sub_bt = data.ReadPairFile(cleaned_path, usecols = ['insert_time', 'speed', 'day_of_week'])
+	return WritePairStats(D, a, ComputePairStats(sub_bt))
+
+def UpdatePairStats(D, a, new_rows):
+	"""Carry the statistics of roadway (a) forward over the appended (new_rows), without re-reading its history."""
+	pair_stats = GetPairStats(D, a)
+	if pair_stats is None or len(new_rows) == 0:
+		return pair_stats
+	added = ComputePairStats(new_rows)
+	count = pair_stats['count'] + added['count']
+	merged = dict(pair_stats)
+	merged.update({'count' : count,
+				   'min_speed' : min([s for s in [pair_stats['min_speed'], added['min_speed']] if s is not None]),
+				   'max_speed' : max([s for s in [pair_stats['max_speed'], added['max_speed']] if s is not None]),
+				   'mean_speed' : ((pair_stats['mean_speed'] or 0) * pair_stats['count'] + added['mean_speed'] * added['count']) / count,
+				   'first_insert_time' : min([t for t in [pair_stats['first_insert_time'], added['first_insert_time']] if t is not None]),
+				   'last_insert_time' : max([t for t in [pair_stats['last_insert_time'], added['last_insert_time']] if t is not None]),
+				   'day_of_week_counts' : [c + n for c, n in zip(pair_stats['day_of_week_counts'], added['day_of_week_counts'])]})
+	if pair_stats['raw_count'] is not None: #live readings are never '\N', so none are dropped
+		merged['raw_count'] = pair_stats['raw_count'] + added['count']
+		merged['dropped_fraction'] = round(float(merged['raw_count'] - count) / merged['raw_count'], 6)
+	return WritePairStats(D, a, merged)
+
+def IsSparse(D, pair_stats):
+	"""Whether a roadway with statistics (pair_stats) has too few readings, (D)['min_pair_rows'], to be worth
+	building and predicting."""
+	return pair_stats is not None and pair_stats['count'] < D['min_pair_rows']
+
+def AssembleCatalog(D, all_pair_ids):
+	"""Combine the statistics of every pair_id into PairStatistics.json, keyed by pair_id."""
+	catalog = {}
+	for a in all_pair_ids.pair_id:
+		pair_stats = GetPairStats(D, a)
+		if pair_stats is not None:
+			catalog[str(a)] = pair_stats
+	BTA.WriteJSON(catalog, D['update_path'], 'PairStatistics.json')
+	return catalog
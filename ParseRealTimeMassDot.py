@@ -2,7 +2,6 @@
 requested information as a json to be used by other prognostic functions."""
 
 import pandas as pd
-import urllib2 as url
 import json
 import sys
 import BlueToadAnalysis as BTA
@@ -11,8 +10,7 @@ import datetime as dt
 import numpy as np
 import os
 import datetime
-import gzip
-from StringIO import StringIO
+import SpatialIndex as spatial
 
 def ParseHistoricalJson(current_transit_dict):
 	"""Given a json taken from mass-dot's real-time feed (current_transit_dict), 
@@ -33,6 +31,8 @@ def unique(seq, keepstr=True):
 	return t(c for c in seq if not (c in seen or seen.append(c)))
 
 def RetrieveJSON(path_to_massdot, json_type):	
+	import urllib2 as url, gzip #only needed for live feeds
+	from StringIO import StringIO
 	request = url.Request(path_to_massdot)
 	request.add_header('Accept-encoding', 'gzip')	
 	opener = url.build_opener()
@@ -40,6 +40,8 @@ def RetrieveJSON(path_to_massdot, json_type):
 	if response.info().get('Content-Encoding') == 'gzip':
 		buf = StringIO( response.read())		
 		f = gzip.GzipFile(fileobj=buf)
+	else: #served uncompressed
+		f = response
 	if json_type == 'historical':
 		return ParseHistoricalJson(json.load(f))
 	if json_type == 'current':
@@ -75,38 +77,125 @@ def GetNormalizedTrafficHistory(historical_data, roadway, diurnal_history, weigh
 	else:
 		return [c - d for c,d in zip(historical_data[roadway] + [current_speed], diurnal_history)]
 			
-def GetCurrentInfo(massdot_history, DiurnalDic, traffic_system_memory, weights, path_to_current, default_roadway, pct_tile_list):
+def BuildDiurnalMatrix(DiurnalDic, roadways, percentile = '50'):
+	"""Given the (DiurnalDic) and a list of (roadways), return an array of shape (roadways, 7, 288) holding the
+	(percentile) diurnal cycle for every roadway and day of the week, so that baselines for all roads can be
+	gathered at once rather than through string-keyed lookups.  Days without a cycle are left NaN."""
+	baseline = np.empty((len(roadways), 7, 288)); baseline.fill(np.nan)
+	for r, roadway in enumerate(roadways):
+		for day in range(7):
+			diurnal_key = str(roadway) + "_" + str(day)
+			if diurnal_key in DiurnalDic: #GetCurrentInfo fills the days its memory spans, others may be absent
+				baseline[r, day, :] = DiurnalDic[diurnal_key][percentile]
+	return baseline
+
+def GetDiurnalHistoryMatrix(baseline, day_of_week, time_of_day_ind, traffic_system_memory):
+	"""Given the (baseline) from BuildDiurnalMatrix, return a (roadways, traffic_system_memory) array of the diurnal
+	speeds for the last (traffic_system_memory) five-minute steps, oldest first, ending at (time_of_day_ind) on
+	(day_of_week).  Steps before midnight wrap to the previous day, as in GetDiurnalKeys_and_Indices."""
+	week_slots = (day_of_week * 288 + time_of_day_ind - np.arange(traffic_system_memory)[::-1]) % (7 * 288)
+	return baseline[:, week_slots // 288, week_slots % 288]
+
+def LoadSpeedBuffer(update_path, buffer_name):
+	"""Read the ring buffer of recent speeds from (update_path), returning None if it has not been built yet.
+	The buffer holds the list of 'roads', the 'last_update' time and a (roads, traffic_system_memory) array of
+	'speeds', oldest first, in which missing observations are NaN."""
+	if update_path is None or not os.path.exists(os.path.join(update_path, buffer_name)):
+		return None
+	buffer_json = BTA.GetJSON(update_path, buffer_name)
+	return {'roads' : [str(r) for r in buffer_json['roads']],
+			'last_update' : datetime.datetime.strptime(buffer_json['last_update'], "%Y-%m-%dT%H:%M:%S"),
+			'speeds' : np.array([[np.nan if s is None else s for s in row] for row in buffer_json['speeds']], dtype = float)}
+
+def WriteSpeedBuffer(speed_buffer, update_path, buffer_name):
+	"""Write the (speed_buffer) to (update_path) as a json, with NaN stored as null."""
+	if update_path is None:
+		return None
+	buffer_json = {'roads' : speed_buffer['roads'],
+				   'last_update' : speed_buffer['last_update'].strftime("%Y-%m-%dT%H:%M:%S"),
+				   'speeds' : [[None if np.isnan(s) else round(s, 2) for s in row] for row in speed_buffer['speeds']]}
+	BTA.WriteJSON(buffer_json, update_path, buffer_name)
+	return None
+
+def SeedSpeedBuffer(historical_data, current_datetime, traffic_system_memory):
+	"""Cold start: build a ring buffer from the full (historical_data) feed, whose lists run oldest to most recent
+	and end one five-minute step before (current_datetime).  The newest column is left empty for the current speed."""
+	roads = [str(k) for k in historical_data.keys() if k != 'Start']
+	speeds = np.empty((len(roads), traffic_system_memory)); speeds.fill(np.nan)
+	for r, roadway in enumerate(roads):
+		recent = [np.nan if s in [None, ''] else float(s) for s in historical_data[roadway][-(traffic_system_memory - 1):]]
+		if len(recent) > 0 and traffic_system_memory > 1:
+			speeds[r, (traffic_system_memory - 1 - len(recent)):(traffic_system_memory - 1)] = recent
+	return {'roads' : roads, 'last_update' : BTA.RoundToFive(current_datetime) - datetime.timedelta(minutes = 5), 'speeds' : speeds}
+
+def UpdateSpeedBuffer(speed_buffer, current_datetime, current_data):
+	"""Advance the (speed_buffer) to (current_datetime) and write the non-stale speeds of (current_data) into its
+	newest column.  Skipped five-minute steps are left as NaN, and roads first seen in (current_data) get a new row."""
+	current_slot = BTA.RoundToFive(current_datetime)
+	elapsed_steps = int(round((current_slot - speed_buffer['last_update']).total_seconds() / 300))
+	speeds = speed_buffer['speeds']
+	if elapsed_steps > 0: #shift left, emptying one column per elapsed step
+		speeds = np.roll(speeds, -elapsed_steps, axis = 1)
+		speeds[:, -min(elapsed_steps, speeds.shape[1]):] = np.nan
+	new_roads = [str(k) for k in current_data.keys() if str(k) not in speed_buffer['roads']]
+	if len(new_roads) > 0:
+		empty_rows = np.empty((len(new_roads), speeds.shape[1])); empty_rows.fill(np.nan)
+		speeds = np.vstack([speeds, empty_rows])
+	roads = speed_buffer['roads'] + new_roads
+	road_index = dict((roadway, r) for r, roadway in enumerate(roads))
+	for roadway in current_data.keys():
+		if not current_data[roadway]['stale']:
+			speeds[road_index[str(roadway)], -1] = float(current_data[roadway]['speed'])
+	return {'roads' : roads, 'last_update' : current_slot, 'speeds' : speeds}
+
+def BufferNeedsSeeding(speed_buffer, current_datetime, traffic_system_memory):
+	"""The history feed is only needed when there is no buffer, when it has fallen more than (traffic_system_memory)
+	steps behind, when the clock has moved backwards, or when the memory length has been changed."""
+	if speed_buffer is None or speed_buffer['speeds'].shape[1] != traffic_system_memory:
+		return True
+	elapsed_steps = int(round((BTA.RoundToFive(current_datetime) - speed_buffer['last_update']).total_seconds() / 300))
+	return elapsed_steps < 0 or elapsed_steps >= traffic_system_memory
+
+def GetCurrentInfo(massdot_history, DiurnalDic, traffic_system_memory, weights, path_to_current, default_roadway, pct_tile_list,
+				   update_path = None, buffer_name = 'SpeedBuffer.json', road_index = None, neighbour_roads = 3):
 	"""To run a real-time prediction scheme, we must obtain four pieces of information.
 	The first is the current weather conditions.  We have not constructed a real-time query
 	to NOAA/NCDC.  This is probably above my pay-grade, but I can dig into it.  The second is
 	a normalized estimate of traffic conditions.  The third is the day of the week, the fourth
-	is the time of day..."""
-	historical_data = RetrieveJSON(massdot_history, 'historical')
+	is the time of day...
+
+	Recent speeds are kept in a ring buffer under (update_path), so only current.json is fetched on
+	a warm run; the full (massdot_history) feed is read after a cold start.  The normalized traffic
+	state of every roadway is then one weighted sum over (speeds - diurnal baseline).  Roadways without a
+	diurnal cycle, on any day the memory spans, borrow the mean cycle of their (neighbour_roads) nearest
+	same-direction roadways in (road_index), or that of (default_roadway) when no neighbours are known."""
 	current_time, current_data = RetrieveJSON(path_to_current, 'current')
 	current_datetime = ConvertCurrentTimeToDatetime(current_time)
 	day_of_week = BTA.GetDayOfWeek(int(NCDC.GetTimeFromDateTime(current_datetime, False)))
 	time_of_day_ind = int(NCDC.GetTimeFromDateTime(current_datetime, True) * 288)
-	keys_and_indices = GetDiurnalKeys_and_Indices(day_of_week, time_of_day_ind, traffic_system_memory)
+	speed_buffer = LoadSpeedBuffer(update_path, buffer_name)
+	if BufferNeedsSeeding(speed_buffer, current_datetime, traffic_system_memory):
+		print "Seeding the recent speed buffer from the full history feed"
+		speed_buffer = SeedSpeedBuffer(RetrieveJSON(massdot_history, 'historical'), current_datetime, traffic_system_memory)
+	speed_buffer = UpdateSpeedBuffer(speed_buffer, current_datetime, current_data)
+	WriteSpeedBuffer(speed_buffer, update_path, buffer_name)
+	roads = speed_buffer['roads']
+	memory_days = [day_of_week] if time_of_day_ind + 1 >= traffic_system_memory else [day_of_week, (day_of_week - 1) % 7] #the memory wraps past midnight
+	for day in memory_days:
+		observed_roads = set([k.split("_")[0] for k in DiurnalDic if k.split("_")[1] == str(day)]) #before any are borrowed
+		for roadway in roads:
+			if roadway + "_" + str(day) not in DiurnalDic:
+				DiurnalDic = AddNeighbourValuesToDiurnalDic(DiurnalDic, day, roadway, road_index, neighbour_roads, observed_roads,
+															default_roadway, pct_tile_list)
+	print "gathering current and recent conditions for %d roadways" % len(roads)
+	diurnal_history = GetDiurnalHistoryMatrix(BuildDiurnalMatrix(DiurnalDic, roads), day_of_week, time_of_day_ind, traffic_system_memory)
+	normalized_history = np.nan_to_num(speed_buffer['speeds'] - diurnal_history) #missing or stale speeds assume 'typical conditions'
+	#most recent step first, matching the weighting of CalculateAntecedentTraffic in the historical features
+	traffic_states = np.dot(normalized_history[:, ::-1], np.array(weights[0:traffic_system_memory], dtype = float))
+	current_speeds = np.where(np.isnan(speed_buffer['speeds'][:, -1]), diurnal_history[:, -1], speed_buffer['speeds'][:, -1])
 	pair_cond_weather_dic = {}
-	for roadway in [k for k in historical_data.keys() if k != 'Start']:
-		if str(roadway) + "_" + str(day_of_week) not in DiurnalDic.keys(): 
-			DiurnalDic = AddDummyValuesToDiurnalDic(DiurnalDic, day_of_week, roadway, default_roadway, pct_tile_list)
-		print "gathering current and recent conditions for roadway %s" % roadway
-		if roadway not in current_data.keys():
-			print "No recent data available for roadway %s" % roadway
-			if roadway + "_" + str(day_of_week) not in DiurnalDic.keys():
-				print "No historical data available for roadway %s" % roadway
-				current_speed = -1
-				normalized_history = [0 for w in weights] #assume 'typical conditions'
-			else:	
-				current_speed = DiurnalDic[roadway + "_" + str(day_of_week)]['50'][time_of_day_ind]
-				diurnal_history = GetDiurnalHistory(DiurnalDic, traffic_system_memory, keys_and_indices, roadway)
-				normalized_history = GetNormalizedTrafficHistory(historical_data, roadway, diurnal_history, weights, current_speed)
-		else:
-			current_speed = float(current_data[roadway]['speed']) if not current_data[roadway]['stale'] else DiurnalDic[roadway + "_" + str(day_of_week)]['50'][time_of_day_ind]	
-			diurnal_history = GetDiurnalHistory(DiurnalDic, traffic_system_memory, keys_and_indices, roadway)
-			normalized_history = GetNormalizedTrafficHistory(historical_data, roadway, diurnal_history, weights, current_speed)
-		pair_cond_weather_dic[roadway] = [np.sum([n * w for n,w in zip(normalized_history, weights)]), ' ', current_speed]
+	for r, roadway in enumerate(roads):
+		pair_cond_weather_dic[roadway] = [traffic_states[r], ' ', current_speeds[r]]
 	return day_of_week, current_datetime, pair_cond_weather_dic
 	
 def	AddDummyValuesToDiurnalDic(DiurnalDic, day_of_week, roadway, default_roadway, pct_tile_list):
@@ -117,6 +206,20 @@ def	AddDummyValuesToDiurnalDic(DiurnalDic, day_of_week, roadway, default_roadway
 			DiurnalDic[diurnal_key][str(p)] = DiurnalDic[str(default_roadway) + "_" + str(day_of_week)][str(p)]
 	return DiurnalDic
 			
+def AddNeighbourValuesToDiurnalDic(DiurnalDic, day_of_week, roadway, road_index, k, observed_roads, default_roadway, pct_tile_list):
+	"""Fill the missing (day_of_week) diurnal cycle of (roadway) with the mean, per percentile and five-minute step, of
+	the (k) nearest roadways in (road_index) that travel in the same direction and have their own diurnal cycle
+	(observed_roads).  Fall back on AddDummyValuesToDiurnalDic if the roadway has no coordinates or no such neighbours."""
+	neighbours = spatial.KNearest(road_index, roadway, k, observed_roads) if road_index is not None else []
+	if len(neighbours) == 0:
+		return AddDummyValuesToDiurnalDic(DiurnalDic, day_of_week, roadway, default_roadway, pct_tile_list)
+	print "Borrowing the diurnal cycle of roadway %s from roadways %s" % (roadway, ", ".join(neighbours))
+	diurnal_key = roadway + "_" + str(day_of_week)
+	DiurnalDic[diurnal_key] = {}
+	for p in pct_tile_list:
+		DiurnalDic[diurnal_key][str(p)] = list(np.round(np.mean([DiurnalDic[n + "_" + str(day_of_week)][str(p)] for n in neighbours], axis = 0), 0))
+	return DiurnalDic
+
 def ParseCurrentJson(current_transit_dict): 
 	"""Given a json taken from mass-dot's real-time feed (current_transit_dict),  
 	return the real-time string and an appropriate data-frame with current information""" 
@@ -185,6 +288,7 @@ def GetLatLons(bt_path, file_name):
 	return RoadwayCoordsDic
 	
 if __name__ == "__main__":
+	import urllib2 as url
 	script_name, massdot_current = sys.argv
 	#where to fetch real-time data for transit:
 	#massdot_current = 'http://www.acollier.com/massdot/current.json'
@@ -0,0 +1,261 @@
+"""This module replays the live feeds offline, so that a prediction cycle can be measured end to end without the
+MassDOT and NOAA endpoints.  'record' saves the payloads a live cycle fetches -- current.json and the speed history
+feed, exactly as served (gzipped), and the NOAA observation page of every weather site in NOAA_df -- into a
+recording directory.  'run' serves a recording from a local HTTP stand-in, points BlueToadAnalysis at it through a
+scenario config.json, and times each invocation from its launch to its output file.
+
+Each scenario injects faults into the stand-in's routes ('current', 'history' and 'weather'):
+
+  latency   seconds to wait before answering
+  hang      seconds to hold the request without answering, then drop the connection (a dependency timing out)
+  truncate  the fraction of the body to send, cutting the gzip stream short
+  stale     the fraction of current.json roadways flagged stale
+  status    an HTTP error code to answer with
+
+and 'cold' removes the recent speed buffer before each run, so that the history feed is fetched.  Each scenario is
+run (repeats) times and summarized by its median, 95th percentile and worst latency, and how many runs failed."""
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import urllib2
+import argparse
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+import numpy as np
+import pandas as pd
+from StringIO import StringIO
+import BlueToadAnalysis as BTA
+
+ROUTES = {'current' : 'path_to_current', 'history' : 'path_to_speed_history', 'weather' : 'WeatherURL_historical'}
+REPLAY_BUFFER = "SpeedBuffer_replay.json" #kept apart from the live run's buffer
+SCENARIOS = {'baseline' : {},
+			 'slow_current' : {'current' : {'latency' : 2}},
+			 'slow_weather' : {'weather' : {'latency' : 0.5}},
+			 'slow_history_cold' : {'cold' : True, 'history' : {'latency' : 5}},
+			 'hung_current' : {'current' : {'hang' : 60}},
+			 'hung_weather' : {'weather' : {'hang' : 60}},
+			 'truncated_current' : {'current' : {'truncate' : 0.5}},
+			 'truncated_history_cold' : {'cold' : True, 'history' : {'truncate' : 0.5}},
+			 'all_stale' : {'current' : {'stale' : 1.0}},
+			 'current_unavailable' : {'current' : {'status' : 503}}}
+
+def Fetch(url):
+	"""The body of (url) as served, asking for gzip as RetrieveJSON does, and its content encoding."""
+	request = urllib2.Request(url)
+	request.add_header('Accept-encoding', 'gzip')
+	response = urllib2.urlopen(request, timeout = 120)
+	return response.read(), response.info().get('Content-Encoding')
+
+def WriteBody(recording_dir, file_name, body):
+	with open(os.path.join(recording_dir, file_name), 'wb') as outfile:
+		outfile.write(body)
+	return file_name
+
+def Record(D, recording_dir):
+	"""Save the live payloads of one cycle into (recording_dir), listed in its manifest.json."""
+	if not os.path.exists(os.path.join(recording_dir, "weather")): os.makedirs(os.path.join(recording_dir, "weather"))
+	manifest = {'recorded' : time.strftime("%Y-%m-%dT%H:%M:%S"), 'weather' : {}}
+	for route in ['current', 'history']:
+		body, encoding = Fetch(D[ROUTES[route]])
+		manifest[route] = {'file' : WriteBody(recording_dir, route + ".json", body), 'encoding' : encoding}
+		print "Recorded %s: %d bytes" % (D[ROUTES[route]], len(body))
+	NOAA_df = pd.read_csv(os.path.join(D['data_path'], D['NOAA_df_name']))
+	for code in sorted(set(NOAA_df.Code)):
+		try:
+			body, encoding = Fetch(D['WeatherURL_historical'] + code + ".html")
+		except (urllib2.URLError, IOError), e:
+			print "Could not record the NOAA page of %s: %s" % (code, e)
+			continue
+		manifest['weather'][code] = {'file' : WriteBody(recording_dir, os.path.join("weather", code + ".html"), body), 'encoding' : encoding}
+	print "Recorded %d NOAA pages" % len(manifest['weather'])
+	BTA.WriteJSON(manifest, recording_dir, "manifest.json")
+	return manifest
+
+def StaleBody(body, encoding, fraction):
+	"""The current.json (body) with the first (fraction) of its roadways, in pair_id order, flagged stale."""
+	current = json.loads(gzip.GzipFile(fileobj = StringIO(body)).read() if encoding == 'gzip' else body)
+	roads = sorted(current['pairData'].keys())
+	for roadway in roads[:int(round(len(roads) * fraction))]:
+		current['pairData'][roadway]['stale'] = True
+	if encoding != 'gzip':
+		return json.dumps(current)
+	buf = StringIO()
+	with gzip.GzipFile(fileobj = buf, mode = 'wb') as compressed:
+		compressed.write(json.dumps(current))
+	return buf.getvalue()
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Answers the routes of the server's recording, with the server's faults."""
+	def do_GET(self):
+		route, entry = self.server.Resolve(self.path)
+		if route is None:
+			self.send_error(404)
+			return
+		faults = self.server.faults.get(route, {})
+		time.sleep(faults.get('latency', 0))
+		if faults.get('hang', 0) > 0:
+			time.sleep(faults['hang'])
+			return #the connection is closed without a response
+		if faults.get('status', 0) != 0:
+			self.send_error(int(faults['status']))
+			return
+		with open(os.path.join(self.server.recording_dir, entry['file']), 'rb') as infile:
+			body = infile.read()
+		if route == 'current' and faults.get('stale', 0) > 0:
+			body = StaleBody(body, entry['encoding'], faults['stale'])
+		if 'truncate' in faults:
+			body = body[:int(len(body) * faults['truncate'])]
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/html' if route == 'weather' else 'application/json')
+		if entry['encoding'] is not None:
+			self.send_header('Content-Encoding', entry['encoding'])
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		return None
+
+class FeedStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""A local HTTP server replaying the recording in (recording_dir) with the given (faults), {route : {fault : value}},
+	on a free port, answering each request in its own thread."""
+	daemon_threads = True
+
+	def __init__(self, recording_dir, faults):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+		self.recording_dir, self.faults = recording_dir, faults
+		self.manifest = BTA.GetJSON(recording_dir, "manifest.json")
+
+	def Resolve(self, path):
+		"""The route of a request (path), and the manifest entry answering it, or None and None."""
+		if path == "/current.json":
+			return 'current', self.manifest['current']
+		if path == "/history.json":
+			return 'history', self.manifest['history']
+		code = os.path.splitext(os.path.basename(path))[0]
+		if path.startswith("/weather/") and code in self.manifest['weather']:
+			return 'weather', self.manifest['weather'][code]
+		return None, None
+
+	def BaseURL(self):
+		return "http://127.0.0.1:%d" % self.server_address[1]
+
+	def Start(self):
+		thread = threading.Thread(target = self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+def ScenarioConfig(D, environment_vars, base_url, run_dir):
+	"""Write the config.json of a replay into (run_dir): the user's configuration, with the paths made absolute and
+	the feeds pointed at the stand-in at (base_url).  Recorded snapshots are never appended to the real histories,
+	and every run predicts from the per-pair files rather than from a bundle, whatever the user's configuration."""
+	config = dict(environment_vars)
+	for key in ['bt_path', 'update_path', 'data_path', 'bundle_path', 'metrics_path']:
+		config[key] = os.path.abspath(D[key])
+	config['path_to_current'], config['path_to_speed_history'] = base_url + "/current.json", base_url + "/history.json"
+	config['WeatherURL_historical'] = base_url + "/weather/"
+	config['speed_buffer_name'] = REPLAY_BUFFER
+	config['append_history'], config['use_bundle'] = 0, 0
+	BTA.WriteJSON(config, run_dir, "config.json")
+	return config
+
+def TimeRun(command, run_dir, output_path, limit):
+	"""Run (command) in (run_dir), killing it after (limit) seconds, and return how long it took from launch until it
+	exited, its exit code, and whether it wrote (output_path)."""
+	if os.path.exists(output_path): os.remove(output_path)
+	start = time.time()
+	with open(os.path.join(run_dir, "runs.log"), 'ab') as log:
+		process = subprocess.Popen(command, cwd = run_dir, stdout = log, stderr = subprocess.STDOUT)
+		while process.poll() is None and time.time() - start < limit:
+			time.sleep(0.02)
+		killed = process.poll() is None
+		if killed:
+			process.kill(); process.wait()
+	return {'seconds' : round(time.time() - start, 3), 'exit_code' : process.returncode, 'killed' : killed,
+			'output_written' : os.path.exists(output_path)}
+
+def Summarize(name, scenario, runs):
+	"""Latency percentiles and failures of a scenario's (runs); only runs that wrote their output count as successes."""
+	seconds = [run['seconds'] for run in runs]
+	return {'scenario' : name, 'faults' : scenario, 'runs' : len(runs),
+			'failures' : len([run for run in runs if not run['output_written']]),
+			'killed' : len([run for run in runs if run['killed']]),
+			'p50' : round(np.percentile(seconds, 50), 3), 'p95' : round(np.percentile(seconds, 95), 3), 'max' : round(max(seconds), 3)}
+
+def RunScenarios(D, environment_vars, recording_dir, scenarios, repeats, limit, bta_args):
+	"""Replay (recording_dir) under each of (scenarios), {name : faults}, (repeats) times each, invoking
+	BlueToadAnalysis with (bta_args), in which '{output}' names the output.  Returns the summaries and every run."""
+	run_dir = tempfile.mkdtemp(prefix = "replay_")
+	script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BlueToadAnalysis.py")
+	summaries, all_runs = [], {}
+	try:
+		for name in sorted(scenarios):
+			scenario = scenarios[name]
+			faults = dict((route, scenario[route]) for route in ROUTES if route in scenario)
+			stand_in = FeedStandIn(recording_dir, faults).Start()
+			ScenarioConfig(D, environment_vars, stand_in.BaseURL(), run_dir)
+			output_name = "replay_" + name + ".json"
+			command = [sys.executable, script] + [arg.replace("{output}", output_name) for arg in bta_args]
+			runs = []
+			for r in range(repeats):
+				if scenario.get('cold', False) and os.path.exists(os.path.join(D['update_path'], REPLAY_BUFFER)):
+					os.remove(os.path.join(D['update_path'], REPLAY_BUFFER))
+				runs.append(TimeRun(command, run_dir, os.path.join(D['update_path'], output_name), limit))
+				print "%s, run %d: %.2f s, %s" % (name, r + 1, runs[-1]['seconds'], "output written" if runs[-1]['output_written'] else
+												   ("killed after %d s" % limit if runs[-1]['killed'] else "failed, exit code %s" % runs[-1]['exit_code']))
+			stand_in.shutdown(); stand_in.server_close()
+			summaries.append(Summarize(name, scenario, runs))
+			all_runs[name] = runs
+	finally:
+		if os.path.exists(os.path.join(run_dir, "runs.log")):
+			shutil.copy(os.path.join(run_dir, "runs.log"), os.path.join(D['update_path'], "replay_runs.log"))
+		shutil.rmtree(run_dir)
+	return summaries, all_runs
+
+def LoadScenarios(spec):
+	"""The scenarios named in the comma-separated (spec), or those of the json file (spec), {name : faults}."""
+	if os.path.exists(spec):
+		return BTA.GetJSON("", spec)
+	names = sorted(SCENARIOS) if spec == "all" else [name.strip() for name in spec.split(",")]
+	unknown = [name for name in names if name not in SCENARIOS]
+	if unknown:
+		raise ValueError("Unknown scenarios %s; choose from %s, or give a json file of scenarios" % (", ".join(unknown), ", ".join(sorted(SCENARIOS))))
+	return dict((name, SCENARIOS[name]) for name in names)
+
+if __name__ == "__main__":
+	D = BTA.HardCodedParameters()
+	environment_vars = BTA.GetJSON("","config.json") if os.path.exists("config.json") else {}
+	for key in environment_vars:
+		D[key] = environment_vars[key]
+	parser = argparse.ArgumentParser()
+	parser.add_argument("command", choices = ['record', 'run'], help = "'record' the live feeds, or 'run' scenarios replaying a recording")
+	parser.add_argument("recording_dir", help = "directory of the recording")
+	parser.add_argument("-s", "--scenarios", help = "comma-separated scenario names, 'all' (default), or a json file of {name : faults}", type = str, default = "all")
+	parser.add_argument("-n", "--repeats", help = "runs per scenario, default of 5", type = int, default = 5)
+	parser.add_argument("--limit", help = "seconds after which a run is killed and counted as failed, default of 300 (one cycle)", type = int, default = 300)
+	parser.add_argument("--args", help = "arguments passed to BlueToadAnalysis.py, with {output} for the output name", type = str, default = "today {output} -w -t")
+	parser.add_argument("-o", "--output", help = "file to which the JSON results are written", type = str, default = "replay_results.json")
+	args = parser.parse_args()
+
+	try:
+		if args.command == 'record':
+			Record(D, args.recording_dir)
+		else:
+			if not os.path.exists(os.path.join(args.recording_dir, "manifest.json")):
+				raise ValueError("%s is not a recording; make one with 'python ReplayHarness.py record %s'" % (args.recording_dir, args.recording_dir))
+			summaries, all_runs = RunScenarios(D, environment_vars, args.recording_dir, LoadScenarios(args.scenarios), args.repeats, args.limit,
+											   args.args.split())
+			with open(args.output, 'wb') as outfile:
+				json.dump({'summaries' : summaries, 'runs' : all_runs}, outfile, indent = 1)
+			print pd.DataFrame(summaries, columns = ['scenario', 'runs', 'failures', 'killed', 'p50', 'p95', 'max']).to_string(index = False)
+			print "Results written to %s" % args.output
+	except ValueError, e:
+		print e; sys.exit(1)
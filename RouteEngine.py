@@ -0,0 +1,88 @@
+"""This module chains the speed predictions of consecutive roadway segments into door-to-door travel times along
+commuter routes.  A route is a list of pair_ids, each ending where the next begins (per pair_definitions.csv).  The
+time at which a trip enters each segment depends on how long the previous segments took, so the speed used for
+segment k+1 is read at the horizon step the trip actually reaches it.  Every departure slot and percentile is
+carried along the route at once, as arrays, so a whole route table costs one array step per segment."""
+
+import os
+import datetime
+import numpy as np
+import pandas as pd
+import BlueToadAnalysis as BTA
+
+MIN_ROUTE_SPEED = 1.0 #mph, so that a predicted standstill gives a long rather than infinite traversal
+
+def ReadDefinitions(data_path, pair_definitions_name = "pair_definitions.csv"):
+	"""Return the Origin, Destination and Distance (miles) of every pair_id in (pair_definitions_name), by pair_id."""
+	pair_definitions = pd.read_csv(os.path.join(data_path, pair_definitions_name))
+	return dict((str(p), {'Origin' : o, 'Destination' : d, 'Distance' : float(m)}) for p, o, d, m in
+				zip(pair_definitions.pair_id, pair_definitions.Origin, pair_definitions.Destination, pair_definitions.Distance))
+
+def ValidateRoute(name, pair_ids, definitions):
+	"""Check that every segment of the route (name) is defined and begins where the one before it ends."""
+	if len(pair_ids) == 0:
+		raise ValueError("Route %s has no segments" % name)
+	for a in pair_ids:
+		if a not in definitions:
+			raise ValueError("Route %s includes pair_id %s, which is not in pair_definitions" % (name, a))
+	for a, b in zip(pair_ids[:-1], pair_ids[1:]):
+		if definitions[a]['Destination'] != definitions[b]['Origin']:
+			raise ValueError("Route %s: pair_id %s ends at '%s', but %s begins at '%s'" % (name, a, definitions[a]['Destination'],
+																						   b, definitions[b]['Origin']))
+	return pair_ids
+
+def LoadRoutes(D):
+	"""Read the commuter routes, {'<name>' : [pair_id, ...]}, from (D)['routes_name'] in the data directory, and
+	return each with its segment distances, {'<name>' : {'pair_ids' : [...], 'distances' : [...]}}."""
+	definitions = ReadDefinitions(D['data_path'])
+	routes = {}
+	for name, pair_ids in BTA.GetJSON(D['data_path'], D['routes_name']).iteritems():
+		pair_ids = ValidateRoute(name, [str(a) for a in pair_ids], definitions)
+		routes[name] = {'pair_ids' : pair_ids, 'distances' : [definitions[a]['Distance'] for a in pair_ids]}
+	return routes
+
+def PredictionSpan(PredDic):
+	"""Return the first departure, the number of departure slots, and the roadways' predicted speeds, from either a
+	PredictionModule output (one departure per five-minute prediction step) or a DepartureSweep output (whose
+	per-departure predictions overlap, and are stitched back into one continuous sequence per percentile)."""
+	if 'Departures' in PredDic:
+		start, n_departures = PredDic['Departures'][0], len(PredDic['Departures'])
+		speeds = {}
+		for road in PredDic:
+			if road in ['Departures', 'Fallbacks']: continue
+			speeds[road] = dict((p, seqs if not seqs else seqs[0] + [seq[-1] for seq in seqs[1:]]) for p, seqs in PredDic[road].iteritems())
+	else:
+		start, speeds = PredDic['Start'], dict((road, PredDic[road]) for road in PredDic if road not in ['Start', 'Fallbacks'])
+		n_departures = max([len(seq) for road in speeds for seq in speeds[road].values() if seq] or [0])
+	return datetime.datetime.strptime(start[:19], "%Y-%m-%dT%H:%M:%S"), n_departures, speeds
+
+def RouteTravelTimes(segment_speeds, distances, n_departures):
+	"""Given, for each segment in order, its predicted speeds as a (percentiles, steps) array, where step i covers the
+	five minutes ending 5(i+1) minutes after the first departure, return the (percentiles, departures) travel times
+	in minutes for departures every five minutes.  Trips reaching past the last step use the last step's speed."""
+	n_pcts = segment_speeds[0].shape[0]
+	rows = np.arange(n_pcts)[:, None]
+	clock = np.tile(5.0 * np.arange(n_departures), (n_pcts, 1)) #minutes after the first departure
+	departure = clock.copy()
+	for speeds, distance in zip(segment_speeds, distances):
+		step = np.clip(np.ceil(clock / 5.0).astype(int) - 1, 0, speeds.shape[1] - 1) #the step during which the trip enters
+		clock += 60.0 * distance / np.maximum(speeds[rows, step], MIN_ROUTE_SPEED)
+	return clock - departure
+
+def RouteTables(D, PredDic, routes):
+	"""Travel times along every one of (routes) for every departure slot and percentile of (PredDic).  Travel times
+	rise as speeds fall, so each speed percentile is reported under its travel-time percentile ('10' as '90', 'min'
+	as 'max').  Routes with a segment lacking predictions are reported as None."""
+	start, n_departures, speeds = PredictionSpan(PredDic)
+	pcts = [str(p) for p in D['pct_tile_list']]
+	pct_map = BTA.PctMap(pcts)
+	RouteDic = {'Departures' : [(start + datetime.timedelta(minutes = 5 * j)).isoformat() for j in xrange(n_departures)]}
+	for name, route in routes.iteritems():
+		RouteDic[name] = {'pair_ids' : route['pair_ids'], 'distance' : round(sum(route['distances']), 3)}
+		if not all([road in speeds and all([speeds[road].get(p) for p in pcts]) for road in route['pair_ids']]):
+			RouteDic[name]['travel_minutes'] = None
+			continue
+		segment_speeds = [np.array([speeds[road][p] for p in pcts], dtype = float) for road in route['pair_ids']]
+		minutes = RouteTravelTimes(segment_speeds, route['distances'], n_departures)
+		RouteDic[name]['travel_minutes'] = dict((pct_map[p], [round(m, 1) for m in minutes[ind]]) for ind, p in enumerate(pcts))
+	return RouteDic
@@ -0,0 +1,99 @@
+"""This module collects structured metrics for a run: the wall time of each major stage, and per-pair counters
+(rows loaded, analog matches found, relaxation steps taken, empty predictions...).  At the end of a run they are
+written both as a JSON and as a Prometheus textfile, so a slow stage or pair can be found without reading the log."""
+
+import os
+import time
+import json
+import contextlib
+import resource
+
+global stage_seconds
+global stage_calls
+global pair_counters
+stage_seconds, stage_calls, pair_counters = {}, {}, {}
+run_started = time.time()
+
+def Reset():
+	"""Clear all metrics, e.g. between runs in the same process."""
+	global run_started
+	stage_seconds.clear(); stage_calls.clear(); pair_counters.clear()
+	run_started = time.time()
+	return None
+
+@contextlib.contextmanager
+def Timer(stage):
+	"""Time the enclosed block as (stage).  Repeated stages accumulate their time and number of calls."""
+	start = time.time()
+	try:
+		yield
+	finally:
+		AddStageTime(stage, time.time() - start)
+
+def AddStageTime(stage, seconds):
+	stage_seconds[stage] = stage_seconds.get(stage, 0) + seconds
+	stage_calls[stage] = stage_calls.get(stage, 0) + 1
+	return None
+
+def Count(a, counter, n = 1):
+	"""Add (n) to the named (counter) of roadway (a)."""
+	pair_counters.setdefault(str(a), {})
+	pair_counters[str(a)][counter] = pair_counters[str(a)].get(counter, 0) + n
+	return None
+
+def SetValue(a, counter, value):
+	"""Record a per-pair value, such as its prediction time, overwriting any previous value."""
+	pair_counters.setdefault(str(a), {})
+	pair_counters[str(a)][counter] = value
+	return None
+
+def CurrentRSS():
+	"""Resident memory of this process, in MB.  Where /proc is not available, fall back on the process-wide
+	maximum reported by getrusage."""
+	try:
+		with open("/proc/self/statm") as statm:
+			return int(statm.read().split()[1]) * resource.getpagesize() / 1048576.0
+	except IOError:
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def MetricsDic(run_name):
+	"""Return every metric gathered so far for the run named (run_name)."""
+	return {'run' : run_name, 'started' : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(run_started)),
+			'total_seconds' : round(time.time() - run_started, 4),
+			'stages' : dict((s, {'seconds' : round(stage_seconds[s], 4), 'calls' : stage_calls[s]}) for s in stage_seconds),
+			'pairs' : pair_counters}
+
+def PrometheusLabel(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def PrometheusText(metrics_dic):
+	"""Format (metrics_dic) in the Prometheus text exposition format, for node_exporter's textfile collector."""
+	run = PrometheusLabel(metrics_dic['run'])
+	lines = ['# HELP traffic_run_seconds Wall time of the whole run.', '# TYPE traffic_run_seconds gauge',
+			 'traffic_run_seconds{run="%s"} %s' % (run, metrics_dic['total_seconds']),
+			 '# HELP traffic_stage_seconds Wall time spent in each stage of the run.', '# TYPE traffic_stage_seconds gauge']
+	for stage in sorted(metrics_dic['stages']):
+		lines.append('traffic_stage_seconds{run="%s",stage="%s"} %s' % (run, PrometheusLabel(stage), metrics_dic['stages'][stage]['seconds']))
+	counters = sorted(set([c for a in metrics_dic['pairs'] for c in metrics_dic['pairs'][a]]))
+	for counter in counters:
+		lines += ['# HELP traffic_pair_%s Per-pair %s.' % (counter, counter.replace('_', ' ')), '# TYPE traffic_pair_%s gauge' % counter]
+		for a in sorted(metrics_dic['pairs']):
+			if counter in metrics_dic['pairs'][a]:
+				lines.append('traffic_pair_%s{run="%s",pair_id="%s"} %s' % (counter, run, PrometheusLabel(a), metrics_dic['pairs'][a][counter]))
+	return "\n".join(lines) + "\n"
+
+def WriteAtomic(text, file_path):
+	"""Write (text) via a temporary file and a rename, so that collectors never read a partial file."""
+	temp_path = file_path + ".tmp" + str(os.getpid())
+	with open(temp_path, 'wb') as outfile:
+		outfile.write(text)
+	os.rename(temp_path, file_path)
+	return None
+
+def WriteMetrics(metrics_path, run_name):
+	"""Write the run's metrics to (metrics_path) as (run_name)_metrics.json and (run_name)_metrics.prom."""
+	if not os.path.exists(metrics_path): os.makedirs(metrics_path)
+	metrics_dic = MetricsDic(run_name)
+	WriteAtomic(json.dumps(metrics_dic, indent = 1, sort_keys = True), os.path.join(metrics_path, run_name + "_metrics.json"))
+	WriteAtomic(PrometheusText(metrics_dic), os.path.join(metrics_path, run_name + "_metrics.prom"))
+	return metrics_dic
@@ -0,0 +1,194 @@
+"""This module splits a run across machines.  With (--shard i/N), BlueToadAnalysis builds and predicts only the
+pair_ids assigned to shard i of N, and writes a partial output beside the usual one.  The assignment balances the
+shards by each pair's number of readings (the largest pairs first, each onto the least loaded shard), and is
+written once to update/shards, so every node sharing the directory uses the same one.  Once every shard has
+finished, the merge step assembles the partial outputs into the final prediction JSON, checking that every pair_id
+of the plan is present exactly once.  A plan made before some pairs had been cleaned, whose readings were then
+estimated, is made again by the merge once the shards have cleaned them, so that the next run is balanced by the
+actual readings."""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import pandas as pd
+import BlueToadAnalysis as BTA
+import PairStatistics as stats
+
+BYTES_PER_ROW = 40 #approximate size of one row of a split pair file, for pairs split but not yet cleaned
+
+def ParseShard(spec):
+	"""Parse 'i/N' (spec) into (i, N), with shards numbered from 1."""
+	try:
+		index, count = [int(x) for x in spec.split("/")]
+	except ValueError:
+		raise ValueError("A shard is given as 'i/N', e.g. '2/4', not '%s'" % spec)
+	if count < 1 or index < 1 or index > count:
+		raise ValueError("Shard %s does not exist; shards run from 1/%d to %d/%d" % (spec, max(count, 1), max(count, 1), max(count, 1)))
+	return index, count
+
+def PairWeights(D, all_pair_ids):
+	"""The number of readings of every pair_id, {pair_id : rows}, from the statistics catalog, or estimated from the
+	size of its split file if it has not been cleaned.  Pairs not yet split take the median of the others.  Returns
+	the weights and the sorted pair_ids whose weights were estimated."""
+	weights = {}
+	for a in all_pair_ids.pair_id:
+		pair_stats = stats.GetPairStats(D, a)
+		split_path = os.path.join(D['update_path'], "IndividualFiles", D['bt_name'] + "_" + str(a) + "_Cleaned.csv")
+		if pair_stats is not None:
+			weights[int(a)] = pair_stats['count']
+		elif os.path.exists(split_path):
+			weights[int(a)] = os.path.getsize(split_path) / BYTES_PER_ROW
+	known = sorted(weights.values())
+	default = known[len(known) / 2] if len(known) > 0 else 1
+	estimated = sorted([int(a) for a in all_pair_ids.pair_id if stats.GetPairStats(D, a) is None])
+	return dict((int(a), max(weights.get(int(a), default), 1)) for a in all_pair_ids.pair_id), estimated
+
+def AssignShards(weights, count):
+	"""Deal the pair_ids of (weights) out to (count) shards, the heaviest first, each to the shard with the fewest rows
+	so far (the lowest-numbered on ties).  Returns a list of sorted pair_id lists, one per shard."""
+	shards, loads = [[] for i in range(count)], [0] * count
+	for a in sorted(weights, key = lambda a: (-weights[a], a)):
+		lightest = min(range(count), key = lambda i: (loads[i], i))
+		shards[lightest].append(a)
+		loads[lightest] += weights[a]
+	return [sorted(shard) for shard in shards]
+
+def PlanPath(D, all_pair_ids, count):
+	"""Where the plan for (count) shards of (all_pair_ids) is kept; a different list of pair_ids gets a new plan."""
+	digest = hashlib.sha1(",".join([str(a) for a in sorted(all_pair_ids.pair_id)])).hexdigest()[:10]
+	return os.path.join(D['update_path'], "shards", "plan-%d-%s.json" % (count, digest))
+
+def ShardPlan(D, all_pair_ids, count, replan = False):
+	"""Return the plan for (count) shards, {'count', 'weights', 'estimated', 'shards' : [[pair_id, ...], ...]},
+	computing and writing it if no node has yet, where 'estimated' lists the pair_ids whose weights were estimated.
+	The plan is linked into place, which fails if it already exists, so nodes starting together all keep the first
+	one written.  With (replan), the plan is computed again and replaces the one written."""
+	plan_path = PlanPath(D, all_pair_ids, count)
+	if replan or not os.path.exists(plan_path):
+		if not os.path.exists(os.path.dirname(plan_path)):
+			try:
+				os.makedirs(os.path.dirname(plan_path))
+			except OSError: #made by another node in the meantime
+				pass
+		weights, estimated = PairWeights(D, all_pair_ids)
+		if len(estimated) > 0:
+			print "Planning %d shards with the readings of %d of %d pair_ids estimated, as they have not been cleaned" % (count, len(estimated), len(weights))
+		plan = {'count' : count, 'weights' : dict((str(a), w) for a, w in weights.iteritems()), 'estimated' : estimated,
+				'shards' : AssignShards(weights, count)}
+		temp_path = plan_path + ".tmp" + str(os.getpid())
+		with open(temp_path, 'wb') as outfile:
+			json.dump(plan, outfile)
+		if replan:
+			os.rename(temp_path, plan_path)
+		else:
+			try:
+				os.link(temp_path, plan_path)
+			except OSError: #another node's plan got there first
+				pass
+			os.remove(temp_path)
+	return BTA.GetJSON("", plan_path)
+
+def Rebalance(D, all_pair_ids, count, plan):
+	"""Make the (plan) for (count) shards again if any pair_id it estimated has been cleaned since.  Returns the plan
+	kept or made."""
+	estimated = plan.get('estimated', [int(a) for a in all_pair_ids.pair_id]) #a plan older than the field may have been estimated
+	if not any([stats.GetPairStats(D, a) is not None for a in estimated]):
+		return plan
+	print "Rebalancing the plan for %d shards by the readings of the pairs cleaned since it was made" % count
+	return ShardPlan(D, all_pair_ids, count, replan = True)
+
+def ShardPairIds(D, all_pair_ids, shard):
+	"""The pair_ids of (all_pair_ids) assigned to (shard), (i, N), as a data frame like all_pair_ids."""
+	index, count = shard
+	return pd.DataFrame({'pair_id' : ShardPlan(D, all_pair_ids, count)['shards'][index - 1]})
+
+def PartialName(output_file_name, shard):
+	"""The name of the partial output of (shard), (i, N), for the run writing (output_file_name)."""
+	base, extension = os.path.splitext(output_file_name)
+	return "%s.shard-%d-of-%d%s" % (base, shard[0], shard[1], extension)
+
+def WritePartial(D, PredDic, output_file_name, shard, pair_ids):
+	"""Write the predictions (PredDic) of (shard)'s (pair_ids) as its partial output."""
+	partial = dict(PredDic)
+	partial['_shard'] = {'index' : shard[0], 'count' : shard[1], 'pair_ids' : [int(a) for a in pair_ids]}
+	BTA.WriteJSON(partial, D['update_path'], PartialName(output_file_name, shard))
+	return None
+
+def MergeShards(D, all_pair_ids, output_file_name, count):
+	"""Assemble the partial outputs of all (count) shards into (output_file_name), after checking that every shard
+	has finished the same run, by its 'Start', and that every pair_id of the plan is reported by exactly one of them.
+	A shard that failed leaves the partial of its previous run in place, which is then refused."""
+	plan = ShardPlan(D, all_pair_ids, count)
+	partials = []
+	for index in range(1, count + 1):
+		partial_path = os.path.join(D['update_path'], PartialName(output_file_name, (index, count)))
+		if not os.path.exists(partial_path):
+			raise ValueError("Shard %d/%d has not written %s" % (index, count, partial_path))
+		partials.append(BTA.GetJSON("", partial_path))
+	starts = dict((partial['_shard']['index'], partial.get('Start')) for partial in partials)
+	if len(set(starts.values())) > 1:
+		raise ValueError("Cannot merge %d shards of different runs, whose 'Start' is %s; run again the shards that did not finish"
+						 % (count, ", ".join(["%d/%d: %s" % (index, count, starts[index]) for index in sorted(starts)])))
+	seen = {}
+	for partial in partials:
+		for a in partial['_shard']['pair_ids']:
+			seen[a] = seen.get(a, 0) + 1
+	planned = [a for shard in plan['shards'] for a in shard]
+	missing = sorted([a for a in planned if a not in seen])
+	repeated = sorted([a for a in seen if seen[a] > 1])
+	unplanned = sorted([a for a in seen if a not in planned])
+	if missing or repeated or unplanned:
+		raise ValueError("Cannot merge %d shards: missing pair_ids %s, repeated pair_ids %s, unplanned pair_ids %s" % (count, missing, repeated, unplanned))
+	PredDic = {}
+	for partial in partials:
+		pair_ids = set([str(a) for a in partial['_shard']['pair_ids']])
+		for key in partial:
+			if key in pair_ids:
+				PredDic[key] = partial[key]
+			elif key == 'Fallbacks': #the pairs each shard left at its deadline
+				PredDic.setdefault(key, {}).update(partial[key])
+			elif key != '_shard' and key not in PredDic: #'Start' or 'Departures', shared by every shard
+				PredDic[key] = partial[key]
+			elif key != '_shard' and PredDic[key] != partial[key]:
+				raise ValueError("Cannot merge %d shards: shard %d/%d has a different '%s' than the shards before it" % (count, partial['_shard']['index'], count, key))
+	BTA.WriteJSON(PredDic, D['update_path'], output_file_name)
+	Rebalance(D, all_pair_ids, count, plan) #every shard has finished with this plan, so the next run can take another
+	return PredDic
+
+if __name__ == "__main__":
+	D = BTA.HardCodedParameters()
+	environment_vars = BTA.GetJSON("","config.json") if os.path.exists("config.json") else {}
+	for key in environment_vars:
+		D[key] = environment_vars[key]
+	parser = argparse.ArgumentParser()
+	parser.add_argument("command", choices = ['plan', 'merge'], help = "'plan' to show the assignment of pair_ids to shards, 'merge' to assemble the shards' outputs")
+	parser.add_argument("count", help = "the number of shards", type = int)
+	parser.add_argument("output_file_name", help = "for 'merge', the output file name given to every shard", nargs = "?", default = "")
+	parser.add_argument("-rp", "--replan", help = "set to any value other than 0 for 'plan' to make the plan again from the current readings, replacing the one written.  No shard of the plan should be running.",
+						type = int, default = 0)
+	parser.add_argument("-r", "--routes", help = "set to any value other than 0 to also write the route travel times of the merged predictions.",
+						type = int, default = 0)
+	args = parser.parse_args()
+
+	all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
+	try:
+		if args.command == 'plan':
+			plan = ShardPlan(D, all_pair_ids, args.count, replan = args.replan != 0)
+			if len(plan.get('estimated', [])) > 0:
+				print "The readings of %d pair_ids were estimated: %s" % (len(plan['estimated']), " ".join([str(a) for a in plan['estimated']]))
+			for index, shard in enumerate(plan['shards']):
+				print "Shard %d/%d: %d pair_ids, %d rows: %s" % (index + 1, args.count, len(shard), sum([plan['weights'][str(a)] for a in shard]),
+																 " ".join([str(a) for a in shard]))
+		else:
+			if args.output_file_name == "":
+				raise ValueError("Give the output file name used by the shards")
+			PredDic = MergeShards(D, all_pair_ids, args.output_file_name, args.count)
+			print "Merged %d shards into %s" % (args.count, os.path.join(D['update_path'], args.output_file_name))
+			if args.routes != 0:
+				import RouteEngine as route
+				BTA.WriteJSON(route.RouteTables(D, PredDic, route.LoadRoutes(D)), D['update_path'],
+							  os.path.splitext(args.output_file_name)[0] + "_routes.json")
+	except ValueError, e:
+		print e; sys.exit(1)
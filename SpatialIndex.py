@@ -0,0 +1,76 @@
+"""This module holds a small spatial index over roadway and weather-station coordinates.  Points are stored as
+unit vectors on the sphere, so the great-circle distances from many query points to every indexed point come from
+one matrix product, and nearest-neighbour queries for all roadways are answered in a single batch."""
+
+import os
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_MILES = 3958.8
+
+def ToUnitVectors(lats, lons):
+	"""Convert arrays of (lats) and (lons), in degrees, to an (n, 3) array of points on the unit sphere."""
+	lat_rad, lon_rad = np.radians(np.asarray(lats, dtype = float)), np.radians(np.asarray(lons, dtype = float))
+	return np.column_stack([np.cos(lat_rad) * np.cos(lon_rad), np.cos(lat_rad) * np.sin(lon_rad), np.sin(lat_rad)])
+
+def BuildIndex(ids, lats, lons, groups = None):
+	"""Index the points (ids) at (lats)/(lons).  Points with impossible coordinates (NOAA lists Chatham at 99, 99)
+	are left out.  Optional (groups), such as a roadway's direction of travel, restrict neighbour queries."""
+	lats, lons = np.asarray(lats, dtype = float), np.asarray(lons, dtype = float)
+	valid = np.logical_and(np.abs(lats) <= 90, np.abs(lons) <= 180)
+	return {'ids' : [i for i, v in zip(ids, valid) if v],
+			'vectors' : ToUnitVectors(lats[valid], lons[valid]),
+			'groups' : None if groups is None else [g for g, v in zip(groups, valid) if v]}
+
+def GreatCircleMatrix(index, lats, lons):
+	"""Return the (queries, indexed points) matrix of great-circle distances, in miles, from each of the query
+	(lats)/(lons) to every point in the (index)."""
+	cos_angle = np.clip(np.dot(ToUnitVectors(lats, lons), index['vectors'].T), -1, 1)
+	return EARTH_RADIUS_MILES * np.arccos(cos_angle)
+
+def Nearest(index, lats, lons):
+	"""Return the id of the closest indexed point to each query (lats)/(lons), all in one batch."""
+	if len(index['ids']) == 0:
+		return [None for lat in lats]
+	closest = np.argmin(GreatCircleMatrix(index, lats, lons), axis = 1)
+	return [index['ids'][c] for c in closest]
+
+def KNearest(index, query_id, k, candidates = None):
+	"""Return up to (k) ids of indexed points closest to the indexed point (query_id), excluding itself.  If the
+	index is grouped, only points of the same group qualify, and if (candidates) is given, only those ids qualify."""
+	if query_id not in index['ids']:
+		return []
+	position = index['ids'].index(query_id)
+	group = None if index['groups'] is None else index['groups'][position]
+	distances = EARTH_RADIUS_MILES * np.arccos(np.clip(np.dot(index['vectors'], index['vectors'][position]), -1, 1))
+	neighbours = []
+	for c in np.argsort(distances):
+		candidate = index['ids'][c]
+		if candidate == query_id or (group is not None and index['groups'][c] != group):
+			continue
+		if candidates is not None and candidate not in candidates:
+			continue
+		neighbours.append(candidate)
+		if len(neighbours) == k:
+			break
+	return neighbours
+
+def NormalizeDirection(direction):
+	"""pair_definitions.csv writes the same heading as 'NB' or 'N', 'NWB' or 'NW'...  Reduce both to 'N', 'NW'."""
+	direction = str(direction).strip().upper()
+	return direction[:-1] if len(direction) > 1 and direction.endswith('B') else direction
+
+def RoadDirections(data_path, pair_definitions_name = "pair_definitions.csv"):
+	"""Return the direction of travel of every pair_id listed in (pair_definitions_name), if it exists."""
+	definitions_path = os.path.join(data_path, pair_definitions_name)
+	if not os.path.exists(definitions_path):
+		return {}
+	pair_definitions = pd.read_csv(definitions_path)
+	return dict((str(p), NormalizeDirection(d)) for p, d in zip(pair_definitions.pair_id, pair_definitions.Direction))
+
+def BuildRoadIndex(RoadwayCoordsDic, directions):
+	"""Index every roadway in (RoadwayCoordsDic) by its average lat/lon, grouped by its direction of travel in
+	(directions), as returned by RoadDirections.  Roadways with no listed direction form their own group ('')."""
+	roads = sorted(RoadwayCoordsDic.keys())
+	return BuildIndex(roads, [RoadwayCoordsDic[r]['Lat'] for r in roads], [RoadwayCoordsDic[r]['Lon'] for r in roads],
+					  [directions.get(r, '') for r in roads])
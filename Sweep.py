@@ -0,0 +1,174 @@
+"""This module sweeps the model's tuning parameters over a grid, or a random sample of it, scoring each point by
+backtest.  Points are grouped by the derived data they invalidate, so that each expensive artifact is built once:
+
+  - traffic_system_memory changes the traffic and weather history features, which are rebuilt once per value
+    into the sweep directory (the current value reuses the IndividualFiles), and again once a pair is rebuilt or
+    appended to;
+  - pct_range, time_range, weather_kernel_pct and analog_cap change which analogs are matched, which is done once
+    per combination, at every replayed timestamp;
+  - steps_to_smooth, steps_to_diurnal_return and min_spread_fac only change how those matches are unnormalized,
+    which is all that is repeated for each point.
+
+Every point is ranked by its mean pinball loss over all percentiles and horizons in a results table."""
+
+import os
+import json
+import time
+import random
+import datetime
+import argparse
+import itertools
+import multiprocessing
+import pandas as pd
+import BlueToadAnalysis as BTA
+import MassDotDataTypes as data
+import Backtest as backtest
+import BuildGraph as graph
+import PairStatistics as stats
+
+HISTORY_PARAMETERS = ['traffic_system_memory']
+MATCHING_PARAMETERS = ['pct_range', 'time_range', 'weather_kernel_pct', 'analog_cap']
+UNNORMALIZING_PARAMETERS = ['steps_to_smooth', 'steps_to_diurnal_return', 'min_spread_fac']
+SWEEP_PARAMETERS = HISTORY_PARAMETERS + MATCHING_PARAMETERS + UNNORMALIZING_PARAMETERS
+
+def ParseChoices(D, specs):
+	"""Parse 'name=v1,v2,...' (specs) into {name : [values]}, each value of the type of its default in (D)."""
+	choices = {}
+	for spec in specs:
+		name, values = spec.split("=", 1)
+		name = name.strip()
+		if name not in SWEEP_PARAMETERS:
+			raise ValueError("%s cannot be swept; choose from %s" % (name, ", ".join(SWEEP_PARAMETERS)))
+		choices[name] = [type(D[name])(v) for v in values.split(",")]
+	return choices
+
+def GridPoints(choices):
+	"""Every combination of the (choices), as a list of {name : value} points."""
+	names = sorted(choices.keys())
+	return [dict(zip(names, values)) for values in itertools.product(*[choices[n] for n in names])]
+
+def RandomPoints(choices, n, seed):
+	"""(n) distinct combinations of the (choices), drawn at random, or all of them if there are no more than (n)."""
+	names = sorted(choices.keys())
+	grid_size = reduce(lambda x, y: x * y, [len(choices[name]) for name in names], 1)
+	if grid_size <= n:
+		return GridPoints(choices)
+	rng, drawn = random.Random(seed), set()
+	while len(drawn) < n:
+		drawn.add(tuple(rng.choice(choices[name]) for name in names))
+	return [dict(zip(names, values)) for values in sorted(drawn)]
+
+def GroupPoints(D, points):
+	"""Group (points) by their history parameters, then within each by their matching parameters:
+	{(history values) : [[points sharing matching values], ...]}."""
+	groups = {}
+	for point in points:
+		full = dict(D, **point)
+		history_key = tuple(full[name] for name in HISTORY_PARAMETERS)
+		matching_key = tuple(full[name] for name in MATCHING_PARAMETERS)
+		groups.setdefault(history_key, {}).setdefault(matching_key, []).append(point)
+	return dict((h, [groups[h][m] for m in sorted(groups[h])]) for h in groups)
+
+def SourceKey(D, a):
+	"""The key of the weather file of roadway (a) the history features are built from: its stage key, from its
+	manifest, with its number of readings from its statistics, which live appends carry forward."""
+	pair_stats = stats.GetPairStats(D, a)
+	return graph.HashObject([graph.ReadManifest(D, a).get('weather'), pair_stats['count'] if pair_stats is not None else None])
+
+def BuildPairHistory(task):
+	"""Recompute the traffic and weather history features of one pair under the task's parameters, unless they were
+	built from its current weather file by an earlier sweep.  Run in a worker."""
+	D, a, history_dir, weights = task
+	base = D['bt_name'] + "_" + str(a)
+	weather_path = os.path.join(D['update_path'], "IndividualFiles", base + "_Cleaned_Normalized_Weather.csv")
+	key_path = os.path.join(history_dir, base + "_SweepKey.json")
+	if not os.path.exists(weather_path):
+		return a #never built at all
+	key = SourceKey(D, a) #read before the weather file, so a sweep racing an append is keyed to the shorter file
+	if os.path.exists(os.path.join(history_dir, base + "_CNW_TrafficHist_WeatherHist.csv")) and os.path.exists(key_path) and BTA.GetJSON("", key_path) == key:
+		return a
+	sub_bt = BTA.AttachTrafficHistory(data.ReadPairFile(weather_path), history_dir, base, D, weights)
+	BTA.AttachWeatherHistory(sub_bt, history_dir, base, D, weights)
+	BTA.WriteJSON(key, "", key_path)
+	return a
+
+def BuildHistoryGroup(D, all_pair_ids, weights, history_key, workdir, processes):
+	"""Return the directory of the history features for (history_key), building them first unless they are the
+	current ones (None, the IndividualFiles)."""
+	group_D = dict(D, **dict(zip(HISTORY_PARAMETERS, history_key)))
+	if all([group_D[name] == D[name] for name in HISTORY_PARAMETERS]):
+		return None
+	history_dir = os.path.join(workdir, "_".join(["%s_%s" % (name, group_D[name]) for name in HISTORY_PARAMETERS]))
+	if not os.path.exists(history_dir): os.makedirs(history_dir)
+	tasks = [(group_D, a, history_dir, weights) for a in all_pair_ids.pair_id]
+	print "Building history features for %s in %s" % (", ".join(["%s=%s" % (n, group_D[n]) for n in HISTORY_PARAMETERS]), history_dir)
+	if processes > 1:
+		pool = multiprocessing.Pool(processes)
+		pool.map(BuildPairHistory, tasks, chunksize = 1)
+		pool.close(); pool.join()
+	else:
+		map(BuildPairHistory, tasks)
+	return history_dir
+
+def Summarize(point, scores, pcts):
+	"""One row of the results table: the (point)'s parameters and its overall scores."""
+	numeric = [p for p in pcts if p not in ['min', 'max']]
+	counts = dict((p, float(scores[p + '_count'].sum())) for p in pcts)
+	row = dict(point)
+	row['predictions'] = scores['predictions']
+	row['pinball'] = round(sum([scores[p + '_pinball'].sum() for p in numeric]) / max(sum([counts[p] for p in numeric]), 1), 4)
+	row['median_mae'] = round(scores['50_abs_error'].sum() / max(counts['50'], 1), 4) if '50' in pcts else None
+	row['coverage_error'] = round(sum([abs(scores[p + '_below'].sum() / max(counts[p], 1) - float(p) / 100) for p in numeric]) / max(len(numeric), 1), 4)
+	return row
+
+def RunSweep(D, all_pair_ids, weights, points, slots, subset, pred_len, workdir, processes):
+	"""Score every one of (points) by backtest over (slots), building each artifact once per group, and return the
+	rows of the results table, best first."""
+	rows = []
+	groups = GroupPoints(D, points)
+	for history_key in sorted(groups):
+		history_dir = BuildHistoryGroup(D, all_pair_ids, weights, history_key, workdir, processes)
+		group_D = dict(D, **dict(zip(HISTORY_PARAMETERS, history_key)))
+		backtest.LoadReplay(group_D, all_pair_ids, subset, pred_len, history_dir)
+		point_groups = groups[history_key]
+		print "Replaying %d timestamps for %d points in %d matching groups" % (len(slots), sum([len(g) for g in point_groups]), len(point_groups))
+		for point_group, group_scores in zip(point_groups, backtest.Replay(point_groups, slots, processes)):
+			for point, scores in zip(point_group, group_scores):
+				full = dict(group_D, **point)
+				rows.append(Summarize(dict((n, full[n]) for n in SWEEP_PARAMETERS), scores, backtest.replay_settings['pcts']))
+	return sorted(rows, key = lambda row: row['pinball'])
+
+if __name__ == "__main__":
+	D = BTA.HardCodedParameters()
+	environment_vars = BTA.GetJSON("","config.json") if os.path.exists("config.json") else {}
+	for key in environment_vars:
+		D[key] = environment_vars[key]
+	parser = argparse.ArgumentParser()
+	parser.add_argument("start", help = "first timestamp replayed, as YYYY-MM-DDTHH:MM")
+	parser.add_argument("end", help = "last timestamp replayed, as YYYY-MM-DDTHH:MM")
+	parser.add_argument("-p", "--parameter", help = "values of one parameter to sweep, as 'name=v1,v2,...'; repeat for each parameter", action = "append", default = [])
+	parser.add_argument("-r", "--random", help = "score this many random combinations rather than the whole grid", type = int, default = 0)
+	parser.add_argument("--seed", help = "random seed for (-r)", type = int, default = 0)
+	parser.add_argument("-e", "--every", help = "minutes between replayed timestamps, default of 60", type = int, default = 60)
+	parser.add_argument("-s", "--subset", help = "analog subset, as in BlueToadAnalysis", type = str, default = 'WTO')
+	parser.add_argument("-l", "--length", help = "horizon scored, in five-minute increments, default of 288 (one day)", type = int, default = 288)
+	parser.add_argument("-j", "--jobs", help = "worker processes, default of one per core", type = int, default = multiprocessing.cpu_count())
+	parser.add_argument("-d", "--workdir", help = "directory for rebuilt history features", type = str, default = os.path.join("update", "sweep"))
+	parser.add_argument("-o", "--output", help = "file to which the JSON results are written, with the table beside it as a .csv", type = str, default = "sweep_results.json")
+	args = parser.parse_args()
+
+	start_time = time.time()
+	choices = ParseChoices(D, args.parameter)
+	points = RandomPoints(choices, args.random, args.seed) if args.random > 0 else GridPoints(choices)
+	slots = backtest.TimestampSlots(datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M"), datetime.datetime.strptime(args.end, "%Y-%m-%dT%H:%M"), args.every)
+	all_pair_ids = pd.read_csv(os.path.join(D['data_path'], "all_pair_ids.csv"))
+	weights = list(pd.read_csv(os.path.join(D['data_path'], 'DecaySeries.csv')).Weight)
+	rows = RunSweep(D, all_pair_ids, weights, points, slots, args.subset, args.length, args.workdir, max(args.jobs, 1))
+	table = pd.DataFrame(rows, columns = SWEEP_PARAMETERS + ['pinball', 'median_mae', 'coverage_error', 'predictions'])
+	table.index = range(1, len(table) + 1)
+	with open(args.output, 'wb') as outfile:
+		json.dump({'points' : len(points), 'timestamps' : len(slots), 'subset' : args.subset, 'seconds' : round(time.time() - start_time, 2),
+				   'ranked' : rows}, outfile, indent = 1)
+	table.to_csv(os.path.splitext(args.output)[0] + ".csv", index_label = 'rank')
+	print table.head(20).to_string()
+	print "Scored %d points in %.1f s; results written to %s" % (len(points), time.time() - start_time, args.output)
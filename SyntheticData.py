@@ -0,0 +1,100 @@
+"""This module writes synthetic, but realistically shaped, BlueToad and NCDC inputs, so that the pipeline can be
+benchmarked and exercised offline at any scale.  Speeds follow a weekday/weekend diurnal cycle with rush-hour
+slowdowns, weather penalties, random incidents, and noise; a configurable fraction of five-minute readings is
+either reported as '\\N' or missing entirely, as in the MassDOT archive."""
+
+import os
+import shutil
+import datetime
+import numpy as np
+import pandas as pd
+
+WEATHER_STRINGS = {' ' : ' ', 'RA' : '-RA', 'FG' : 'BR', 'SN' : 'SN'} #an NCDC WeatherType string for each classification
+WEATHER_PENALTY = {' ' : 0, 'RA' : 5, 'FG' : 3, 'SN' : 15} #mph lost in each type of weather
+DEFAULT_WEATHER_MIX = {' ' : 0.8, 'RA' : 0.12, 'FG' : 0.05, 'SN' : 0.03}
+
+def ParseWeatherMix(mix_string):
+	"""Turn a string such as ' :0.8,RA:0.12,FG:0.05,SN:0.03' into a dictionary of weather fractions summing to one."""
+	mix = {}
+	for item in mix_string.split(','):
+		weather, fraction = item.rsplit(':', 1)
+		mix[weather if weather.strip() != '' else ' '] = float(fraction)
+	total = sum(mix.values())
+	return dict((w, f / total) for w, f in mix.items())
+
+def FiveMinuteTimes(start, months):
+	"""Return the datetimes of every five-minute step over (months) thirty-day months from (start)."""
+	return [start + datetime.timedelta(minutes = 5 * i) for i in xrange(months * 30 * 288)]
+
+def WeatherSequence(rng, n_hours, weather_mix, episode_hours = 6):
+	"""Draw a weather classification for each hour, holding each draw for an episode of (episode_hours)."""
+	types = sorted(weather_mix.keys())
+	episodes = rng.choice(types, size = n_hours / episode_hours + 1, p = [weather_mix[t] for t in types])
+	return [episodes[h / episode_hours] for h in xrange(n_hours)]
+
+def SyntheticSpeeds(rng, times, hourly_weather, base_speed):
+	"""Return the speed of one roadway at each of (times), given the (hourly_weather) and its free-flow (base_speed)."""
+	hours = np.array([t.hour + t.minute / 60.0 for t in times])
+	weekday = np.array([t.weekday() < 5 for t in times])
+	rush = 12 * np.exp(-((hours - 8) ** 2) / 1.5) + 15 * np.exp(-((hours - 17.5) ** 2) / 2.0)
+	speeds = base_speed - np.where(weekday, rush, rush / 4) #weekends see far milder peaks
+	speeds -= np.array([WEATHER_PENALTY[hourly_weather[i / 12]] for i in xrange(len(times))])
+	for start in rng.randint(0, len(times), size = max(1, len(times) / 2000)): #roughly one incident a week
+		speeds[start:start + rng.randint(6, 24)] -= rng.uniform(10, 30)
+	speeds += rng.normal(0, 2.5, size = len(times))
+	return np.clip(speeds, 3, 85)
+
+def WriteBlueToad(D, pair_ids, times, hourly_weather, gap_rate, rng):
+	"""Write the synthetic archive to (D)['bt_path'], one pair at a time to bound memory.  Half of the gaps are
+	'\\N' readings, the other half are rows that never appear.  Returns the number of rows written."""
+	time_strings = [t.strftime("%m/%d/%Y %H:%M:%S") for t in times]
+	out_path = os.path.join(D['bt_path'], D['bt_name'] + ".csv")
+	rows = 0
+	for ind, a in enumerate(pair_ids):
+		speeds = ['%.1f' % s for s in SyntheticSpeeds(rng, times, hourly_weather, rng.uniform(45, 65))]
+		gaps = rng.rand(len(times)) < gap_rate
+		dropped = np.logical_and(gaps, rng.rand(len(times)) < 0.5)
+		for i in np.nonzero(np.logical_and(gaps, np.logical_not(dropped)))[0]:
+			speeds[i] = '\\N'
+		keep = np.nonzero(np.logical_not(dropped))[0]
+		pair_df = pd.DataFrame({'pair_id' : [a] * len(keep), 'insert_time' : [time_strings[i] for i in keep],
+								'speed' : [speeds[i] for i in keep]})
+		pair_df[['pair_id', 'insert_time', 'speed']].to_csv(out_path, mode = 'w' if ind == 0 else 'a', header = ind == 0, index = False)
+		rows += len(pair_df)
+	return rows
+
+def WriteWeather(D, site_name, start, hourly_weather):
+	"""Write an hourly NCDC-style record, as read by GetWeatherData, for (site_name)."""
+	hour_times = [start + datetime.timedelta(hours = h, minutes = 54) for h in xrange(len(hourly_weather))]
+	weather_df = pd.DataFrame({'WBAN' : [14739.0] * len(hour_times),
+							   'Date' : [float(t.strftime("%Y%m%d")) for t in hour_times],
+							   'Time' : [float(t.strftime("%H%M")) for t in hour_times],
+							   'SkyCondition' : ['OVC010' if w != ' ' else 'CLR' for w in hourly_weather],
+							   'WeatherType' : [WEATHER_STRINGS[w] for w in hourly_weather]})
+	weather_df.to_csv(os.path.join(D['weather_dir'], site_name + "_NCDC.csv"), index = False)
+	return len(weather_df)
+
+def GenerateDataset(D, n_pairs, months, gap_rate, weather_mix = DEFAULT_WEATHER_MIX, seed = 0,
+					start = datetime.datetime(2013, 1, 7)):
+	"""Write a complete synthetic input tree under the paths in (D): the BlueToad archive, all_pair_ids.csv,
+	DecaySeries.csv, and the default site's NCDC record.  Returns a summary of what was generated."""
+	rng = np.random.RandomState(seed)
+	for path in [D['bt_path'], D['data_path'], D['weather_dir'], os.path.join(D['update_path'], "IndividualFiles")]:
+		if not os.path.exists(path): os.makedirs(path)
+	repo_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+	shutil.copy(os.path.join(repo_data, "DecaySeries.csv"), os.path.join(D['data_path'], "DecaySeries.csv"))
+	pair_ids = [10000 + i for i in range(n_pairs)]
+	pd.DataFrame({'pair_id' : pair_ids}).to_csv(os.path.join(D['data_path'], "all_pair_ids.csv"), index = False)
+	times = FiveMinuteTimes(start, months)
+	hourly_weather = WeatherSequence(rng, len(times) / 12 + 1, weather_mix)
+	rows = WriteBlueToad(D, pair_ids, times, hourly_weather, gap_rate, rng)
+	WriteWeather(D, D['weather_site_default'], start, hourly_weather)
+	return {'pairs' : n_pairs, 'months' : months, 'gap_rate' : gap_rate, 'weather_mix' : weather_mix, 'seed' : seed,
+			'rows' : rows, 'start' : start.isoformat(), 'end' : times[-1].isoformat()}
+
+def PointAt(D, root):
+	"""Return a copy of the parameter dictionary (D) with every input and output path rooted at (root)."""
+	D = dict(D)
+	D['bt_path'], D['update_path'], D['data_path'] = [os.path.join(root, p) for p in ["scratch", "update", "data"]]
+	D['weather_dir'] = os.path.join(D['data_path'], "NCDC_Weather")
+	return D
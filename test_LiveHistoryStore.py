@@ -0,0 +1,55 @@
+"""Checks that live snapshots appended to a pair's history survive a rebuild of the stages downstream of them."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+import BlueToadAnalysis as BTA
+import MassDotDataTypes as data
+import BuildGraph as graph
+import LiveHistoryStore as history
+
+PAIR_ID, HISTORY_ROWS, APPENDED_ROWS = 5, 200, 5
+
+def InsertTime(i):
+	"""The YYYYDOY.fff insert_time of the (i)th five-minute reading from the start of 2013."""
+	return round(2013001 + i / 288.0, 3)
+
+class AppendThenRebuildTest(unittest.TestCase):
+
+	def setUp(self):
+		self.update_path = tempfile.mkdtemp(prefix = "live_history_")
+		self.D = dict(BTA.HardCodedParameters(), update_path = self.update_path, bt_name = "bt")
+		self.weights = list(pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "DecaySeries.csv")).Weight)
+		self.DiurnalDic = dict((str(PAIR_ID) + "_" + str(d), {'50' : [50.0] * 288}) for d in range(7))
+		bt_path, bt_name = os.path.join(self.update_path, "IndividualFiles"), "bt_" + str(PAIR_ID)
+		os.makedirs(bt_path)
+		times = [InsertTime(i) for i in range(HISTORY_ROWS)]
+		sub_bt = data.CompactFrame(pd.DataFrame({'pair_id' : PAIR_ID, 'insert_time' : times, 'speed' : [50.0 - i % 7 for i in range(HISTORY_ROWS)],
+												 'time_of_day' : [round(t - int(t), 3) for t in times],
+												 'day_of_week' : [BTA.GetDayOfWeek(int(t)) for t in times]}))
+		sub_bt = BTA.NormalizeTravelTime(sub_bt, self.DiurnalDic, bt_path, bt_name)
+		sub_bt['weather'] = ['RA' if i % 10 == 0 else ' ' for i in range(HISTORY_ROWS)] #as AttachWeatherData would, without an NCDC record
+		sub_bt = data.CompactFrame(sub_bt)
+		BTA.WriteCSVAtomic(sub_bt, graph.StageOutputs(self.D, PAIR_ID)['weather'])
+		sub_bt = BTA.AttachTrafficHistory(sub_bt, bt_path, bt_name, self.D, self.weights)
+		BTA.AttachWeatherHistory(sub_bt, bt_path, bt_name, self.D, self.weights)
+
+	def tearDown(self):
+		shutil.rmtree(self.update_path)
+
+	def testWeatherCostChangeKeepsAppendedRows(self):
+		snapshots = [(InsertTime(HISTORY_ROWS + j), 45.0, 'RA') for j in range(APPENDED_ROWS)]
+		self.assertEqual(history.AppendSnapshots(self.D, PAIR_ID, snapshots, self.DiurnalDic, self.weights), APPENDED_ROWS)
+		outputs = graph.StageOutputs(self.D, PAIR_ID)
+		for stage in ['normalized', 'weather', 'traffic_hist', 'weather_hist']:
+			self.assertEqual(len(data.ReadPairFile(outputs[stage])), HISTORY_ROWS + APPENDED_ROWS)
+		rebuilt_D = dict(self.D, weather_cost_facs = dict(self.D['weather_cost_facs'], RA = 2))
+		graph.RunStages(rebuilt_D, PAIR_ID, ['weather_hist'], {'weather_hist' : 'rebuilt'}, {}, self.weights)
+		rebuilt = data.ReadPairFile(outputs['weather_hist'])
+		self.assertEqual(len(rebuilt), HISTORY_ROWS + APPENDED_ROWS)
+		self.assertEqual(float(rebuilt.insert_time.iloc[-1]), InsertTime(HISTORY_ROWS + APPENDED_ROWS - 1))
+
+if __name__ == "__main__":
+	unittest.main()